@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""Benchmark harness for server.py.
+
+Generates a synthetic music library, then drives the API and audio Range
+requests through the Flask test client (handler cost only) and through a real
+server process over sockets. Results can be saved as a baseline and later runs
+compared against it.
+
+    python bench/bench.py --playlists 20 --songs 200 --save-baseline bench/baseline.json
+    python bench/bench.py --playlists 20 --songs 200 --baseline bench/baseline.json
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WORK_DIR = os.path.join(REPO_DIR, "cache", "bench")
+
+LYRIC_WORDS = ("雨", "风", "夜", "光", "梦", "海", "星", "歌", "心", "路",
+               "rain", "wind", "night", "light", "dream", "sea", "star", "song")
+
+
+# --- Synthetic library ---
+
+def library_signature(args):
+    config = [args.playlists, args.songs, args.lrc_ratio, args.audio_kb, args.lrc_lines, args.seed]
+    return hashlib.sha1(json.dumps(config).encode()).hexdigest()[:12]
+
+
+def make_lrc(rng, lines):
+    out = []
+    for i in range(lines):
+        t = i * 3.5
+        text = " ".join(rng.choice(LYRIC_WORDS) for _ in range(rng.randint(3, 8)))
+        out.append(f"[{int(t // 60):02d}:{t % 60:05.2f}]{text}")
+    return "\n".join(out) + "\n"
+
+
+def generate_library(root, args):
+    """Create ``root/music/<playlist>/<song>/`` with dummy audio and optional .lrc.
+
+    Output is deterministic for a given configuration and is reused when the
+    marker file matches, so repeated runs measure the same tree.
+    """
+    marker = os.path.join(root, "library.json")
+    signature = library_signature(args)
+    if os.path.isfile(marker):
+        with open(marker, encoding="utf-8") as f:
+            existing = json.load(f)
+        if existing.get("signature") == signature:
+            return existing["songs"]
+
+    rng = random.Random(args.seed)
+    music_dir = os.path.join(root, "music")
+    for stale in (music_dir, os.path.join(root, "cache")):
+        if os.path.isdir(stale):
+            shutil.rmtree(stale)
+
+    audio = bytes(rng.getrandbits(8) for _ in range(min(args.audio_kb * 1024, 65536)))
+    songs = []
+    for p in range(args.playlists):
+        playlist = f"{p + 1}-bench-{p:03d}"
+        for s in range(args.songs):
+            song = f"song-{p:03d}-{s:05d}"
+            song_dir = os.path.join(music_dir, playlist, song)
+            os.makedirs(song_dir, exist_ok=True)
+            with open(os.path.join(song_dir, f"{song}.mp3"), "wb") as f:
+                remaining = args.audio_kb * 1024
+                while remaining > 0:
+                    f.write(audio[:remaining])
+                    remaining -= len(audio)
+            has_lrc = rng.random() < args.lrc_ratio
+            if has_lrc:
+                with open(os.path.join(song_dir, f"{song}.lrc"), "w", encoding="utf-8") as f:
+                    f.write(make_lrc(rng, args.lrc_lines))
+            songs.append([playlist, song, has_lrc])
+
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump({"signature": signature, "songs": songs}, f)
+    return songs
+
+
+# --- Scenarios ---
+
+def build_scenarios(songs, args):
+    """Return ``{name: [(method, path, body, headers), ...]}`` with a fixed request mix."""
+    rng = random.Random(args.seed + 1)
+    playlists = sorted({playlist for playlist, _, _ in songs})
+    by_playlist = {}
+    for playlist, song, has_lrc in songs:
+        by_playlist.setdefault(playlist, []).append((song, has_lrc))
+    audio_bytes = args.audio_kb * 1024
+    n = args.requests
+
+    def pick():
+        playlist, song, has_lrc = rng.choice(songs)
+        return playlist, song
+
+    def folders():
+        return ("GET", "/api/folders", None, {})
+
+    def songs_list():
+        return ("GET", "/api/songs?" + urlencode({"folder": rng.choice(playlists)}), None, {})
+
+    def lyrics():
+        playlist, song = pick()
+        return ("GET", "/api/lyrics?" + urlencode({"folder": playlist, "song": song}), None, {})
+
+    def batch_names():
+        playlist = rng.choice(playlists)
+        names = [song for song, _ in by_playlist[playlist][:args.batch_size]]
+        return playlist, names
+
+    def batch_lyrics():
+        playlist, names = batch_names()
+        query = urlencode({"folder": playlist, "songs": json.dumps(names, ensure_ascii=False)})
+        return ("GET", "/api/batch-lyrics?" + query, None, {})
+
+    def batch_lyrics_stream():
+        playlist, names = batch_names()
+        body = json.dumps({"folder": playlist, "songs": names}).encode()
+        return ("POST", "/api/batch-lyrics", body, {"Content-Type": "application/json"})
+
+    def music_range():
+        playlist, song = pick()
+        start = rng.randrange(0, max(1, audio_bytes - args.range_kb * 1024))
+        end = min(audio_bytes, start + args.range_kb * 1024) - 1
+        path = "/music/" + quote(f"{playlist}/{song}/{song}.mp3")
+        return ("GET", path, None, {"Range": f"bytes={start}-{end}"})
+
+    makers = {
+        "folders": folders,
+        "songs": songs_list,
+        "lyrics": lyrics,
+        "batch-lyrics": batch_lyrics,
+        "batch-lyrics-stream": batch_lyrics_stream,
+        "music-range": music_range,
+    }
+    selected = args.scenarios or list(makers)
+    return {name: [makers[name]() for _ in range(n)] for name in selected}
+
+
+# --- Drivers ---
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, elapsed, errors):
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run_test_client(scenarios, args):
+    """In-process: import server with the synthetic library as cwd."""
+    sys.path.insert(0, REPO_DIR)
+    import server
+
+    server.prepare_caches()
+    client = server.app.test_client()
+    results = {}
+    for name, plan in scenarios.items():
+        for method, path, body, headers in plan[:args.warmup]:
+            client.open(path, method=method, data=body, headers=headers).close()
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for method, path, body, headers in plan:
+            t0 = time.perf_counter()
+            response = client.open(path, method=method, data=body, headers=headers)
+            response.get_data()
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code >= 400:
+                errors += 1
+            response.close()
+        results[name] = summarize(latencies, time.perf_counter() - started, errors)
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args):
+    port = free_port()
+    command = [sys.executable, os.path.join(REPO_DIR, "server.py"), "--host", "127.0.0.1",
+               "--port", str(port), "--server", args.server,
+               # keep background work (watcher, warmup, waveform precompute) out of the numbers
+               "--watch", "off", "--waveforms", "on-demand", "--no-warmup"]
+    if args.server != "flask":
+        command += ["--threads", str(args.concurrency)]
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with status {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/api/folders")
+            conn.getresponse().read()
+            conn.close()
+            return proc, port
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start within 60s")
+
+
+def socket_request(port, request_):
+    method, path, body, headers = request_
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        t0 = time.perf_counter()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return time.perf_counter() - t0, response.status >= 400
+    finally:
+        conn.close()
+
+
+def run_socket(scenarios, args):
+    """Real server process on a loopback port, ``--concurrency`` client threads."""
+    proc, port = start_server(args)
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for name, plan in scenarios.items():
+                list(pool.map(lambda r: socket_request(port, r), plan[:args.warmup]))
+                started = time.perf_counter()
+                outcomes = list(pool.map(lambda r: socket_request(port, r), plan))
+                elapsed = time.perf_counter() - started
+                latencies = [latency for latency, _ in outcomes]
+                errors = sum(1 for _, failed in outcomes if failed)
+                results[name] = summarize(latencies, elapsed, errors)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return results
+
+
+DRIVERS = {"client": run_test_client, "socket": run_socket}
+
+
+# --- Reporting ---
+
+def print_results(results):
+    print(f"{'driver':<8} {'scenario':<22} {'req':>6} {'err':>4} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for driver, scenarios in results.items():
+        for name, r in scenarios.items():
+            print(f"{driver:<8} {name:<22} {r['requests']:>6} {r['errors']:>4} "
+                  f"{r['rps']:>9.1f} {r['p50_ms']:>9.3f} {r['p99_ms']:>9.3f}")
+
+
+def compare(results, baseline, args):
+    """Return a list of regression messages against ``baseline``."""
+    regressions = []
+    for driver, scenarios in results.items():
+        for name, r in scenarios.items():
+            base = baseline.get(driver, {}).get(name)
+            if not base:
+                continue
+            checks = (
+                ("p50_ms", r["p50_ms"], base["p50_ms"] * (1 + args.threshold), ">"),
+                ("p99_ms", r["p99_ms"], base["p99_ms"] * (1 + args.p99_threshold), ">"),
+                ("rps", r["rps"], base["rps"] / (1 + args.threshold), "<"),
+            )
+            for metric, value, limit, direction in checks:
+                worse = value > limit if direction == ">" else value < limit
+                if worse:
+                    regressions.append(f"{driver}/{name}: {metric} {value} vs baseline "
+                                       f"{base[metric]} (limit {limit:.3f})")
+            if r["errors"] > base.get("errors", 0):
+                regressions.append(f"{driver}/{name}: {r['errors']} errors "
+                                   f"(baseline {base.get('errors', 0)})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the music player server")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR,
+                        help="Where the synthetic library is generated (default: cache/bench)")
+    parser.add_argument("--playlists", type=int, default=10)
+    parser.add_argument("--songs", type=int, default=100, help="Songs per playlist")
+    parser.add_argument("--lrc-ratio", type=float, default=0.8,
+                        help="Fraction of songs that get an .lrc file")
+    parser.add_argument("--lrc-lines", type=int, default=40)
+    parser.add_argument("--audio-kb", type=int, default=512, help="Size of each dummy audio file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=20, help="Songs per batch-lyrics request")
+    parser.add_argument("--range-kb", type=int, default=64, help="Size of each Range request")
+    parser.add_argument("--concurrency", type=int, default=8, help="Client threads for the socket driver")
+    parser.add_argument("--server", choices=["flask", "waitress", "gunicorn"], default="flask",
+                        help="Server used by the socket driver")
+    parser.add_argument("--drivers", nargs="+", choices=list(DRIVERS), default=list(DRIVERS))
+    parser.add_argument("--scenarios", nargs="+", help="Subset of scenarios to run")
+    parser.add_argument("--output", help="Write results as JSON")
+    parser.add_argument("--save-baseline", help="Write results to this baseline file")
+    parser.add_argument("--baseline", help="Compare against this baseline file")
+    parser.add_argument("--threshold", type=float, default=0.20,
+                        help="Allowed p50/throughput regression (default: 0.20)")
+    parser.add_argument("--p99-threshold", type=float, default=0.50,
+                        help="Allowed p99 regression (default: 0.50)")
+    args = parser.parse_args()
+    for name in ("work_dir", "output", "save_baseline", "baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    started = time.perf_counter()
+    songs = generate_library(args.work_dir, args)
+    print(f"Library: {args.playlists} playlists x {args.songs} songs in {args.work_dir} "
+          f"({time.perf_counter() - started:.1f}s)")
+
+    # server.py resolves music/ and cache/ against the working directory
+    os.chdir(args.work_dir)
+    scenarios = build_scenarios(songs, args)
+    results = {}
+    for driver in args.drivers:
+        results[driver] = DRIVERS[driver](scenarios, args)
+    print_results(results)
+
+    report = {
+        "config": {k: v for k, v in vars(args).items()
+                   if k not in ("output", "save_baseline", "baseline", "work_dir")},
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("Warning: baseline was recorded with a different configuration")
+        regressions = compare(results, baseline["results"], args)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+音乐库内容去重索引
+
+按文件内容（分块哈希）识别重复音频。哈希结果按 路径+大小+修改时间 缓存在
+cache/content_index.sqlite3，只有大小相同的文件才需要计算哈希，计算在进程池中并行
+（嵌入服务器等多线程进程时改用线程池）。
+
+    python download/dedup.py              # 报告重复文件
+    python download/dedup.py --collapse   # 将重复文件替换为硬链接
+"""
+
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MUSIC_DIR = os.path.join(ROOT_DIR, 'music')
+INDEX_DB = os.path.join(ROOT_DIR, 'cache', 'content_index.sqlite3')
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.aac', '.wav', '.ogg', '.flac')
+HASH_CHUNK_SIZE = 1024 * 1024
+PARALLEL_HASH_MIN = 8    # 少于这么多文件时不启动进程池
+
+def hash_file(path: str) -> str:
+    """分块计算文件内容哈希"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def format_size(size: int) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+
+class ContentIndex:
+    """音乐库文件的 大小/修改时间/内容哈希 索引（路径相对于 music 目录）
+
+    processes=False 时用线程池计算哈希（hashlib 计算时释放 GIL），供服务器等
+    多线程进程使用，避免在其中 fork 或重新导入主模块。
+    """
+
+    def __init__(self, music_dir: str = MUSIC_DIR, db_path: str = INDEX_DB, processes: bool = True):
+        self.music_dir = os.path.abspath(music_dir)
+        self.processes = processes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+        self.refreshed = False
+
+    def relpath(self, path: str) -> Optional[str]:
+        """库内文件返回相对路径，库外返回 None"""
+        path = os.path.abspath(path)
+        if os.path.commonpath([path, self.music_dir]) != self.music_dir:
+            return None
+        return os.path.relpath(path, self.music_dir)
+
+    def abspath(self, rel_path: str) -> str:
+        return os.path.join(self.music_dir, rel_path)
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        for root, _, names in os.walk(self.music_dir):
+            for name in names:
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files[os.path.relpath(path, self.music_dir)] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def refresh(self, workers: Optional[int] = None):
+        """同步索引与磁盘：删除已消失的文件，并为大小相同的文件补算哈希"""
+        files = self.scan()
+        with self.lock:
+            cached = {path: (size, mtime, digest) for path, size, mtime, digest
+                      in self.db.execute("SELECT path, size, mtime_ns, hash FROM files")}
+            with self.db:
+                self.db.executemany("DELETE FROM files WHERE path = ?",
+                                    [(path,) for path in cached if path not in files])
+                for path, (size, mtime) in files.items():
+                    entry = cached.get(path)
+                    if entry is None or entry[:2] != (size, mtime):
+                        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL)",
+                                        (path, size, mtime))
+            stale = [path for (path,) in self.db.execute(
+                "SELECT path FROM files WHERE hash IS NULL AND size IN "
+                "(SELECT size FROM files GROUP BY size HAVING COUNT(*) > 1)")]
+        self.hash_paths(stale, workers)
+        self.refreshed = True
+
+    def hash_paths(self, rel_paths: List[str], workers: Optional[int] = None):
+        if not rel_paths:
+            return
+        paths = [self.abspath(p) for p in rel_paths]
+        if len(paths) < PARALLEL_HASH_MIN:
+            digests = [try_hash_file(p) for p in paths]
+        elif self.processes:
+            # spawn 而非 fork：fork 会复制其他线程持有的锁
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context('spawn')) as pool:
+                digests = list(pool.map(try_hash_file, paths, chunksize=4))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                digests = list(pool.map(try_hash_file, paths))
+        with self.lock, self.db:
+            self.db.executemany("UPDATE files SET hash = ? WHERE path = ?",
+                                [(d, p) for d, p in zip(digests, rel_paths) if d])
+
+    def add(self, path: str, digest: Optional[str] = None):
+        """登记新加入库中的文件"""
+        rel_path = self.relpath(path)
+        if rel_path is None:
+            return
+        st = os.stat(path)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (rel_path, st.st_size, st.st_mtime_ns, digest))
+
+    def find_duplicate(self, path: str) -> Optional[str]:
+        """返回库中与 path 内容相同的文件（绝对路径），没有则返回 None"""
+        if not self.refreshed:
+            self.refresh()
+        size = os.path.getsize(path)
+        own = self.relpath(path)
+        with self.lock:
+            candidates = [(p, mtime, digest) for p, mtime, digest in self.db.execute(
+                "SELECT path, mtime_ns, hash FROM files WHERE size = ?", (size,)) if p != own]
+        if not candidates:
+            return None
+        digest = hash_file(path)
+        unhashed = []
+        for rel_path, mtime, candidate_digest in candidates:
+            try:
+                st = os.stat(self.abspath(rel_path))
+            except OSError:
+                continue
+            if st.st_size != size or st.st_mtime_ns != mtime:
+                self.add(self.abspath(rel_path))
+                unhashed.append(rel_path)
+            elif candidate_digest is None:
+                unhashed.append(rel_path)
+            elif candidate_digest == digest:
+                return self.abspath(rel_path)
+        self.hash_paths(unhashed)
+        with self.lock:
+            for (rel_path,) in self.db.execute(
+                    "SELECT path FROM files WHERE size = ? AND hash = ?", (size, digest)):
+                if rel_path != own:
+                    return self.abspath(rel_path)
+        return None
+
+    def duplicate_groups(self) -> List[Tuple[str, List[str]]]:
+        """内容相同的文件分组：(哈希, 按路径排序的相对路径列表)"""
+        groups = {}
+        with self.lock:
+            for path, digest in self.db.execute(
+                    "SELECT path, hash FROM files WHERE hash IS NOT NULL ORDER BY path"):
+                groups.setdefault(digest, []).append(path)
+        return [(digest, paths) for digest, paths in groups.items() if len(paths) > 1]
+
+    def close(self):
+        self.db.close()
+
+def try_hash_file(path: str) -> Optional[str]:
+    """进程池任务：读取失败时返回 None"""
+    try:
+        return hash_file(path)
+    except OSError:
+        return None
+
+def link_duplicate(source: str, target: str):
+    """用指向 source 的硬链接原子替换 target"""
+    tmp_path = target + '.dedup-tmp'
+    os.link(source, tmp_path)
+    try:
+        os.replace(tmp_path, target)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+def report_duplicates(index: ContentIndex, collapse: bool = False):
+    """报告（并可选地合并）库中的重复文件"""
+    groups = index.duplicate_groups()
+    wasted = 0
+    reclaimed = 0
+    shown = 0
+    for digest, paths in groups:
+        present = []
+        for rel_path in paths:
+            try:
+                present.append((rel_path, os.stat(index.abspath(rel_path))))
+            except OSError:
+                continue  # 索引之后被删除或移动
+        if len(present) < 2:
+            continue
+        keep_path, keep_stat = present[0]
+        keep = index.abspath(keep_path)
+        copies = []
+        group_wasted = 0
+        inodes = {(keep_stat.st_dev, keep_stat.st_ino)}
+        for rel_path, st in present[1:]:
+            if (st.st_dev, st.st_ino) != (keep_stat.st_dev, keep_stat.st_ino):
+                copies.append((rel_path, st))
+            # 互为硬链接的副本只占一份空间
+            if (st.st_dev, st.st_ino) not in inodes:
+                inodes.add((st.st_dev, st.st_ino))
+                group_wasted += st.st_size
+        if not copies:
+            continue
+        wasted += group_wasted
+        collapsed = True
+        shown += 1
+        print(f"\n{format_size(keep_stat.st_size)} × {len(copies) + 1}")
+        print(f"  保留: {keep_path}")
+        for rel_path, st in copies:
+            if not collapse:
+                print(f"  重复: {rel_path}")
+                continue
+            if st.st_dev != keep_stat.st_dev:
+                print(f"  ⚠️  跨文件系统，跳过: {rel_path}")
+                collapsed = False
+                continue
+            try:
+                link_duplicate(keep, index.abspath(rel_path))
+                index.add(index.abspath(rel_path), digest)
+                print(f"  🔗 已替换为硬链接: {rel_path}")
+            except OSError as e:
+                print(f"  ❌ 替换失败 {rel_path}: {e}")
+                collapsed = False
+        if collapse and collapsed:
+            reclaimed += group_wasted
+
+    if not shown:
+        print("✅ 未发现重复文件")
+    elif collapse:
+        print(f"\n✅ {shown} 组重复文件，释放 {format_size(reclaimed)}")
+    else:
+        print(f"\n共 {shown} 组重复文件，占用 {format_size(wasted)}；使用 --collapse 替换为硬链接")
+
+def main():
+    """主函数"""
+    if '--help' in sys.argv or '-h' in sys.argv:
+        print("音乐库去重工具")
+        print("\n使用方法:")
+        print("  python dedup.py              # 报告重复文件")
+        print("  python dedup.py --collapse   # 将重复文件替换为硬链接（保留路径排序最前的一份）")
+        return
+
+    print(f"正在索引 {MUSIC_DIR} ...")
+    index = ContentIndex()
+    try:
+        index.refresh()
+        report_duplicates(index, collapse='--collapse' in sys.argv)
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    main()
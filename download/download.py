@@ -9,8 +9,28 @@ import subprocess
 import sys
 import os
 import re
-import glob
-from typing import List, Optional
+import json
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from dedup import ContentIndex
+
+MAX_WORKERS = 3          # 同时进行的下载数
+MAX_RETRIES = 3          # 每个URL最多尝试次数
+RETRY_BACKOFF = 5        # 首次重试等待秒数，之后翻倍
+JOB_TIMEOUT = 30 * 60    # 单个下载超时（秒）
+JOURNAL_FILE = 'download_journal.json'
+
+journal_lock = threading.Lock()  # 任务日志的修改与写入都需持有
+dedup_lock = threading.Lock()  # 查重与移动需串行，避免两个任务同时存入同一首歌
+process_lock = threading.Lock()
+active_processes = set()       # 正在运行的 bv2mp3 子进程，中断时统一终止
+downloads_cancelled = threading.Event()
 
 def check_command_exists(command: str) -> bool:
     """检查命令是否存在"""
@@ -276,93 +296,285 @@ def confirm_download() -> bool:
         else:
             print("请输入 Y 或 n")
 
-def move_files_to_target_directory(target_directory: str) -> bool:
-    """将下载的文件移动到目标目录（歌曲文件夹化结构）"""
-    if target_directory == "download":
-        return True
+def move_files_to_target_directory(target_directory: str, source_directory: str = '.',
+                                   content_index: Optional[ContentIndex] = None) -> List[str]:
+    """将下载的文件从 source_directory 移动到目标目录（歌曲文件夹化结构）
 
-    print(f"\n正在移动文件到目标目录: {target_directory}")
+    提供 content_index 时先按内容查重：同一歌单已有的歌曲直接跳过，
+    其他歌单已有的歌曲以硬链接加入，不再保存第二份。
+    返回目标目录中对应的文件路径列表；出错时抛出 OSError。
+    """
+    audio_extensions = ['.mp3', '.m4a', '.aac', '.wav', '.flac']
+    moved_files = []
 
     if not os.path.exists(target_directory):
-        try:
-            os.makedirs(target_directory, exist_ok=True)
-        except Exception as e:
-            print(f"❌ 创建目标目录失败: {e}")
-            return False
+        os.makedirs(target_directory, exist_ok=True)
 
-    audio_extensions = ['.mp3', '.m4a', '.aac', '.wav', '.flac']
-    moved_files = []
+    for root, _, files in os.walk(source_directory):
+        for file in sorted(files):
+            if not any(file.lower().endswith(ext) for ext in audio_extensions):
+                continue
+            base_name = os.path.splitext(file)[0]
+            # 保存到 download 目录时保持平铺，歌单目录则每首歌一个文件夹
+            song_dir = target_directory if target_directory == '.' else os.path.join(target_directory, base_name)
+            source_path = os.path.join(root, file)
 
-    try:
-        for file in os.listdir('.'):
-            if any(file.lower().endswith(ext) for ext in audio_extensions):
-                base_name = os.path.splitext(file)[0]
-                song_dir = os.path.join(target_directory, base_name)
-                os.makedirs(song_dir, exist_ok=True)
+            with dedup_lock:
+                existing = None
+                if content_index and content_index.relpath(target_directory) is not None:
+                    existing = content_index.find_duplicate(source_path)
+                if existing and os.path.commonpath(
+                        [os.path.abspath(existing), os.path.abspath(target_directory)]) == os.path.abspath(target_directory):
+                    print(f"⏭  已在歌单中，跳过: {file} = {os.path.relpath(existing)}")
+                    os.remove(source_path)
+                    moved_files.append(existing)
+                    continue
 
-                source_path = file
+                os.makedirs(song_dir, exist_ok=True)
                 target_path = os.path.join(song_dir, file)
-
                 counter = 1
                 while os.path.exists(target_path):
                     new_name = f"{base_name}_{counter}{os.path.splitext(file)[1]}"
                     target_path = os.path.join(song_dir, new_name)
                     counter += 1
 
-                os.rename(source_path, target_path)
-                moved_files.append(os.path.basename(target_path))
-                print(f"✅ 已移动: {file} → {os.path.relpath(target_path)}")
+                linked = False
+                if existing:
+                    try:
+                        os.link(existing, target_path)
+                        os.remove(source_path)
+                        linked = True
+                        print(f"🔗 与已有歌曲相同，已硬链接: {os.path.relpath(existing)} → {os.path.relpath(target_path)}")
+                    except OSError:
+                        pass  # 跨文件系统等情况下保留独立副本
+                if not linked:
+                    shutil.move(source_path, target_path)
+                if content_index:
+                    content_index.add(target_path)
+                moved_files.append(target_path)
 
-        if moved_files:
-            print(f"\n✅ 文件移动完成！共移动 {len(moved_files)} 个文件到: {target_directory}")
-        else:
-            print("⚠️  未找到音频文件需要移动")
+    return moved_files
 
-        return True
+def load_journal() -> Optional[Dict]:
+    """读取上次未完成批次的任务日志"""
+    if not os.path.exists(JOURNAL_FILE):
+        return None
+    try:
+        with open(JOURNAL_FILE, 'r', encoding='utf-8') as f:
+            journal = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️  无法读取任务日志 {JOURNAL_FILE}: {e}")
+        return None
+    if all(job['status'] == 'done' for job in journal.get('jobs', [])):
+        return None
+    return journal
 
-    except Exception as e:
-        print(f"❌ 移动文件时出现错误: {e}")
-        return False
+def save_journal(journal: Dict):
+    """原子写入任务日志，中断后可据此继续"""
+    with journal_lock:
+        write_journal(journal)
 
-def execute_download(urls: List[str], save_directory: str):
-    """执行下载"""
-    print("开始下载...")
-    
-    # 构建命令字符串，使用shell执行
-    # 始终先下载到当前目录
-    command_parts = ['npx', 'bv2mp3']
-    for url in urls:
-        command_parts.append(f'--url="{url}"')
-    
-    command_str = ' '.join(command_parts)
-    print(f"执行命令: {command_str}")
-    
+def update_job(journal: Dict, job: Dict, **fields):
+    """在 journal_lock 内修改任务并写入日志，保证写出的是一致的快照"""
+    with journal_lock:
+        job.update(fields)
+        write_journal(journal)
+
+def write_journal(journal: Dict):
+    # 调用方须持有 journal_lock
+    tmp_path = JOURNAL_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(journal, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, JOURNAL_FILE)
+
+def new_journal(urls: List[str], save_directory: str) -> Dict:
+    """为一批URL创建任务日志"""
+    jobs = [{
+        'url': url,
+        'status': 'pending',
+        'attempts': 0,
+        'elapsed': None,
+        'files': [],
+        'error': None,
+        'temp_dir': None,
+    } for url in urls]
+    return {'target': save_directory, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'jobs': jobs}
+
+DOWNLOAD_ERRORS = (OSError, RuntimeError, subprocess.TimeoutExpired)
+
+def download_once(url: str, target_directory: str, npx: str, temp_dir: str,
+                  content_index: Optional[ContentIndex] = None) -> List[str]:
+    """在 temp_dir 中下载一个URL并移入目标目录（不交互，供脚本和服务器共用）
+
+    返回目标目录中的文件路径；失败时抛出 DOWNLOAD_ERRORS 中的异常。
+    """
+    process = subprocess.Popen([npx, 'bv2mp3', f"--url={url}"],
+                               cwd=temp_dir,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               text=True,
+                               errors='replace')
+    with process_lock:
+        active_processes.add(process)
+        if downloads_cancelled.is_set():  # 在 terminate_downloads 取快照之后才启动
+            process.terminate()
     try:
-        # 使用shell执行命令，这样引号会被正确解析
-        result = subprocess.run(command_str, 
-                              shell=True,
-                              check=True, 
-                              capture_output=False,
-                              text=True)
-        
-        print("\n✅ 下载完成！")
-        
-        # 如果需要移动到其他目录
-        if save_directory != "download":
-            if not move_files_to_target_directory(save_directory):
-                print("⚠️  文件移动失败，文件保留在当前目录")
-                return False
-        else:
-            print("音频文件已保存到当前目录。")
-        
-    except subprocess.CalledProcessError as e:
-        print(f"❌ 下载过程中出现错误: {e}")
+        stdout, stderr = process.communicate(timeout=JOB_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    finally:
+        with process_lock:
+            active_processes.discard(process)
+    if process.returncode != 0:
+        output = (stderr or stdout).strip().splitlines()
+        raise RuntimeError(f"bv2mp3 退出码 {process.returncode}: {output[-1] if output else ''}")
+    files = move_files_to_target_directory(target_directory, temp_dir, content_index)
+    if not files:
+        raise RuntimeError("未生成音频文件")
+    return files
+
+def terminate_downloads(grace: float = 5):
+    """终止所有仍在运行的 bv2mp3 子进程，并让下载线程不再重试（用户中断时调用）"""
+    with process_lock:
+        downloads_cancelled.set()
+        processes = list(active_processes)
+    for process in processes:
+        process.terminate()
+    deadline = time.time() + grace
+    for process in processes:
+        try:
+            process.wait(max(0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def run_download_job(job: Dict, journal: Dict, npx: str, index: int, total: int,
+                     content_index: Optional[ContentIndex] = None):
+    """在独立临时目录中下载单个URL，失败时按指数退避重试"""
+    target = '.' if journal['target'] == 'download' else journal['target']
+    started = time.time()
+    update_job(journal, job, status='running')
+
+    while job['attempts'] < MAX_RETRIES and not downloads_cancelled.is_set():
+        temp_dir = tempfile.mkdtemp(prefix='bv2mp3-', dir='.')
+        update_job(journal, job, attempts=job['attempts'] + 1, temp_dir=temp_dir)
+        print(f"[{index}/{total}] ⏳ 开始下载（第 {job['attempts']} 次）: {job['url']}")
+        result = {}
+        try:
+            files = download_once(job['url'], target, npx, temp_dir, content_index)
+            result = {'status': 'done', 'files': files, 'error': None}
+        except DOWNLOAD_ERRORS as e:
+            result = {'error': str(e)}
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            update_job(journal, job, temp_dir=None, elapsed=round(time.time() - started, 1), **result)
+
+        if job['status'] == 'done':
+            names = ', '.join(os.path.basename(f) for f in job['files'])
+            print(f"[{index}/{total}] ✅ 完成（{job['elapsed']}s）: {names}")
+            return
+        if job['attempts'] < MAX_RETRIES and not downloads_cancelled.is_set():
+            delay = RETRY_BACKOFF * 2 ** (job['attempts'] - 1)
+            print(f"[{index}/{total}] ⚠️  失败: {job['error']}，{delay} 秒后重试")
+            if downloads_cancelled.wait(delay):
+                break
+
+    if downloads_cancelled.is_set():
+        return  # 保持未完成状态，下次运行时重新开始
+    update_job(journal, job, status='failed')
+    print(f"[{index}/{total}] ❌ 放弃（已尝试 {job['attempts']} 次）: {job['url']}")
+
+def print_summary(journal: Dict):
+    """打印每个任务的状态与耗时"""
+    jobs = journal['jobs']
+    done = [job for job in jobs if job['status'] == 'done']
+    print(f"\n=== 下载结果：成功 {len(done)} / {len(jobs)} ===")
+    for i, job in enumerate(jobs, 1):
+        icon = {'done': '✅', 'failed': '❌'}.get(job['status'], '⏸')
+        elapsed = f"{job['elapsed']}s" if job['elapsed'] is not None else '-'
+        print(f"  {i}. {icon} {job['url']}  耗时 {elapsed}，尝试 {job['attempts']} 次")
+        if job['status'] != 'done' and job['error']:
+            print(f"       原因: {job['error']}")
+
+def open_content_index(target_directory: str) -> Optional[ContentIndex]:
+    """为保存到歌单的批次建立内容索引，用于跳过或硬链接重复歌曲"""
+    if target_directory == 'download':
+        return None
+    print("正在建立音乐库内容索引（用于查重）...")
+    try:
+        content_index = ContentIndex()
+        content_index.refresh()
+        return content_index
+    except (OSError, sqlite3.Error) as e:
+        print(f"⚠️  内容索引不可用，将不做查重: {e}")
+        return None
+
+def execute_download(journal: Dict, workers: int = MAX_WORKERS, dedup: bool = True) -> bool:
+    """按任务日志执行下载：有界并发，每个URL独立子进程"""
+    npx = shutil.which('npx')
+    if not npx:
+        print("❌ 未找到 npx，请先安装 Node.js")
         return False
+    content_index = open_content_index(journal['target']) if dedup else None
+
+    jobs = journal['jobs']
+    for job in jobs:
+        # 上次中断时正在进行或失败的任务重新开始
+        if job['status'] != 'done':
+            if job.get('temp_dir'):
+                shutil.rmtree(job['temp_dir'], ignore_errors=True)
+            job.update(status='pending', attempts=0, error=None, temp_dir=None)
+    save_journal(journal)
+
+    pending = [(i, job) for i, job in enumerate(jobs, 1) if job['status'] == 'pending']
+    print(f"开始下载 {len(pending)} 个任务（并发 {workers}，失败重试 {MAX_RETRIES - 1} 次）...")
+    print(f"保存位置: {journal['target']}")
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(run_download_job, job, journal, npx, i, len(jobs), content_index)
+                   for i, job in pending]
+        for future in as_completed(futures):
+            future.result()
     except KeyboardInterrupt:
-        print("\n\n用户中断下载")
+        print("\n\n用户中断下载，已完成的任务已记录，重新运行脚本可继续")
+        executor.shutdown(wait=False, cancel_futures=True)
+        terminate_downloads()
         return False
-    
-    return True
+    executor.shutdown()
+
+    print_summary(journal)
+    if all(job['status'] == 'done' for job in jobs):
+        os.remove(JOURNAL_FILE)
+        return True
+    print(f"\n未完成的任务已保存在 {JOURNAL_FILE}，重新运行脚本可继续")
+    return False
+
+def resume_previous_batch() -> Optional[Dict]:
+    """询问是否继续上次中断的批次"""
+    journal = load_journal()
+    if not journal:
+        return None
+    jobs = journal['jobs']
+    done = sum(1 for job in jobs if job['status'] == 'done')
+    print(f"\n检测到未完成的下载批次（{journal.get('created', '')}，已完成 {done}/{len(jobs)}，保存到 {journal['target']}）")
+    while True:
+        choice = input("是否继续该批次？(Y/n): ").strip().lower()
+        if choice in ['y', 'yes', '']:
+            return journal
+        elif choice in ['n', 'no']:
+            os.remove(JOURNAL_FILE)
+            return None
+        else:
+            print("请输入 Y 或 n")
+
+def get_option_value(names: List[str], default: int) -> int:
+    """读取形如 --jobs 4 的整数参数"""
+    for i, arg in enumerate(sys.argv):
+        if arg in names and i + 1 < len(sys.argv) and sys.argv[i + 1].isdigit():
+            return max(1, int(sys.argv[i + 1]))
+    return default
 
 def main():
     """主函数"""
@@ -378,10 +590,14 @@ def main():
             print("  python download.py                 # 正常模式（检查环境）")
             print("  python download.py --skip-check   # 跳过环境检查模式")
             print("  python download.py --debug        # 调试模式")
+            print("  python download.py --jobs 4       # 同时下载 4 个")
+            print("  python download.py --no-dedup     # 不检查重复歌曲")
             print("  python download.py --help         # 显示帮助")
             print("\n参数说明:")
             print("  -s, --skip-check    跳过环境检查，直接开始下载")
             print("  -d, --debug        启用调试模式，显示详细检测信息")
+            print(f"  -j, --jobs N       同时下载的数量（默认 {MAX_WORKERS}）")
+            print("  --no-dedup         不按内容查重（默认跳过或硬链接库中已有的歌曲）")
             print("  -h, --help         显示此帮助信息")
             return
         
@@ -414,6 +630,15 @@ def main():
             print("注意: 如果环境不完整，下载可能会失败")
             print()
         
+        workers = get_option_value(['--jobs', '-j'], MAX_WORKERS)
+        dedup = '--no-dedup' not in sys.argv
+
+        # 继续上次中断的批次
+        journal = resume_previous_batch()
+        if journal:
+            execute_download(journal, workers, dedup)
+            return
+
         # 收集URL
         urls = collect_urls()
         
@@ -429,7 +654,9 @@ def main():
             sys.exit(0)
         
         # 执行下载
-        execute_download(urls, save_directory)
+        journal = new_journal(urls, save_directory)
+        save_journal(journal)
+        execute_download(journal, workers, dedup)
         
     except KeyboardInterrupt:
         print("\n\n程序被用户中断")
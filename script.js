@@ -12,6 +12,7 @@ document.addEventListener("DOMContentLoaded", () => {
     let allSongs = [];
     let playbackMode = "sequential";
     let currentIndex = 0;
+    let currentSong = null;
     let currentPage = 1;
     const songsPerPage = 10;
     let lyricsData = [];
@@ -23,7 +24,8 @@ document.addEventListener("DOMContentLoaded", () => {
     let selectedPlaylists = [];
     let allFolders = [];
 
-    const songsCache = new Map();
+    const songsCache = new Map();    // folder -> complete song list
+    const songsLoading = new Map();  // folder -> list still receiving pages
     const lyricsCache = new Map();
 
     function updateDropdownText() {
@@ -55,27 +57,67 @@ document.addEventListener("DOMContentLoaded", () => {
         }
 
         updateDropdownText();
+        currentIndex = songs.indexOf(currentSong);
         currentPage = 1;
         renderSongList();
         renderPagination();
         clearLyrics();
+    }
+
+    // /api/playlist returns songs with their parsed lyrics one page at a time.
+    // The first page is awaited so it renders immediately; the rest of the
+    // folder streams in behind it. Only complete lists are cached, so a folder
+    // whose later pages failed is fetched again the next time it is selected.
+    async function fetchPlaylistPage(folder, cursor, limit, list) {
+        const params = new URLSearchParams({ folder, limit, lyrics: "1", format: "parsed" });
+        if (cursor) params.set("cursor", cursor);
+        const response = await fetch(`/api/playlist?${params}`);
+        const data = await response.json();
+        if (data.error) throw new Error(data.error);
+        data.songs.forEach(song => {
+            if (song.lyrics) {
+                lyricsCache.set(`${folder}/${song.name}`, song.lyrics);
+                delete song.lyrics;
+            }
+            list.push(song);
+        });
+        return data.next_cursor;
+    }
 
-        if (songs.length > 0) {
-            setTimeout(() => preloadLyrics(songs, selectedPlaylists[0]), 100);
+    async function loadRemainingPages(folder, cursor, list) {
+        try {
+            while (cursor) {
+                cursor = await fetchPlaylistPage(folder, cursor, songsPerPage * 10, list);
+                if (selectedPlaylists.includes(folder)) refreshLoadedSongs();
+            }
+            songsCache.set(folder, list);
+        } catch (error) {
+            console.error(`Failed to load playlist ${folder}:`, error);
+        } finally {
+            songsLoading.delete(folder);
         }
     }
 
+    function refreshLoadedSongs() {
+        allSongs = selectedPlaylists.flatMap(folder =>
+            songsCache.get(folder) || songsLoading.get(folder) || []);
+        songs = allSongs;
+        // -1 while the playing song is not in the list; "next" then starts from the top
+        currentIndex = songs.indexOf(currentSong);
+        renderSongList();
+        renderPagination();
+    }
+
     async function loadSongsForPlaylist(folder) {
         if (songsCache.has(folder)) return songsCache.get(folder);
+        if (songsLoading.has(folder)) return songsLoading.get(folder);
 
+        const list = [];
         try {
-            const response = await fetch(`/api/songs?folder=${encodeURIComponent(folder)}`);
-            const data = await response.json();
-            if (!data.error && Array.isArray(data)) {
-                songsCache.set(folder, data);
-                return data;
-            }
-            return [];
+            const cursor = await fetchPlaylistPage(folder, null, songsPerPage, list);
+            songsLoading.set(folder, list);
+            loadRemainingPages(folder, cursor, list);
+            return list;
         } catch (error) {
             console.error(`Failed to load playlist ${folder}:`, error);
             return [];
@@ -200,6 +242,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
         currentIndex = index;
         const song = songs[index];
+        currentSong = song;
         const displayName = song.name;
         const folder = song.folder;
         const audioUrl = `music/${encodeURIComponent(folder)}/${encodeURIComponent(displayName)}/${encodeURIComponent(song.file)}`;
@@ -260,52 +303,15 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     });
 
-    // ---- Lyrics parsing ----
-
-    function parseLyrics(lyricsText) {
-        const lines = lyricsText.split("\n");
-        const lyrics = [];
-
-        for (let line of lines) {
-            line = line.trim();
-            if (!line) continue;
-
-            const timeRegex = /\[(\d{2}):(\d{2})(?:[.:](\d{2,3}))?\]/g;
-            const matches = [...line.matchAll(timeRegex)];
-
-            if (matches.length > 0) {
-                const text = line.replace(timeRegex, "").trim();
-                if (text) {
-                    for (let match of matches) {
-                        const minutes = parseInt(match[1]);
-                        const seconds = parseInt(match[2]);
-                        const fracRaw = match[3];
-                        let fractionSeconds = 0;
-                        if (typeof fracRaw !== "undefined") {
-                            const frac = parseInt(fracRaw);
-                            fractionSeconds = fracRaw.length === 3 ? frac / 1000 : frac / 100;
-                        }
-                        const time = minutes * 60 + seconds + fractionSeconds;
-                        lyrics.push({ time, text, originalText: text });
-                    }
-                }
-            }
-        }
-
-        lyrics.sort((a, b) => a.time - b.time);
+    // ---- Lyrics ----
 
-        const processed = [];
-        for (let i = 0; i < lyrics.length; i++) {
-            const current = lyrics[i];
-            const next = lyrics[i + 1];
-            if (next && Math.abs(current.time - next.time) < 0.1) {
-                processed.push({ time: current.time, text: current.text, translation: next.text });
-                i++;
-            } else {
-                processed.push({ time: current.time, text: current.text, translation: null });
-            }
-        }
-        return processed;
+    // The server parses .lrc files (format=parsed) into parallel, time-sorted arrays
+    function lyricsFromParsed(data) {
+        return data.times.map((time, i) => ({
+            time,
+            text: data.texts[i],
+            translation: data.translations[i]
+        }));
     }
 
     function findCurrentLyricIndex(currentTime) {
@@ -432,7 +438,7 @@ document.addEventListener("DOMContentLoaded", () => {
         if (lyricsCache.has(cacheKey)) {
             const cached = lyricsCache.get(cacheKey);
             if (cached.success) {
-                lyricsData = parseLyrics(cached.lyrics);
+                lyricsData = lyricsFromParsed(cached);
                 displayLyrics();
             } else {
                 clearLyrics();
@@ -440,12 +446,12 @@ document.addEventListener("DOMContentLoaded", () => {
             return;
         }
 
-        fetch(`/api/lyrics?folder=${encodeURIComponent(folder)}&song=${encodeURIComponent(songName)}`)
+        fetch(`/api/lyrics?folder=${encodeURIComponent(folder)}&song=${encodeURIComponent(songName)}&format=parsed`)
             .then(res => res.json())
             .then(data => {
                 lyricsCache.set(cacheKey, data);
                 if (data.success) {
-                    lyricsData = parseLyrics(data.lyrics);
+                    lyricsData = lyricsFromParsed(data);
                     displayLyrics();
                 } else {
                     clearLyrics();
@@ -457,23 +463,6 @@ document.addEventListener("DOMContentLoaded", () => {
             });
     }
 
-    function preloadLyrics(songsToPreload, folder) {
-        if (songsToPreload.length === 0) return;
-        const songNames = songsToPreload.map(s => s.name);
-        const songsParam = encodeURIComponent(JSON.stringify(songNames));
-
-        fetch(`/api/batch-lyrics?folder=${encodeURIComponent(folder)}&songs=${songsParam}`)
-            .then(res => res.json())
-            .then(data => {
-                if (data.success) {
-                    Object.entries(data.results).forEach(([name, result]) => {
-                        lyricsCache.set(`${folder}/${name}`, result);
-                    });
-                }
-            })
-            .catch(error => console.error("Failed to preload lyrics:", error));
-    }
-
     // ---- Audio events ----
 
     audioPlayer.addEventListener("timeupdate", () => updateCurrentLyric(audioPlayer.currentTime));
@@ -2,234 +2,4099 @@
 """Music player server - single-file Flask application. Run with: python server.py"""
 
 import argparse
-import glob
+import base64
+import binascii
+import cProfile
+import gzip
+import hashlib
+import hmac
 import json
 import mimetypes
 import os
+import pstats
+import queue
+import random
 import re
+import sqlite3
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import unicodedata
+import wave
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ContextDecorator, closing
+from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
 
-from flask import Flask, Response, jsonify, request, send_file
+from flask import Flask, Response, g, has_request_context, jsonify, request, send_file
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
 
-app = Flask(__name__, static_url_path="", static_folder=".")
+# No static folder: only the whitelisted STATIC_ASSETS are served, so cache/
+# (snapshots, profiles, the download queue) and the sources are never exposed
+app = Flask(__name__, static_folder=None)
 
 MUSIC_DIR = "music"
 AUDIO_EXTENSIONS = {".mp3", ".m4a", ".aac", ".wav", ".ogg", ".flac"}
 CACHE_TTL = 300
+CACHE_DIR = "cache"
+CATALOG_DB = "catalog.sqlite3"
+CATALOG_CHECK_INTERVAL = 2
+CATALOG_FULL_CHECK_INTERVAL = 60
+LYRICS_CACHE_ENTRIES = 2000
+LYRICS_CACHE_BYTES = 32 * 1024 * 1024
+
+
+# --- Result cache ---
+#
+# Lyrics results go through a pluggable backend with get(key) / set(key, value,
+# size) / pop(key) / clear() / stats() / generation(). Shared backends also keep
+# the lyrics index, outside the result accounting, via load_index() /
+# replace_index(paths, built) / patch_index(changes).
+# LRUCache (default) is private to each process and shares nothing; SQLiteCache
+# and RedisCache are shared by every worker, so results are computed once and
+# clear() reaches all of them. clear() also bumps generation(), which workers
+# poll (check_cache_generation) to drop the process-local state derived from it.
+
+CACHE_TOUCH_INTERVAL = 30   # seconds between recency updates of a shared entry
+RESULT_CACHE_DB = "results.sqlite3"
+REDIS_KEY_PREFIX = "music_player:lyrics:"
+REDIS_GENERATION_KEY = "music_player:generation"
+REDIS_INDEX_KEY = "music_player:lyrics_index"              # hash: song key -> .lrc path
+REDIS_INDEX_BUILT_KEY = "music_player:lyrics_index_built"
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count and accounted bytes, with TTL expiry.
+
+    Callers pass the size of each value to ``set``; expired entries are dropped on
+    access and swept periodically so they stop holding memory.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.bytes = 0
+        self.last_sweep = time.time()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, size):
+        with self.lock:
+            now = time.time()
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (now + self.ttl, size, value)
+            self.bytes += size
+            if now - self.last_sweep > self.ttl / 4:
+                self._sweep(now)
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": "memory",
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _remove(self, key):
+        _, size, value = self.entries.pop(key)
+        self.bytes -= size
+        return value
+
+    def _sweep(self, now):
+        expired = [k for k, (expires, _, _) in self.entries.items() if expires <= now]
+        for key in expired:
+            self._remove(key)
+        self.expirations += len(expired)
+        self.last_sweep = now
+
+    def generation(self):
+        return 0  # nothing outside this process to hear from
+
+    def load_index(self):
+        return None  # the process-local lyrics index is the only copy
+
+    def replace_index(self, paths, built):
+        pass
+
+    def patch_index(self, changes):
+        pass
+
+
+class SQLiteCache:
+    """LRUCache counterpart in one SQLite file, shared by every process on the host.
+
+    Values are stored as JSON. Recency is refreshed at most once per
+    CACHE_TOUCH_INTERVAL per entry so hits stay read-only; hit/miss counters are
+    per process, entry and byte totals are shared.
+    """
+
+    def __init__(self, path, max_entries, max_bytes, ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.local = threading.local()  # per-thread connection, reopened after fork
+        self.lock = threading.Lock()
+        self.last_sweep = time.time()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, "
+                       "size INTEGER, expires REAL, used REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            db.execute("CREATE TABLE IF NOT EXISTS lyrics_index (key TEXT PRIMARY KEY, path TEXT)")
+
+    def __len__(self):
+        return self.connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def connect(self):
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db, self.local.pid = db, os.getpid()
+        return db
+
+    def get(self, key):
+        db = self.connect()
+        now = time.time()
+        row = db.execute("SELECT value, expires, used FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[1] <= now:
+            with db:
+                db.execute("DELETE FROM entries WHERE key = ? AND expires <= ?", (key, now))
+            with self.lock:
+                self.expirations += 1
+            row = None
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        if now - row[2] > CACHE_TOUCH_INTERVAL:
+            with db:
+                db.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+        with self.lock:
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            self.pop(key)
+            return
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        db = self.connect()
+        now = time.time()
+        evicted = expired = 0
+        with db:
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                       (key, data, size, now + self.ttl, now))
+            if now - self.last_sweep > self.ttl / 4:
+                expired = db.execute("DELETE FROM entries WHERE expires <= ?", (now,)).rowcount
+                self.last_sweep = now
+            count, total = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            while count > self.max_entries or total > self.max_bytes:
+                oldest, oldest_size = db.execute(
+                    "SELECT key, size FROM entries ORDER BY used LIMIT 1").fetchone()
+                db.execute("DELETE FROM entries WHERE key = ?", (oldest,))
+                count -= 1
+                total -= oldest_size
+                evicted += 1
+        with self.lock:
+            self.evictions += evicted
+            self.expirations += expired
+
+    def pop(self, key, default=None):
+        db = self.connect()
+        with db:
+            row = db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        return json.loads(row[0])
+
+    def clear(self):
+        with self.connect() as db:
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM lyrics_index")
+            db.execute("DELETE FROM meta WHERE name = 'index_built'")
+            db.execute("INSERT INTO meta VALUES ('generation', 1) "
+                       "ON CONFLICT (name) DO UPDATE SET value = value + 1")
+
+    def generation(self):
+        row = self.connect().execute(
+            "SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def load_index(self):
+        db = self.connect()
+        with db:  # one read transaction, so rows and build time match
+            row = db.execute("SELECT value FROM meta WHERE name = 'index_built'").fetchone()
+            if row is None:
+                return None
+            return dict(db.execute("SELECT key, path FROM lyrics_index")), row[0]
+
+    def replace_index(self, paths, built):
+        with self.connect() as db:
+            db.execute("DELETE FROM lyrics_index")
+            db.executemany("INSERT INTO lyrics_index VALUES (?, ?)", paths.items())
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('index_built', ?)", (built,))
+
+    def patch_index(self, changes):
+        """Apply {song key: .lrc path, or None to remove} to the shared index."""
+        with self.connect() as db:
+            db.executemany("INSERT OR REPLACE INTO lyrics_index VALUES (?, ?)",
+                           [(k, v) for k, v in changes.items() if v is not None])
+            db.executemany("DELETE FROM lyrics_index WHERE key = ?",
+                           [(k,) for k, v in changes.items() if v is None])
+
+    def stats(self):
+        count, total = self.connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        with self.lock:
+            return {
+                "backend": "sqlite",
+                "entries": count,
+                "bytes": total,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class RedisCache:
+    """Cache on a Redis-protocol server (Redis, Valkey, KeyDB...), shared across hosts.
+
+    Expiry uses server-side TTLs and capacity is left to the server's maxmemory
+    policy, so entry and byte totals are not reported. Server errors count as
+    misses. Pass ``client`` to use an existing client, e.g. fakeredis in tests.
+    """
+
+    def __init__(self, url, max_entries, max_bytes, ttl, client=None):
+        try:
+            import redis
+        except ImportError:
+            sys.exit("--cache-backend redis:// requires redis: pip install redis")
+        self.client = client if client is not None else redis.Redis.from_url(url)
+        self.errors = (redis.RedisError, OSError)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.errors_seen = 0
+
+    def __len__(self):
+        return 0  # unknown; see stats()
+
+    def get(self, key):
+        try:
+            data = self.client.get(REDIS_KEY_PREFIX + key)
+        except self.errors:
+            data = None
+            with self.lock:
+                self.errors_seen += 1
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(data)
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            self.pop(key)
+            return
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        try:
+            self.client.set(REDIS_KEY_PREFIX + key, data, px=int(self.ttl * 1000))
+        except self.errors:
+            with self.lock:
+                self.errors_seen += 1
+
+    def pop(self, key, default=None):
+        pipe = self.client.pipeline()
+        pipe.get(REDIS_KEY_PREFIX + key)
+        pipe.delete(REDIS_KEY_PREFIX + key)
+        try:
+            data, _ = pipe.execute()
+        except self.errors:
+            with self.lock:
+                self.errors_seen += 1
+            return default
+        return default if data is None else json.loads(data)
+
+    def clear(self):
+        try:
+            batch = [REDIS_INDEX_KEY, REDIS_INDEX_BUILT_KEY]
+            for key in self.client.scan_iter(match=REDIS_KEY_PREFIX + "*", count=1000):
+                batch.append(key)
+                if len(batch) >= 1000:
+                    self.client.delete(*batch)
+                    batch = []
+            if batch:
+                self.client.delete(*batch)
+            self.client.incr(REDIS_GENERATION_KEY)
+        except self.errors:
+            with self.lock:
+                self.errors_seen += 1
+
+    def generation(self):
+        try:
+            return int(self.client.get(REDIS_GENERATION_KEY) or 0)
+        except self.errors:
+            return None
+
+    def load_index(self):
+        pipe = self.client.pipeline()
+        pipe.get(REDIS_INDEX_BUILT_KEY)
+        pipe.hgetall(REDIS_INDEX_KEY)
+        try:
+            built, paths = pipe.execute()
+        except self.errors:
+            with self.lock:
+                self.errors_seen += 1
+            return None
+        if built is None:
+            return None
+        return {k.decode("utf-8"): v.decode("utf-8") for k, v in paths.items()}, float(built)
+
+    def replace_index(self, paths, built):
+        pipe = self.client.pipeline()
+        pipe.delete(REDIS_INDEX_KEY)
+        if paths:
+            pipe.hset(REDIS_INDEX_KEY, mapping=paths)
+        pipe.set(REDIS_INDEX_BUILT_KEY, built)
+        self._execute(pipe)
+
+    def patch_index(self, changes):
+        """Apply {song key: .lrc path, or None to remove} to the shared index."""
+        pipe = self.client.pipeline()
+        for key, path in changes.items():
+            if path is None:
+                pipe.hdel(REDIS_INDEX_KEY, key)
+            else:
+                pipe.hset(REDIS_INDEX_KEY, key, path)
+        self._execute(pipe)
+
+    def _execute(self, pipe):
+        try:
+            pipe.execute()
+        except self.errors:
+            with self.lock:
+                self.errors_seen += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": "redis",
+                "entries": None,
+                "bytes": None,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": 0,
+                "expirations": 0,
+                "errors": self.errors_seen,
+            }
+
+
+def make_cache_backend(spec, max_entries, max_bytes, ttl):
+    """Cache backend for --cache-backend: memory, sqlite or a redis:// URL."""
+    if spec == "memory":
+        return LRUCache(max_entries, max_bytes, ttl)
+    if spec == "sqlite":
+        return SQLiteCache(os.path.join(CACHE_DIR, RESULT_CACHE_DB), max_entries, max_bytes, ttl)
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(spec, max_entries, max_bytes, ttl)
+    raise ValueError(f"Unknown cache backend: {spec}")
+
 
 lyrics_index_cache = None
 lyrics_index_timestamp = 0
-lyrics_result_cache = {}
+lyrics_result_cache = LRUCache(LYRICS_CACHE_ENTRIES, LYRICS_CACHE_BYTES, CACHE_TTL)
+
+
+# --- Metrics ---
+#
+# Process-local counters and histograms rendered in Prometheus text format at
+# /metrics. Each update is a dict operation under one lock, cheap enough to
+# leave on in production. Under gunicorn every worker reports its own values
+# (scrape with a pid label or aggregate in the query).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PREFIX = "music_player_"
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.gauges = {}      # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def render(self, extra=()):
+        """Prometheus text exposition; ``extra`` adds (name, kind, labels, value) samples."""
+        with self.lock:
+            samples = [(n, "counter", l, v) for (n, l), v in self.counters.items()]
+            samples += [(n, "gauge", l, v) for (n, l), v in self.gauges.items()]
+            histograms = [(n, l, list(h)) for (n, l), h in self.histograms.items()]
+        samples += [(n, kind, tuple(sorted(labels.items())), v) for n, kind, labels, v in extra]
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                text = self.help.get(name, (kind, name))[1]
+                lines.append(f"# HELP {METRICS_PREFIX}{name} {text}")
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+
+        for name, kind, labels, value in sorted(samples, key=lambda s: (s[0], s[2])):
+            header(name, kind)
+            lines.append(f"{METRICS_PREFIX}{name}{format_labels(labels)} {value}")
+        for name, labels, hist in sorted(histograms, key=lambda h: (h[0], h[1])):
+            header(name, "histogram")
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), hist[:-2] + [hist[-1]]):
+                le = labels + (("le", str(bound)),)
+                lines.append(f"{METRICS_PREFIX}{name}_bucket{format_labels(le)} {count}")
+            lines.append(f"{METRICS_PREFIX}{name}_sum{format_labels(labels)} {hist[-2]}")
+            lines.append(f"{METRICS_PREFIX}{name}_count{format_labels(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels) + "}"
+
+
+metrics = Metrics()
+metrics.describe("http_requests_total", "counter", "HTTP requests by route, method and status.")
+metrics.describe("http_request_duration_seconds", "histogram",
+                 "Time to produce response headers, by route.")
+metrics.describe("index_build_seconds", "histogram", "Duration of catalog/lyrics/search index builds.")
+metrics.describe("streams_active", "gauge", "Audio responses currently being sent.")
+metrics.describe("stream_bytes_total", "counter", "Audio bytes handed to the server for sending.")
+metrics.describe("streams_rejected_total", "counter", "Audio requests refused by stream limits, by status.")
+metrics.describe("stream_throttled_seconds_total", "counter", "Time audio responses spent paced by --stream-rate-kbps.")
+metrics.describe("cache_hits_total", "counter", "Cache hits by cache.")
+metrics.describe("cache_misses_total", "counter", "Cache misses by cache.")
+metrics.describe("cache_evictions_total", "counter", "Cache evictions (capacity) by cache.")
+metrics.describe("cache_expirations_total", "counter", "Cache entries dropped by TTL, by cache.")
+metrics.describe("cache_entries", "gauge", "Entries currently held, by cache.")
+metrics.describe("cache_bytes", "gauge", "Accounted bytes currently held, by cache.")
+metrics.describe("catalog_songs", "gauge", "Songs in the library catalog.")
+metrics.describe("search_documents", "gauge", "Live documents in the search index.")
+metrics.describe("music_idle_files", "gauge", "Open audio files pooled for reuse.")
+metrics.describe("stream_clients", "gauge", "Client IPs with audio responses in flight (with stream limits on).")
+metrics.describe("readahead_prefetched_total", "counter", "Next-track prefetches done, by kind (audio/lyrics).")
+metrics.describe("readahead_used_total", "counter", "Prefetched tracks/lyrics later requested, by kind.")
+metrics.describe("readahead_wasted_total", "counter",
+                 "Prefetches dropped unrequested (budget or time window), by kind.")
+metrics.describe("readahead_dropped_total", "counter", "Read-ahead requests dropped because the queue was full.")
+metrics.describe("readahead_pending_bytes", "gauge", "Prefetched audio bytes not yet requested.")
+metrics.describe("startup_phase_seconds", "gauge", "Duration of each startup and warmup phase.")
+
+
+class timed:
+    """``with timed("catalog"):`` records an index_build_seconds sample."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        metrics.observe("index_build_seconds", time.perf_counter() - self.start, index=self.index)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get("request_start")
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - start, route=route)
+        metrics.inc("http_requests_total", route=route, method=request.method,
+                    status=str(response.status_code))
+    return response
+
+
+class CountingIterable:
+    """Counts bytes of a response body that has no known length as it is sent."""
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            metrics.inc("stream_bytes_total", len(chunk))
+            yield chunk
+
+    def close(self):
+        close = getattr(self.iterable, "close", None)
+        if close is not None:
+            close()
+
+
+def track_stream(response):
+    if response.status_code not in (200, 206):
+        return response
+    if response.content_length is not None:
+        # Keep the body untouched so file wrappers can still use sendfile
+        metrics.inc("stream_bytes_total", response.content_length)
+    else:
+        response.response = CountingIterable(response.response)
+    metrics.add_gauge("streams_active", 1)
+    on_stream_close(response, lambda: metrics.add_gauge("streams_active", -1))
+    return response
+
+
+def on_stream_close(response, func):
+    """Run ``func`` once the server is done with the response body.
+
+    Werkzeug hands direct-passthrough bodies (file wrappers) to the server as they
+    are and never runs call_on_close() callbacks for them, so for file responses
+    the callback goes on the underlying FileRange instead.
+    """
+    file_range = getattr(response, "file_range", None)
+    if file_range is not None:
+        file_range.callbacks.append(func)
+    else:
+        response.call_on_close(func)
+
+
+@app.route("/metrics")
+def api_metrics():
+    extra = []
+    for cache_name, cache in (("lyrics", lyrics_result_cache),):
+        stats = cache.stats()
+        for field in ("hits", "misses", "evictions", "expirations"):
+            extra.append((f"cache_{field}_total", "counter", {"cache": cache_name}, stats[field]))
+        if stats["entries"] is not None:  # not known for redis
+            extra.append(("cache_entries", "gauge", {"cache": cache_name}, stats["entries"]))
+            extra.append(("cache_bytes", "gauge", {"cache": cache_name}, stats["bytes"]))
+    extra.append(("cache_entries", "gauge", {"cache": "metadata"}, len(metadata_cache)))
+    with music_files_lock:
+        extra.append(("cache_entries", "gauge", {"cache": "music_files"}, len(music_files)))
+        extra.append(("music_idle_files", "gauge", {}, music_idle_files))
+        for field in ("hits", "misses", "evictions"):
+            extra.append((f"cache_{field}_total", "counter", {"cache": "music_files"},
+                          music_files_stats[field]))
+    extra.append(("cache_entries", "gauge", {"cache": "transcode"}, len(transcode_cache or ())))
+    extra.append(("cache_bytes", "gauge", {"cache": "transcode"}, transcode_cache_bytes))
+    extra.append(("search_documents", "gauge", {}, len(search_index.docs) - search_index.deleted))
+    with stream_lock:
+        extra.append(("stream_clients", "gauge", {}, len(stream_active)))
+    extra.append(("readahead_pending_bytes", "gauge", {}, readahead_pending_bytes))
+    extra += [("startup_phase_seconds", "gauge", {"phase": name}, seconds)
+              for name, seconds in startup_phases.items()]
+    extra.append(("catalog_songs", "gauge", {},
+                  sum(len(songs) for songs, _, _ in catalog.values())))
+    return Response(metrics.render(extra), mimetype="text/plain; version=0.0.4")
+
+
+# --- Profiling ---
+#
+# Opt-in and off by default. A sampled fraction of requests runs under cProfile
+# (aggregated per route into .prof files for pstats/snakeviz) or under a stack
+# sampler (aggregated into flamegraph.pl-ready .collapsed files). Independently,
+# requests slower than a threshold are logged with their phase breakdown.
+# With --profile, settings can be changed at runtime through /api/profile (per
+# process), from loopback clients only; without it the route does not exist.
+
+PROFILE_FORMATS = ("collapsed", "pstats")
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_FLUSH_INTERVAL = 5.0
+SLOW_REQUEST_MS = 1000
+LOOPBACK_ADDRS = ("127.0.0.1", "::1")
+
+profile_settings = {"rate": 0.0, "format": "collapsed", "slow_ms": SLOW_REQUEST_MS}
+profile_lock = threading.Lock()
+profile_stats = {}      # route -> pstats.Stats or Counter of collapsed stacks
+profile_samples = {}    # route -> number of profiled requests
+profile_flushed = {}    # route -> time of last write
+cprofile_lock = threading.Lock()  # cProfile cannot profile two threads at once on 3.12+
+sampled_threads = {}    # thread id -> Counter of collapsed stacks
+sampler_thread = None
+
+
+def profile_dir():
+    return os.path.join(CACHE_DIR, "profiles")
+
+
+class phase(ContextDecorator):
+    """Attribute wall time to a named phase of the current request.
+
+    Times are exclusive: a nested phase is subtracted from its parent. Outside
+    a request (background threads) this does nothing.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if has_request_context():
+            stack = g.setdefault("phase_stack", [])
+            stack.append((self.name, time.perf_counter()))
+        return self
+
+    def __exit__(self, *exc):
+        stack = g.get("phase_stack") if has_request_context() else None
+        if stack:
+            name, start = stack.pop()
+            elapsed = time.perf_counter() - start
+            phases = g.setdefault("phases", {})
+            phases[name] = phases.get(name, 0.0) + elapsed
+            if stack:
+                parent = stack[-1][0]
+                phases[parent] = phases.get(parent, 0.0) - elapsed
+        return False
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def run_sampler():
+    while True:
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+        with profile_lock:
+            if not sampled_threads:
+                continue
+            frames = sys._current_frames()
+            for thread_id, counter in sampled_threads.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                if stack:
+                    counter[";".join(reversed(stack))] += 1
+
+
+def start_profile():
+    global sampler_thread
+    if profile_settings["format"] == "pstats":
+        if not cprofile_lock.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    counter = Counter()
+    with profile_lock:
+        sampled_threads[threading.get_ident()] = counter
+        if sampler_thread is None:
+            sampler_thread = threading.Thread(target=run_sampler, name="profile-sampler", daemon=True)
+            sampler_thread.start()
+    return counter
+
+
+def finish_profile(route, sample):
+    if isinstance(sample, cProfile.Profile):
+        sample.disable()
+        cprofile_lock.release()
+        stats = pstats.Stats(sample)
+    else:
+        with profile_lock:
+            sampled_threads.pop(threading.get_ident(), None)
+        stats = sample
+    with profile_lock:
+        current = profile_stats.get(route)
+        if current is None or type(current) is not type(stats):
+            profile_stats[route] = stats
+        elif isinstance(stats, pstats.Stats):
+            current.add(stats)
+        else:
+            current.update(stats)
+        profile_samples[route] = profile_samples.get(route, 0) + 1
+        due = time.time() - profile_flushed.get(route, 0) > PROFILE_FLUSH_INTERVAL
+    if due:
+        flush_profile(route)
+
+
+def flush_profile(route):
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    with profile_lock:
+        stats = profile_stats.get(route)
+        profile_flushed[route] = time.time()
+        if stats is None:
+            return
+        try:
+            os.makedirs(profile_dir(), exist_ok=True)
+            if isinstance(stats, pstats.Stats):
+                stats.dump_stats(os.path.join(profile_dir(), f"{slug}.prof"))
+            else:
+                tmp = os.path.join(profile_dir(), f"{slug}.collapsed.tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    for stack, count in stats.items():
+                        f.write(f"{stack} {count}\n")
+                os.replace(tmp, os.path.join(profile_dir(), f"{slug}.collapsed"))
+        except OSError as e:
+            print(f"Failed to write profile for {route}: {e}")
+
+
+@app.before_request
+def maybe_start_profile():
+    rate = profile_settings["rate"]
+    if rate and random.random() < rate:
+        g.profile = start_profile()
+
+
+@app.teardown_request
+def maybe_finish_profile(exc):
+    sample = g.pop("profile", None)
+    if sample is not None:
+        finish_profile(request.url_rule.rule if request.url_rule else "unmatched", sample)
+
+
+@app.after_request
+def log_slow_request(response):
+    start = g.get("request_start")
+    slow_ms = profile_settings["slow_ms"]
+    if start is None or not slow_ms:
+        return response
+    elapsed = (time.perf_counter() - start) * 1000
+    if elapsed >= slow_ms:
+        phases = g.get("phases", {})
+        other = elapsed - sum(phases.values()) * 1000
+        breakdown = ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds
+                              in sorted(phases.items(), key=lambda item: -item[1]))
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        params = dict(request.args)
+        if request.method == "POST":
+            params["body_bytes"] = request.content_length
+        print(f"Slow request: {elapsed:.1f} ms {request.method} {request.path} "
+              f"[{route} {response.status_code}] params={json.dumps(params, ensure_ascii=False)} "
+              f"phases: {breakdown + ', ' if breakdown else ''}other {other:.1f} ms")
+    return response
+
+
+def api_profile():
+    """Show or change profiling settings: {"rate": 0.05, "format": "pstats", "slow_ms": 500}.
+
+    Registered by main() only with --profile.
+    """
+    if request.remote_addr not in LOOPBACK_ADDRS:
+        return jsonify({"error": "Profiling settings are only available from localhost"}), 403
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        try:
+            rate = float(body.get("rate", profile_settings["rate"]))
+            slow_ms = float(body.get("slow_ms", profile_settings["slow_ms"]))
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid rate or slow_ms"}), 400
+        fmt = body.get("format", profile_settings["format"])
+        if not 0 <= rate <= 1 or slow_ms < 0 or fmt not in PROFILE_FORMATS:
+            return jsonify({"error": "Invalid profile settings"}), 400
+        profile_settings.update(rate=rate, slow_ms=slow_ms, format=fmt)
+    if request.args.get("flush") or request.method == "POST":
+        for route in list(profile_stats):
+            flush_profile(route)
+    with profile_lock:
+        samples = dict(profile_samples)
+    return jsonify({"success": True, **profile_settings, "directory": profile_dir(),
+                    "samples": samples})
+
+
+# --- Conditional requests ---
+#
+# JSON endpoints carry ETags derived from catalog content or .lrc stat data, and
+# audio carries ETag/Last-Modified from the file's stat; clients revalidate with
+# If-None-Match / If-Modified-Since and get a bodiless 304 when nothing changed.
+
+def content_etag(payload):
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()[:20]
+
+
+def stat_etag(st):
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def not_modified(etag, last_modified=None):
+    response = Response(status=304)
+    return with_validators(response, etag, last_modified)
+
+
+def with_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@phase("serialize")
+def conditional_json(payload, etag):
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+    return with_validators(jsonify(payload), etag)
+
+
+# --- Library catalog ---
+#
+# playlist -> (songs, listing, etag)
+#   songs:   {song_dir_name: (dir_mtime_ns, audio_file or None, lrc_file or None)}
+#   listing: sorted /api/songs payload, rebuilt only when the playlist changes
+#   etag:    content hash of listing, stable across restarts and workers
+
+catalog_lock = threading.RLock()
+catalog = {}
+catalog_loaded = False
+catalog_checked = 0
+catalog_full_checked = 0
+catalog_dir_mtimes = {}  # playlist -> directory mtime_ns when it was last scanned
+catalog_version = 0
+
+
+def catalog_db_path():
+    return os.path.join(CACHE_DIR, CATALOG_DB)
+
+
+def scan_song_dir(song_path):
+    audio = lrc = None
+    for name in sorted(e.name for e in os.scandir(song_path) if e.is_file()):
+        ext = os.path.splitext(name)[1].lower()
+        if audio is None and ext in AUDIO_EXTENSIONS:
+            audio = name
+        elif lrc is None and ext == ".lrc":
+            lrc = name
+    return audio, lrc
+
+
+def scan_playlist(playlist_path, previous):
+    songs = {}
+    for entry in os.scandir(playlist_path):
+        if not entry.is_dir():
+            continue
+        try:
+            mtime = entry.stat().st_mtime_ns
+            old = previous.get(entry.name)
+            if old is not None and old[0] == mtime:
+                songs[entry.name] = old
+            else:
+                songs[entry.name] = (mtime,) + scan_song_dir(entry.path)
+        except FileNotFoundError:
+            continue
+    return songs
+
+
+def build_listing(playlist, songs):
+    listing = [
+        {"name": name, "folder": playlist, "file": songs[name][1]}
+        for name in sorted(songs)
+        if songs[name][1]
+    ]
+    return listing, content_etag(listing)
+
+
+def apply_catalog_playlist(playlist, songs):
+    """Swap in a playlist's new song map; returns the song names whose entry changed."""
+    global catalog, catalog_version
+    before = catalog.get(playlist, ({}, None))[0]
+    if songs is None:
+        if playlist not in catalog:
+            return []
+        changed = list(before)
+        catalog = {p: v for p, v in catalog.items() if p != playlist}
+        save_catalog_snapshot([], [playlist])
+    else:
+        changed = [s for s in set(before) | set(songs) if before.get(s) != songs.get(s)]
+        if playlist in catalog and not changed:
+            return []
+        catalog = dict(catalog)
+        catalog[playlist] = (songs,) + build_listing(playlist, songs)
+        save_catalog_snapshot([playlist], [])
+    catalog_version += 1
+    return changed
+
+
+def update_catalog_playlist(playlist):
+    with catalog_lock:
+        playlist_path = os.path.join(MUSIC_DIR, playlist)
+        songs = None
+        if os.path.isdir(playlist_path):
+            songs = scan_playlist(playlist_path, catalog.get(playlist, ({}, None))[0])
+        return apply_catalog_playlist(playlist, songs)
+
+
+def update_catalog_song(playlist, song):
+    with catalog_lock:
+        if playlist not in catalog:
+            return update_catalog_playlist(playlist)
+        songs = dict(catalog[playlist][0])
+        song_path = os.path.join(MUSIC_DIR, playlist, song)
+        try:
+            if not os.path.isdir(song_path):
+                raise FileNotFoundError(song_path)
+            songs[song] = (os.stat(song_path).st_mtime_ns,) + scan_song_dir(song_path)
+        except FileNotFoundError:
+            songs.pop(song, None)
+        return apply_catalog_playlist(playlist, songs)
+
+
+def refresh_catalog(full=None):
+    """Re-stat the library and rescan only folders whose mtime changed.
+
+    Playlists whose directory mtime is unchanged are skipped; that misses edits
+    inside an existing song folder, so every CATALOG_FULL_CHECK_INTERVAL (or with
+    ``full``) each song folder is re-stat'ed as well. Returns the (playlist, song)
+    pairs whose catalog entry changed.
+    """
+    global catalog_checked, catalog_full_checked
+    with catalog_lock, timed("catalog"):
+        now = time.time()
+        if full is None:
+            full = now - catalog_full_checked > CATALOG_FULL_CHECK_INTERVAL
+        dir_mtimes = {}
+        if os.path.isdir(MUSIC_DIR):
+            for entry in os.scandir(MUSIC_DIR):
+                try:
+                    if entry.is_dir():
+                        dir_mtimes[entry.name] = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    continue
+        changed = []
+        for playlist in sorted(set(catalog) | set(dir_mtimes)):
+            mtime = dir_mtimes.get(playlist)
+            if not full and mtime is not None and catalog_dir_mtimes.get(playlist) == mtime:
+                continue
+            changed.extend((playlist, song) for song in update_catalog_playlist(playlist))
+            # Taken before the scan, so a change made during it is seen next time
+            if mtime is None:
+                catalog_dir_mtimes.pop(playlist, None)
+            else:
+                catalog_dir_mtimes[playlist] = mtime
+        catalog_checked = now
+        if full:
+            catalog_full_checked = now
+        return changed
+
+
+def load_catalog_snapshot():
+    global catalog, catalog_loaded
+    with catalog_lock:
+        catalog_loaded = True
+        if not os.path.isfile(catalog_db_path()):
+            return
+        loaded = {}
+        try:
+            with closing(sqlite3.connect(catalog_db_path())) as db, db:
+                rows = db.execute("SELECT playlist, song, mtime_ns, audio, lrc FROM songs")
+                for playlist, song, mtime, audio, lrc in rows:
+                    loaded.setdefault(playlist, {})[song] = (mtime, audio, lrc)
+        except sqlite3.Error as e:
+            print(f"Ignoring unreadable catalog snapshot: {e}")
+            return
+        catalog = {p: (songs,) + build_listing(p, songs) for p, songs in loaded.items()}
+
+
+def save_catalog_snapshot(changed, removed):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with closing(sqlite3.connect(catalog_db_path())) as db, db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS songs ("
+                "playlist TEXT, song TEXT, mtime_ns INTEGER, audio TEXT, lrc TEXT, "
+                "PRIMARY KEY (playlist, song))"
+            )
+            for playlist in list(changed) + list(removed):
+                db.execute("DELETE FROM songs WHERE playlist = ?", (playlist,))
+            for playlist in changed:
+                db.executemany(
+                    "INSERT INTO songs VALUES (?, ?, ?, ?, ?)",
+                    [(playlist, song) + entry for song, entry in catalog[playlist][0].items()],
+                )
+    except (OSError, sqlite3.Error) as e:
+        print(f"Failed to save catalog snapshot: {e}")
+
+
+@phase("catalog")
+def get_catalog():
+    with catalog_lock:
+        if not catalog_loaded:
+            load_catalog_snapshot()
+        if not catalog_checked or (
+                watcher_mode is None and time.time() - catalog_checked > CATALOG_CHECK_INTERVAL):
+            refresh_catalog()
+        return catalog
+
+
+# --- Lyrics index ---
+
+lyrics_index_lock = threading.Lock()
+
+
+def build_lyrics_index():
+    """Load the lyrics index shared through the cache backend, or build and share it."""
+    global lyrics_index_cache, lyrics_index_timestamp
+    with lyrics_index_lock, timed("lyrics"):
+        shared = lyrics_result_cache.load_index()
+        if shared is not None and time.time() - shared[1] <= CACHE_TTL:
+            index, built = shared
+        else:
+            index, built = {}, time.time()
+            for playlist, (songs, _, _) in get_catalog().items():
+                for song_dir_name, (_, _, lrc) in songs.items():
+                    if lrc:
+                        key = f"{playlist}/{song_dir_name}"
+                        index[key] = os.path.join(MUSIC_DIR, playlist, song_dir_name, lrc)
+            lyrics_result_cache.replace_index(index, built)
+
+        lyrics_index_cache = index
+        lyrics_index_timestamp = built
+    return index
+
+
+@phase("lyrics_index")
+def get_lyrics_index():
+    index = lyrics_index_cache
+    if index is None or (
+            watcher_mode is None and time.time() - lyrics_index_timestamp > CACHE_TTL):
+        index = build_lyrics_index()
+    return index
+
+
+def patch_lyrics_entries(keys):
+    """Bring the lyrics index and results in line with the catalog for the given songs."""
+    songs_by_playlist = get_catalog()
+    changes = {}
+    with lyrics_index_lock:
+        for playlist, song in keys:
+            key = f"{playlist}/{song}"
+            for fmt in LYRICS_FORMATS:
+                lyrics_result_cache.pop(lyrics_cache_key(key, fmt), None)
+            entry = songs_by_playlist.get(playlist, ({}, None))[0].get(song)
+            changes[key] = (os.path.join(MUSIC_DIR, playlist, song, entry[2])
+                            if entry and entry[2] else None)
+            if lyrics_index_cache is None:
+                continue
+            if changes[key]:
+                lyrics_index_cache[key] = changes[key]
+            else:
+                lyrics_index_cache.pop(key, None)
+        lyrics_result_cache.patch_index(changes)
+
+
+# --- Audio metadata ---
+#
+# Header/tag readers for AUDIO_EXTENSIONS. Each returns a dict with any of
+# duration (s), bitrate (kbps), codec, sample_rate, channels, title, artist,
+# album. Results are cached per file by (mtime_ns, size), persisted next to
+# the catalog snapshot and computed on a background pool.
+
+METADATA_WORKERS = 2
+METADATA_FIELDS = ("duration", "bitrate", "codec", "sample_rate", "channels",
+                   "title", "artist", "album")
+
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_BITRATES[(2, 3)] = MP3_BITRATES[(2, 2)]
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+AAC_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050,
+                    16000, 12000, 11025, 8000, 7350]
+ID3_FRAMES = {"TIT2": "title", "TPE1": "artist", "TALB": "album",
+              "TT2": "title", "TP1": "artist", "TAL": "album"}
+VORBIS_FIELDS = {"TITLE": "title", "ARTIST": "artist", "ALBUM": "album"}
+MP4_TAGS = {b"\xa9nam": "title", b"\xa9ART": "artist", b"\xa9alb": "album"}
+RIFF_TAGS = {b"INAM": "title", b"IART": "artist", b"IPRD": "album"}
+
+metadata_lock = threading.Lock()
+metadata_cache = {}  # relative audio path -> (mtime_ns, size, metadata)
+metadata_pending = set()
+metadata_unsaved = []
+metadata_version = 0
+metadata_pool = None
+
+
+def syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decode_id3_text(data):
+    if not data:
+        return ""
+    encoding, body = data[0], data[1:]
+    if encoding == 1:
+        text = body.decode("utf-16", errors="replace")
+    elif encoding == 2:
+        text = body.decode("utf-16-be", errors="replace")
+    elif encoding == 3:
+        text = body.decode("utf-8", errors="replace")
+    else:
+        text = body.decode("latin-1")
+    return text.split("\0")[0].strip()
+
+
+def read_id3v2(f, meta):
+    """Parse an ID3v2 tag at the current position; returns the tag length (0 if none)."""
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    version = header[3]
+    size = syncsafe(header[6:10])
+    tag = f.read(size)
+    pos = 0
+    id_len, header_len = (3, 6) if version == 2 else (4, 10)
+    while pos + header_len <= len(tag):
+        frame_id = tag[pos:pos + id_len].decode("latin-1")
+        if not frame_id.strip("\0"):
+            break
+        if version == 2:
+            frame_size = int.from_bytes(tag[pos + 3:pos + 6], "big")
+        elif version == 4:
+            frame_size = syncsafe(tag[pos + 4:pos + 8])
+        else:
+            frame_size = int.from_bytes(tag[pos + 4:pos + 8], "big")
+        body = tag[pos + header_len:pos + header_len + frame_size]
+        if frame_id in ID3_FRAMES:
+            text = decode_id3_text(body)
+            if text:
+                meta[ID3_FRAMES[frame_id]] = text
+        pos += header_len + frame_size
+    return 10 + size
+
+
+def read_mp3(f, file_size):
+    meta = {"codec": "mp3"}
+    audio_start = read_id3v2(f, meta)
+    f.seek(audio_start)
+    data = f.read(64 * 1024)
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        b1, b2, b3 = data[i + 1], data[i + 2], data[i + 3]
+        version = {3: 1, 2: 2, 0: 2.5}.get((b1 >> 3) & 3)
+        layer = {3: 1, 2: 2, 1: 3}.get((b1 >> 1) & 3)
+        bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+        if version is None or layer is None or bitrate_index in (0, 15) or rate_index == 3:
+            continue
+        bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index]
+        sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+        mono = (b3 >> 6) == 3
+        if layer == 1:
+            samples = 384
+        elif layer == 3 and version != 1:
+            samples = 576
+        else:
+            samples = 1152
+        padding = (b2 >> 1) & 1
+        if layer == 1:
+            frame_length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+        else:
+            frame_length = samples // 8 * bitrate * 1000 // sample_rate + padding
+        following = data[i + frame_length:i + frame_length + 2]
+        if len(following) == 2 and (following[0] != 0xFF or following[1] & 0xE0 != 0xE0):
+            continue  # false sync inside tag padding or garbage
+        meta.update(sample_rate=sample_rate, channels=1 if mono else 2)
+        if layer != 3:
+            meta["codec"] = f"mp{layer}"
+
+        side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+        xing = data[i + 4 + side_info:i + 4 + side_info + 12]
+        vbri = data[i + 36:i + 36 + 18]
+        frames = None
+        if xing[:4] in (b"Xing", b"Info") and int.from_bytes(xing[4:8], "big") & 1:
+            frames = int.from_bytes(xing[8:12], "big")
+        elif vbri[:4] == b"VBRI":
+            frames = int.from_bytes(vbri[14:18], "big")
+        audio_bytes = file_size - audio_start - i
+        if frames:
+            meta["duration"] = frames * samples / sample_rate
+            meta["bitrate"] = round(audio_bytes * 8 / meta["duration"] / 1000)
+        else:
+            meta["duration"] = audio_bytes * 8 / (bitrate * 1000)
+            meta["bitrate"] = bitrate
+        break
+    return meta
+
+
+def mp4_atoms(f, start, end):
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header)
+        offset = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            offset = 16
+        elif size == 0:
+            size = end - pos
+        if size < offset:
+            return
+        yield kind, pos + offset, pos + size
+        pos += size
+
+
+def mp4_find(f, start, end, path):
+    for kind, body, atom_end in mp4_atoms(f, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return body, atom_end
+            skip = 4 if kind == b"meta" else 0  # meta is a full atom: version + flags
+            return mp4_find(f, body + skip, atom_end, path[1:])
+    return None
+
+
+def read_mp4(f, file_size):
+    meta = {}
+    moov = mp4_find(f, 0, file_size, [b"moov"])
+    if moov is None:
+        return meta
+    mvhd = mp4_find(f, moov[0], moov[1], [b"mvhd"])
+    if mvhd:
+        f.seek(mvhd[0])
+        data = f.read(32)
+        if data[0] == 1:
+            timescale, duration = struct.unpack(">IQ", data[20:32])
+        else:
+            timescale, duration = struct.unpack(">II", data[12:20])
+        if timescale:
+            meta["duration"] = duration / timescale
+            meta["bitrate"] = round(file_size * 8 / meta["duration"] / 1000) if duration else None
+    for kind, body, end in mp4_atoms(f, moov[0], moov[1]):
+        if kind != b"trak":
+            continue
+        stsd = mp4_find(f, body, end, [b"mdia", b"minf", b"stbl", b"stsd"])
+        if stsd is None:
+            continue
+        f.seek(stsd[0] + 8)
+        entry = f.read(36)
+        if len(entry) < 36 or entry[4:8] not in (b"mp4a", b"alac", b"Opus", b"fLaC", b"ac-3"):
+            continue
+        meta["codec"] = {b"mp4a": "aac", b"fLaC": "flac"}.get(entry[4:8], entry[4:8].decode().lower())
+        meta["channels"] = struct.unpack(">H", entry[24:26])[0]
+        meta["sample_rate"] = struct.unpack(">I", entry[32:36])[0] >> 16
+        break
+    ilst = mp4_find(f, moov[0], moov[1], [b"udta", b"meta", b"ilst"])
+    if ilst:
+        for kind, body, end in mp4_atoms(f, ilst[0], ilst[1]):
+            if kind in MP4_TAGS:
+                data = mp4_find(f, body, end, [b"data"])
+                if data:
+                    f.seek(data[0] + 8)
+                    meta[MP4_TAGS[kind]] = f.read(data[1] - data[0] - 8).decode("utf-8", "replace")
+    return meta
+
+
+def parse_vorbis_comments(data, meta):
+    vendor_len = struct.unpack_from("<I", data, 0)[0]
+    pos = 4 + vendor_len
+    count = struct.unpack_from("<I", data, pos)[0]
+    pos += 4
+    for _ in range(count):
+        length = struct.unpack_from("<I", data, pos)[0]
+        comment = data[pos + 4:pos + 4 + length].decode("utf-8", "replace")
+        pos += 4 + length
+        key, _, value = comment.partition("=")
+        if key.upper() in VORBIS_FIELDS and value:
+            meta.setdefault(VORBIS_FIELDS[key.upper()], value)
+
+
+def read_flac(f, file_size):
+    meta = {"codec": "flac"}
+    start = read_id3v2(f, {})
+    f.seek(start)
+    if f.read(4) != b"fLaC":
+        return meta
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        last, kind = header[0] & 0x80, header[0] & 0x7F
+        length = int.from_bytes(header[1:4], "big")
+        block = f.read(length)
+        if kind == 0 and len(block) >= 18:
+            packed = int.from_bytes(block[10:18], "big")
+            sample_rate = packed >> 44
+            total_samples = packed & 0xFFFFFFFFF
+            meta.update(sample_rate=sample_rate, channels=((packed >> 41) & 7) + 1)
+            if sample_rate and total_samples:
+                meta["duration"] = total_samples / sample_rate
+                meta["bitrate"] = round(file_size * 8 / meta["duration"] / 1000)
+        elif kind == 4:
+            try:
+                parse_vorbis_comments(block, meta)
+            except struct.error:
+                pass
+        if last:
+            break
+    return meta
+
+
+def read_wav(f, file_size):
+    meta = {}
+    header = f.read(12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return meta
+    byte_rate = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        kind, size = struct.unpack("<4sI", chunk)
+        if kind == b"fmt ":
+            fmt = f.read(size)
+            audio_format, channels, sample_rate, byte_rate = struct.unpack_from("<HHII", fmt)
+            meta.update(channels=channels, sample_rate=sample_rate, bitrate=round(byte_rate * 8 / 1000),
+                        codec={1: "pcm", 3: "pcm_float", 0xFFFE: "pcm"}.get(audio_format, "wav"))
+        elif kind == b"data":
+            if byte_rate:
+                meta["duration"] = min(size, file_size - f.tell()) / byte_rate
+            f.seek(size, 1)
+        elif kind == b"LIST":
+            data = f.read(size)
+            if data[:4] == b"INFO":
+                pos = 4
+                while pos + 8 <= len(data):
+                    sub, sub_size = struct.unpack_from("<4sI", data, pos)
+                    if sub in RIFF_TAGS:
+                        text = data[pos + 8:pos + 8 + sub_size].split(b"\0")[0]
+                        meta[RIFF_TAGS[sub]] = text.decode("utf-8", "replace")
+                    pos += 8 + sub_size + (sub_size & 1)
+        else:
+            f.seek(size, 1)
+        if size & 1:
+            f.seek(1, 1)
+    return meta
+
+
+def read_ogg(f, file_size):
+    meta = {}
+    head = f.read(64 * 1024)
+    if head[:4] != b"OggS":
+        return meta
+    # Headers are small enough to sit within the first pages; join page payloads
+    packets = b""
+    pos = 0
+    while pos + 27 <= len(head) and head[pos:pos + 4] == b"OggS" and len(packets) < 32 * 1024:
+        segments = head[pos + 26]
+        body = pos + 27 + segments
+        length = sum(head[pos + 27:body])
+        packets += head[body:body + length]
+        pos = body + length
+    pre_skip = 0
+    if packets.startswith(b"\x01vorbis"):
+        meta["codec"] = "vorbis"
+        meta["channels"] = packets[11]
+        meta["sample_rate"] = struct.unpack_from("<I", packets, 12)[0]
+        tags = packets.find(b"\x03vorbis")
+        if tags >= 0:
+            parse_vorbis_comments(packets[tags + 7:], meta)
+    elif packets.startswith(b"OpusHead"):
+        meta["codec"] = "opus"
+        meta["channels"] = packets[9]
+        pre_skip = struct.unpack_from("<H", packets, 10)[0]
+        meta["sample_rate"] = 48000
+        tags = packets.find(b"OpusTags")
+        if tags >= 0:
+            parse_vorbis_comments(packets[tags + 8:], meta)
+    else:
+        return meta
+    f.seek(max(file_size - 64 * 1024, 0))
+    tail = f.read()
+    last = tail.rfind(b"OggS")
+    if last >= 0 and last + 14 <= len(tail):
+        granule = struct.unpack_from("<q", tail, last + 6)[0]
+        if granule > 0 and meta.get("sample_rate"):
+            meta["duration"] = (granule - pre_skip) / meta["sample_rate"]
+            meta["bitrate"] = round(file_size * 8 / meta["duration"] / 1000)
+    return meta
+
+
+def read_aac(f, file_size):
+    meta = {"codec": "aac"}
+    start = read_id3v2(f, meta)
+    f.seek(start)
+    data = f.read(256 * 1024)
+    pos = frames = frame_bytes = 0
+    while pos + 7 <= len(data) and frames < 512:
+        if data[pos] != 0xFF or data[pos + 1] & 0xF6 != 0xF0:
+            if frames:
+                break
+            pos += 1
+            continue
+        rate_index = (data[pos + 2] >> 2) & 0xF
+        length = ((data[pos + 3] & 3) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+        if rate_index >= len(AAC_SAMPLE_RATES) or length < 7:
+            break
+        if not frames:
+            meta["sample_rate"] = AAC_SAMPLE_RATES[rate_index]
+            meta["channels"] = ((data[pos + 2] & 1) << 2) | (data[pos + 3] >> 6)
+        frames += 1
+        frame_bytes += length
+        pos += length
+    if frames and meta.get("sample_rate"):
+        # ADTS has no frame count: extrapolate the average frame size over the file
+        seconds_per_frame = 1024 / meta["sample_rate"]
+        meta["bitrate"] = round(frame_bytes / frames * 8 / seconds_per_frame / 1000)
+        meta["duration"] = (file_size - start) / (frame_bytes / frames) * seconds_per_frame
+    return meta
+
+
+METADATA_READERS = {
+    ".mp3": read_mp3,
+    ".m4a": read_mp4,
+    ".aac": read_aac,
+    ".wav": read_wav,
+    ".ogg": read_ogg,
+    ".flac": read_flac,
+}
+
+
+def sniff_reader(f, path):
+    """Pick a reader from the file's magic bytes; extensions are often wrong
+    (e.g. MP4 audio saved as .mp3 by downloaders)."""
+    head = f.read(12)
+    offset = 0
+    if head[:3] == b"ID3" and len(head) >= 10:
+        offset = 10 + syncsafe(head[6:10])
+        f.seek(offset)
+        head = f.read(12)
+    f.seek(0)
+    if head[4:8] == b"ftyp":
+        return read_mp4
+    if head[:4] == b"fLaC":
+        return read_flac
+    if head[:4] == b"RIFF":
+        return read_wav
+    if head[:4] == b"OggS":
+        return read_ogg
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xF6 == 0xF0:
+        return read_aac
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        return read_mp3
+    return METADATA_READERS.get(os.path.splitext(path)[1].lower())
+
+
+def read_audio_metadata(path, file_size):
+    try:
+        with open(path, "rb") as f:
+            reader = sniff_reader(f, path)
+            if reader is None:
+                return {}
+            meta = reader(f, file_size)
+    except (OSError, ValueError, IndexError, struct.error, ZeroDivisionError) as e:
+        print(f"Failed to read metadata from {path}: {e}")
+        return {}
+    if meta.get("duration") is not None:
+        meta["duration"] = round(meta["duration"], 3)
+    return {k: meta[k] for k in METADATA_FIELDS if meta.get(k) not in (None, "")}
+
+
+def extract_metadata(rel_path):
+    global metadata_version
+    try:
+        abs_path = os.path.join(MUSIC_DIR, rel_path)
+        st = os.stat(abs_path)
+        cached = metadata_cache.get(rel_path)
+        if cached is None or cached[:2] != (st.st_mtime_ns, st.st_size):
+            meta = read_audio_metadata(abs_path, st.st_size)
+            with metadata_lock:
+                metadata_cache[rel_path] = (st.st_mtime_ns, st.st_size, meta)
+                metadata_unsaved.append((rel_path, st.st_mtime_ns, st.st_size, meta))
+                metadata_version += 1
+    except OSError:
+        pass
+    finally:
+        with metadata_lock:
+            metadata_pending.discard(rel_path)
+            flush = len(metadata_unsaved) >= 100 or (metadata_unsaved and not metadata_pending)
+            rows = metadata_unsaved[:] if flush else []
+            if flush:
+                del metadata_unsaved[:]
+        if rows:
+            save_metadata_snapshot(rows)
+
+
+def schedule_metadata(rel_paths):
+    global metadata_pool
+    with metadata_lock:
+        todo = [p for p in rel_paths if p not in metadata_pending]
+        metadata_pending.update(todo)
+        if todo and metadata_pool is None:
+            metadata_pool = ThreadPoolExecutor(METADATA_WORKERS, thread_name_prefix="metadata")
+    for rel_path in todo:
+        metadata_pool.submit(extract_metadata, rel_path)
+
+
+def reset_metadata_pool():
+    # Pool threads do not survive fork (gunicorn workers); start a fresh pool lazily
+    global metadata_pool
+    metadata_pool = None
+    metadata_pending.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_metadata_pool)
+
+
+def catalog_audio_paths():
+    return [
+        f"{song['folder']}/{song['name']}/{song['file']}"
+        for _, listing, _ in get_catalog().values()
+        for song in listing
+    ]
+
+
+def invalidate_metadata(keys):
+    """Re-validate metadata for changed songs (the worker re-stats and skips unchanged files)."""
+    songs_by_playlist = get_catalog()
+    paths = []
+    for playlist, song in keys:
+        entry = songs_by_playlist.get(playlist, ({}, None))[0].get(song)
+        if entry and entry[1]:
+            paths.append(f"{playlist}/{song}/{entry[1]}")
+    schedule_metadata(paths)
+
+
+def load_metadata_snapshot():
+    if not os.path.isfile(catalog_db_path()):
+        return
+    try:
+        with closing(sqlite3.connect(catalog_db_path())) as db, db:
+            rows = db.execute("SELECT path, mtime_ns, size, data FROM metadata").fetchall()
+    except sqlite3.Error:
+        return
+    with metadata_lock:
+        for path, mtime, size, data in rows:
+            metadata_cache[path] = (mtime, size, json.loads(data))
+
+
+def save_metadata_snapshot(rows):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with closing(sqlite3.connect(catalog_db_path())) as db, db:
+            db.execute("CREATE TABLE IF NOT EXISTS metadata ("
+                       "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, data TEXT)")
+            db.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+                [(path, mtime, size, json.dumps(meta, ensure_ascii=False))
+                 for path, mtime, size, meta in rows],
+            )
+    except (OSError, sqlite3.Error) as e:
+        print(f"Failed to save metadata snapshot: {e}")
+
+
+def songs_with_metadata(listing):
+    """Merge cached metadata into a playlist listing; queue extraction for the rest."""
+    songs, missing = [], []
+    for song in listing:
+        rel_path = f"{song['folder']}/{song['name']}/{song['file']}"
+        cached = metadata_cache.get(rel_path)
+        if cached is None:
+            missing.append(rel_path)
+            songs.append(song)
+        else:
+            songs.append(dict(song, **cached[2]))
+    if missing:
+        schedule_metadata(missing)
+    return songs
+
+
+# --- Filesystem watcher ---
+#
+# Keeps the catalog and lyrics caches current without periodic full rebuilds.
+# inotify watches the music root, every playlist and every song folder (it is
+# not recursive); elsewhere, or when the watch limit is hit, a polling thread
+# re-stats directory mtimes instead.
+
+WATCH_POLL_INTERVAL = 10
+WATCH_DEBOUNCE = 0.3
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+watcher_mode = None
+
+
+class InotifyWatcher:
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.get_errno = ctypes.get_errno
+        self.watches = {}
+
+    def add(self, parts):
+        path = os.path.join(MUSIC_DIR, *parts)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+        if wd < 0:
+            errno = self.get_errno()
+            if errno == 28:  # ENOSPC: fs.inotify.max_user_watches exhausted
+                raise OSError(errno, "inotify watch limit reached")
+            return
+        self.watches[wd] = parts
+
+    def add_tree(self, parts):
+        self.add(parts)
+        if len(parts) < 2:
+            path = os.path.join(MUSIC_DIR, *parts)
+            for entry in os.scandir(path):
+                if entry.is_dir():
+                    self.add_tree(parts + (entry.name,))
+
+    def read_events(self, timeout):
+        import select
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        buf = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _cookie, length = struct.unpack_from("iIII", buf, offset)
+            name = buf[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            events.append((self.watches.get(wd), mask, os.fsdecode(name)))
+        return events
+
+    def run(self):
+        dirty_playlists, dirty_songs, touched = set(), set(), set()
+        while True:
+            deadline = None
+            while deadline is None or time.time() < deadline:
+                events = self.read_events(WATCH_DEBOUNCE if deadline else None)
+                if not events and deadline:
+                    break
+                deadline = deadline or time.time() + 1
+                for parts, mask, name in events:
+                    if mask & IN_Q_OVERFLOW or parts is None:
+                        dirty_playlists.add(None)
+                        continue
+                    target = parts + (name,) if name else parts
+                    if len(target) == 1:
+                        dirty_playlists.add(target[0])
+                    elif len(target) >= 2:
+                        dirty_songs.add(target[:2])
+                        touched.add(target[:2])
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and len(target) <= 2:
+                        try:
+                            self.add_tree(target)
+                        except FileNotFoundError:
+                            pass
+            try:
+                apply_watch_changes(dirty_playlists, dirty_songs, touched)
+            except Exception as e:  # e.g. a locked shared cache; keep the batch for next time
+                print(f"Failed to apply library changes, retrying with the next batch: {e!r}")
+                continue
+            dirty_playlists, dirty_songs, touched = set(), set(), set()
+
+
+def apply_watch_changes(dirty_playlists, dirty_songs, touched):
+    if None in dirty_playlists:
+        changed = refresh_catalog(full=True)
+    else:
+        changed = []
+        for playlist in dirty_playlists:
+            changed.extend((playlist, song) for song in update_catalog_playlist(playlist))
+        for playlist, song in dirty_songs:
+            if playlist not in dirty_playlists:
+                changed.extend((playlist, s) for s in update_catalog_song(playlist, song))
+    # In-place edits leave the folder entry unchanged, so refresh touched songs too
+    on_library_change(set(changed) | touched)
+
+
+def on_library_change(keys):
+    """Update every derived cache for the (playlist, song) pairs that changed on disk."""
+    if not keys:
+        return
+    patch_lyrics_entries(keys)
+    invalidate_metadata(keys)
+    invalidate_waveforms(keys)
+    invalidate_music_files(keys)
+    update_search_entries(keys)
+
+
+def poll_library():
+    pending = set()
+    while True:
+        time.sleep(WATCH_POLL_INTERVAL)
+        try:
+            pending.update(refresh_catalog(full=True))
+            on_library_change(pending)
+        except Exception as e:  # the catalog already moved on, so keep its changes
+            print(f"Failed to apply library changes, retrying on the next poll: {e!r}")
+            continue
+        pending = set()
+
+
+def start_watcher(mode):
+    global watcher_mode
+    if mode == "off":
+        return
+    target = poll_library
+    if mode in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            watcher = InotifyWatcher()
+            watcher.add_tree(())
+            target = watcher.run
+            watcher_mode = "inotify"
+        except OSError as e:
+            print(f"inotify unavailable ({e}), falling back to polling")
+    if target is poll_library:
+        watcher_mode = "poll"
+
+    def loop():
+        global watcher_mode
+        try:
+            target()
+        except OSError as e:
+            print(f"Filesystem watcher stopped ({e}), falling back to polling")
+            watcher_mode = "poll"
+            poll_library()
+
+    threading.Thread(target=loop, name="library-watcher", daemon=True).start()
+
+
+# --- Static files ---
+
+STATIC_ASSETS = ("background.jpg", "style.css", "script.js", "index.html")  # dependencies first
+COMPRESSIBLE_SUFFIXES = {".html", ".css", ".js"}
+ASSET_MAX_AGE = 365 * 24 * 3600
+COMPRESS_MIN_SIZE = 1024
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip variants are built
+    brotli = None
+
+# name -> {"version", "mime", "mtime", "variants": {encoding: bytes}}; binary assets
+# have no variants and are streamed from disk
+assets = {}
+
+
+def build_assets():
+    """Fingerprint the front-end files and precompress the text ones.
+
+    References between assets (index.html -> style.css, script.js) are rewritten
+    to ``name?v=<hash>`` so those URLs can be cached as immutable.
+    """
+    built = {}
+    for name in STATIC_ASSETS:
+        if not os.path.isfile(name):
+            continue
+        with open(name, "rb") as f:
+            data = f.read()
+        suffix = os.path.splitext(name)[1]
+        entry = {
+            "mime": mimetypes.guess_type(name)[0] or "application/octet-stream",
+            "mtime": os.path.getmtime(name),
+            "variants": None,
+        }
+        if suffix in COMPRESSIBLE_SUFFIXES:
+            text = data.decode("utf-8")
+            for dep, dep_entry in built.items():
+                text = re.sub(
+                    r'((?:href|src)="|url\(["\']?)' + re.escape(dep) + r'(?=["\')])',
+                    lambda m, dep=dep, version=dep_entry["version"]: f"{m.group(1)}{dep}?v={version}",
+                    text,
+                )
+            data = text.encode("utf-8")
+            entry["variants"] = {"identity": data, "gzip": gzip.compress(data, 9)}
+            if brotli is not None:
+                entry["variants"]["br"] = brotli.compress(data, quality=11)
+        entry["version"] = hashlib.sha1(data).hexdigest()[:12]
+        built[name] = entry
+    assets.clear()
+    assets.update(built)
+
+
+def pick_encoding(variants):
+    for encoding in ("br", "gzip"):
+        if encoding in variants and request.accept_encodings[encoding]:
+            return encoding
+    return "identity"
+
+
+def serve_asset(name):
+    if app.debug or name not in assets:
+        build_assets()
+    asset = assets.get(name)
+    if asset is None:
+        return jsonify({"error": "File not found"}), 404
+
+    versioned = name != "index.html" and request.args.get("v") == asset["version"]
+    cache_control = f"public, max-age={ASSET_MAX_AGE}, immutable" if versioned else "no-cache"
+    last_modified = datetime.fromtimestamp(int(asset["mtime"]), timezone.utc)
+
+    if asset["variants"] is None:
+        etag = asset["version"]
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = not_modified(etag, last_modified)
+        else:
+            response = with_validators(
+                send_file(name, mimetype=asset["mime"], conditional=False), etag, last_modified)
+        response.headers["Cache-Control"] = cache_control
+        return response
+
+    encoding = pick_encoding(asset["variants"])
+    etag = f"{asset['version']}-{encoding}"
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = not_modified(etag, last_modified)
+    else:
+        response = with_validators(
+            Response(asset["variants"][encoding], mimetype=asset["mime"]), etag, last_modified)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = cache_control
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@app.route("/")
+def index():
+    return serve_asset("index.html")
+
+
+@app.route("/<any(" + ", ".join(f'"{name}"' for name in STATIC_ASSETS) + "):name>")
+def static_asset(name):
+    return serve_asset(name)
+
+
+@app.after_request
+@phase("compress")
+def compress_json(response):
+    """Gzip large JSON bodies (e.g. /api/batch-lyrics) on the fly."""
+    if (response.mimetype != "application/json" or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.vary.add("Accept-Encoding")
+    if not request.accept_encodings["gzip"]:
+        return response
+    response.set_data(gzip.compress(data, 5))
+    response.headers["Content-Encoding"] = "gzip"
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # The gzip bytes differ from the identity representation, so only a weak match holds
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# --- API ---
+
+@app.route("/api/folders")
+def api_folders():
+    folders = sorted(get_catalog())
+    return conditional_json(folders, content_etag(folders))
+
+
+songs_response_cache = {}  # folder -> ((listing etag, metadata_version), songs, etag)
+
+
+@app.route("/api/songs")
+def api_songs():
+    folder = request.args.get("folder", "")
+    playlist = get_catalog().get(folder)
+    if playlist is None:
+        return jsonify({"error": f"Folder not found: {folder}"}), 404
+    _, listing, listing_etag = playlist
+    cached = songs_response_cache.get(folder)
+    if cached is None or cached[0] != (listing_etag, metadata_version):
+        songs = songs_with_metadata(listing)
+        cached = ((listing_etag, metadata_version), songs, content_etag(songs))
+        songs_response_cache[folder] = cached
+    _, songs, etag = cached
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+    return with_validators(jsonify(songs), etag)
+
+
+PLAYLIST_PAGE_SIZE = 10  # matches songsPerPage in script.js
+PLAYLIST_MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(song_name):
+    return base64.urlsafe_b64encode(song_name.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError (binascii.Error) on anything else."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    # urlsafe_b64decode silently drops characters outside the alphabet
+    return base64.b64decode(padded.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+
+
+def listing_position(listing, song_name):
+    """Index of the first song sorting after song_name (listing is sorted by name)."""
+    lo, hi = 0, len(listing)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if listing[mid]["name"] <= song_name:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+@app.route("/api/playlist")
+def api_playlist():
+    """Songs plus optional metadata and lyrics for one page of a playlist, streamed.
+
+    The cursor names the last song already delivered, so pages stay consistent
+    when songs are added or removed in between.
+    """
+    folder = request.args.get("folder", "")
+    playlist = get_catalog().get(folder)
+    if playlist is None:
+        return jsonify({"error": f"Folder not found: {folder}"}), 404
+    try:
+        limit = int(request.args.get("limit", PLAYLIST_PAGE_SIZE))
+        after = decode_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return jsonify({"error": "Invalid limit or cursor parameter"}), 400
+    limit = max(1, min(limit, PLAYLIST_MAX_PAGE_SIZE))
+    fmt = lyrics_format_arg()
+    if fmt is None:
+        return jsonify({"error": "Invalid format parameter"}), 400
+    with_metadata = request.args.get("metadata", "1") != "0"
+    with_lyrics = request.args.get("lyrics", "0") != "0"
+
+    listing = playlist[1]
+    start = listing_position(listing, after) if after is not None else 0
+    page = listing[start:start + limit]
+    if with_metadata:
+        page = songs_with_metadata(page)
+    next_cursor = encode_cursor(page[-1]["name"]) if start + limit < len(listing) else None
+    index = get_lyrics_index() if with_lyrics else None
+
+    def generate():
+        yield '{"folder": %s, "total": %d, "songs": [' % (json.dumps(folder), len(listing))
+        for i, song in enumerate(page):
+            if with_lyrics:
+                note_readahead_use("lyrics", f"{folder}/{song['name']}")
+                song = dict(song, lyrics=load_lyrics(folder, song["name"], index, fmt))
+            yield ("," if i else "") + json.dumps(song, ensure_ascii=False)
+        yield '], "next_cursor": %s}' % json.dumps(next_cursor)
+
+    return Response(generate(), mimetype="application/json")
+
+
+LRC_TIME_RE = re.compile(r"\[(\d{2}):(\d{2})(?:[.:](\d{2,3}))?\]")
+LRC_OFFSET_RE = re.compile(r"^\[offset:\s*([+-]?\d+)\s*\]$", re.IGNORECASE)
+LYRICS_FORMATS = ("raw", "parsed")
+
+
+@phase("lyrics_parse")
+def parse_lrc(content):
+    """Parse LRC text into parallel, time-sorted arrays.
+
+    Two lines sharing a timestamp are treated as original + translation, matching
+    the pairing rule described in the README. An ``[offset:ms]`` tag shifts every
+    line earlier (positive) or later (negative), as in other LRC players.
+    """
+    lines = []
+    offset = 0.0
+    for line in content.split("\n"):
+        line = line.strip()
+        offset_match = LRC_OFFSET_RE.match(line)
+        if offset_match:
+            offset = int(offset_match.group(1)) / 1000
+            continue
+        matches = list(LRC_TIME_RE.finditer(line))
+        if not matches:
+            continue
+        text = LRC_TIME_RE.sub("", line).strip()
+        if not text:
+            continue
+        for m in matches:
+            frac = m.group(3)
+            seconds = int(m.group(1)) * 60 + int(m.group(2))
+            if frac:
+                seconds += int(frac) / (1000 if len(frac) == 3 else 100)
+            lines.append((round(seconds, 3), text))
+    if offset:
+        lines = [(max(0.0, round(t - offset, 3)), text) for t, text in lines]
+    lines.sort(key=lambda item: item[0])
+
+    times, texts, translations = [], [], []
+    i = 0
+    while i < len(lines):
+        time_, text = lines[i]
+        translation = None
+        if i + 1 < len(lines) and abs(lines[i + 1][0] - time_) < 0.1:
+            translation = lines[i + 1][1]
+            i += 1
+        times.append(time_)
+        texts.append(text)
+        translations.append(translation)
+        i += 1
+    return {"times": times, "texts": texts, "translations": translations}
+
+
+def lyrics_cache_key(cache_key, fmt):
+    return cache_key if fmt == "raw" else f"{cache_key}\0{fmt}"
+
+
+def load_lyrics(folder, song_name, index, fmt="raw"):
+    cache_key = f"{folder}/{song_name}"
+    result = lyrics_result_cache.get(lyrics_cache_key(cache_key, fmt))
+    if result is not None:
+        return result
+
+    if fmt == "parsed":
+        raw = load_lyrics(folder, song_name, index)
+        if not raw["success"]:
+            return raw
+        result = dict(parse_lrc(raw["lyrics"]), success=True, format="parsed")
+        size = len(cache_key) + 16 * len(result["times"]) + sum(
+            len(t.encode("utf-8")) for t in result["texts"] + result["translations"] if t) + 128
+        lyrics_result_cache.set(lyrics_cache_key(cache_key, fmt), result, size)
+        return result
+
+    lrc_path = index.get(cache_key)
+    if lrc_path and os.path.isfile(lrc_path):
+        with phase("lyrics_read"), open(lrc_path, "r", encoding="utf-8", errors="replace") as f:
+            content = f.read()
+        result = {"success": True, "lyrics": content}
+        size = len(cache_key) + len(content.encode("utf-8")) + 128
+    else:
+        result = {"success": False, "message": "Lyrics file not found"}
+        size = len(cache_key) + 128
+
+    lyrics_result_cache.set(cache_key, result, size)
+    return result
+
+
+def lyrics_etag(folder, song_name, index, fmt):
+    lrc_path = index.get(f"{folder}/{song_name}")
+    try:
+        return f"{fmt}-{stat_etag(os.stat(lrc_path))}" if lrc_path else f"{fmt}-none"
+    except OSError:
+        return f"{fmt}-none"
+
+
+def lyrics_format_arg():
+    fmt = request.args.get("format", "raw")
+    return fmt if fmt in LYRICS_FORMATS else None
+
+
+@app.route("/api/lyrics")
+def api_lyrics():
+    folder = request.args.get("folder", "")
+    song_name = request.args.get("song", "")
+    fmt = lyrics_format_arg()
+    if fmt is None:
+        return jsonify({"error": "Invalid format parameter"}), 400
+    index = get_lyrics_index()
+    etag = lyrics_etag(folder, song_name, index, fmt)
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+    note_readahead_use("lyrics", f"{folder}/{song_name}")
+    return with_validators(jsonify(load_lyrics(folder, song_name, index, fmt)), etag)
+
+
+@app.route("/api/batch-lyrics")
+def api_batch_lyrics():
+    folder = request.args.get("folder", "")
+    try:
+        song_names = json.loads(request.args.get("songs", "[]"))
+    except json.JSONDecodeError:
+        return jsonify({"error": "Invalid songs parameter"}), 400
+    fmt = lyrics_format_arg()
+    if fmt is None:
+        return jsonify({"error": "Invalid format parameter"}), 400
+
+    index = get_lyrics_index()
+    etag = content_etag([lyrics_etag(folder, name, index, fmt) for name in song_names])
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+
+    results = {}
+    for song_name in song_names:
+        note_readahead_use("lyrics", f"{folder}/{song_name}")
+        results[song_name] = load_lyrics(folder, song_name, index, fmt)
+
+    return with_validators(jsonify({"success": True, "results": results}), etag)
+
+
+BATCH_LYRICS_WORKERS = 8
+BATCH_LYRICS_WINDOW = 2 * BATCH_LYRICS_WORKERS  # reads in flight per request
+
+lyrics_pool = None
+
+
+def reset_lyrics_pool():
+    global lyrics_pool
+    lyrics_pool = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_lyrics_pool)
+
+
+@app.route("/api/batch-lyrics", methods=["POST"])
+def api_batch_lyrics_stream():
+    """Body: {"folder": ..., "songs": [...], "format": "raw"|"parsed"}.
+
+    Files are read on a thread pool and one NDJSON record is written per song as
+    soon as it is ready, so results arrive in completion order, not request order.
+    """
+    global lyrics_pool
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("songs"), list):
+        return jsonify({"error": "Expected a JSON body with a songs array"}), 400
+    folder = str(body.get("folder", ""))
+    fmt = body.get("format", "raw")
+    if fmt not in LYRICS_FORMATS:
+        return jsonify({"error": "Invalid format parameter"}), 400
+    song_names = [str(name) for name in body["songs"]]
+
+    index = get_lyrics_index()
+    if lyrics_pool is None:
+        lyrics_pool = ThreadPoolExecutor(BATCH_LYRICS_WORKERS, thread_name_prefix="lyrics")
+
+    def generate():
+        names = iter(song_names)
+        pending = {}
+        while True:
+            # Keep a bounded window of reads in flight so a slow client cannot make
+            # finished results pile up in memory
+            while len(pending) < BATCH_LYRICS_WINDOW:
+                name = next(names, None)
+                if name is None:
+                    break
+                note_readahead_use("lyrics", f"{folder}/{name}")
+                pending[lyrics_pool.submit(load_lyrics, folder, name, index, fmt)] = name
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    record = dict(future.result(), song=name)
+                except OSError as e:
+                    record = {"song": name, "success": False, "message": str(e)}
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+# --- Search ---
+#
+# Character bigram inverted index over song folder names and .lrc lines
+# (timestamps stripped), so CJK text needs no word segmentation. Names and
+# lyric lines have separate postings; names are also indexed by single
+# character, and one-character queries match names only. A query copies the
+# postings of its rarest bigram under the lock, then verifies candidates by
+# substring match outside it, stopping once limit + SEARCH_OVERSCAN songs have
+# matched (names first, then lyrics). Removed songs leave tombstones that are
+# compacted once they outnumber live documents.
+
+SEARCH_NGRAM = 2
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_OVERSCAN = 20  # extra matched songs gathered before ranking, per query
+SEARCH_NORMALIZE_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_search_text(text):
+    return SEARCH_NORMALIZE_RE.sub("", unicodedata.normalize("NFKC", text).casefold())
+
+
+def search_grams(norm):
+    if len(norm) < SEARCH_NGRAM:
+        return {norm} if norm else set()
+    return {norm[i:i + SEARCH_NGRAM] for i in range(len(norm) - SEARCH_NGRAM + 1)}
+
+
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.docs = []           # doc id -> (song key, time or None for the name, text, normalized)
+        self.song_docs = {}      # song key -> [doc ids]
+        self.postings = {}       # gram -> array of lyric line doc ids
+        self.name_postings = {}  # gram or single character -> array of name doc ids
+        self.exact_names = {}    # normalized name -> [doc ids]
+        self.deleted = 0
+
+    def _add_doc(self, key, time_, text):
+        norm = normalize_search_text(text)
+        if not norm:
+            return
+        doc_id = len(self.docs)
+        self.docs.append((key, time_, text, norm))
+        self.song_docs[key].append(doc_id)
+        if time_ is None:
+            postings = self.name_postings
+            grams = search_grams(norm) | set(norm)
+            self.exact_names.setdefault(norm, []).append(doc_id)
+        else:
+            postings = self.postings
+            grams = search_grams(norm)
+        for gram in grams:
+            posting = postings.get(gram)
+            if posting is None:
+                posting = postings[gram] = array("I")
+            posting.append(doc_id)
+
+    def set_song(self, key, lyrics=None):
+        """(Re)index one song: its folder name plus parsed lyrics, if any."""
+        with self.lock:
+            self._remove(key)
+            self.song_docs[key] = []
+            self._add_doc(key, None, key.split("/", 1)[1])
+            if lyrics:
+                for time_, text, translation in zip(
+                        lyrics["times"], lyrics["texts"], lyrics["translations"]):
+                    self._add_doc(key, time_, text)
+                    if translation:
+                        self._add_doc(key, time_, translation)
+
+    def remove_song(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        for doc_id in self.song_docs.pop(key, ()):
+            self.docs[doc_id] = None
+            self.deleted += 1
+        if self.deleted > 1000 and self.deleted > len(self.docs) - self.deleted:
+            self._compact()
+
+    def _compact(self):
+        live = [doc for doc in self.docs if doc is not None]
+        self.docs, self.song_docs, self.deleted = [], {}, 0
+        self.postings, self.name_postings, self.exact_names = {}, {}, {}
+        for key, time_, text, _ in live:
+            self.song_docs.setdefault(key, [])
+            self._add_doc(key, time_, text)
+
+    def _candidates(self, postings, grams):
+        """Copy of the rarest posting list among ``grams`` (empty if any is missing)."""
+        lists = [postings.get(gram) for gram in grams]
+        if not lists or not all(lists):
+            return ()
+        return min(lists, key=len)[:]
+
+    @phase("search")
+    def search(self, query, limit):
+        norm = normalize_search_text(query)
+        if not norm:
+            return []
+        with self.lock:
+            # Compaction replaces self.docs rather than mutating it, so this list
+            # stays consistent with the copied postings after the lock is released
+            docs = self.docs
+            exact = list(self.exact_names.get(norm, ()))
+            if len(norm) < SEARCH_NGRAM:
+                name_candidates = self._candidates(self.name_postings, (norm,))
+                line_candidates = ()
+            else:
+                grams = search_grams(norm)
+                name_candidates = self._candidates(self.name_postings, grams)
+                line_candidates = self._candidates(self.postings, grams)
+
+        wanted = limit + SEARCH_OVERSCAN
+        best = {}
+        for candidates in (exact, name_candidates, line_candidates):
+            for doc_id in candidates:
+                if len(best) >= wanted:
+                    break
+                doc = docs[doc_id]
+                if doc is None or norm not in doc[3]:
+                    continue
+                key, time_, text, doc_norm = doc
+                if time_ is None:
+                    rank = 0 if doc_norm == norm else 1 if doc_norm.startswith(norm) else 2
+                else:
+                    rank = 3
+                score = (rank, len(doc_norm), time_ or 0)
+                if key not in best or score < best[key][0]:
+                    best[key] = (score, time_, text)
+        ranked = sorted(best.items(), key=lambda item: (item[1][0], item[0]))[:limit]
+        results = []
+        for key, (_, time_, text) in ranked:
+            folder, name = key.split("/", 1)
+            hit = {"folder": folder, "name": name, "match": "name" if time_ is None else "lyrics"}
+            if time_ is not None:
+                hit.update(line=text, time=time_)
+            results.append(hit)
+        return results
+
+
+search_index = SearchIndex()
+search_index_ready = False
+search_build_lock = threading.Lock()
+search_changes_lock = threading.Lock()
+search_pending = None  # songs changed while a rebuild runs, replayed before it finishes
+search_build_started = False
+
+
+def index_song_for_search(index, playlist, song, lyrics_index):
+    key = f"{playlist}/{song}"
+    lyrics = None
+    lrc_path = lyrics_index.get(key)
+    if lrc_path:
+        # Read directly rather than through lyrics_result_cache so a full build
+        # does not evict the entries listeners are actually using
+        try:
+            with open(lrc_path, "r", encoding="utf-8", errors="replace") as f:
+                lyrics = parse_lrc(f.read())
+        except OSError:
+            pass
+    index.set_song(key, lyrics)
+
+
+def build_search_index():
+    """Index every song name first (fast), then its lyrics, then swap the index in.
+
+    Watcher changes that arrive meanwhile are applied to whichever index is live
+    and also queued; the queue is replayed onto the new index before the build
+    finishes, so none are lost to the swap or overwritten by the lyrics pass.
+    """
+    global search_index, search_index_ready, search_pending
+    with search_build_lock:
+        start = time.perf_counter()
+        with search_changes_lock:
+            search_pending = set()
+        index = SearchIndex()
+        lyrics_index = get_lyrics_index()
+        songs = [(p, song) for p, (entries, _, _) in get_catalog().items() for song in entries]
+        for playlist, song in songs:
+            index.set_song(f"{playlist}/{song}")
+        search_index = index
+        for playlist, song in songs:
+            index_song_for_search(index, playlist, song, lyrics_index)
+        while True:
+            with search_changes_lock:
+                keys = search_pending
+                search_pending = set() if keys else None
+            if not keys:
+                break
+            apply_search_changes(index, keys)
+        search_index_ready = True
+        metrics.observe("index_build_seconds", time.perf_counter() - start, index="search")
+
+
+def start_search_build():
+    """Build the search index in the background unless warmup or an earlier call does."""
+    global search_build_started
+    if not search_build_started:
+        search_build_started = True
+        threading.Thread(target=build_search_index, name="search-index", daemon=True).start()
+
+
+def apply_search_changes(index, keys):
+    songs_by_playlist = get_catalog()
+    lyrics_index = get_lyrics_index()
+    for playlist, song in keys:
+        if song in songs_by_playlist.get(playlist, ({}, None))[0]:
+            index_song_for_search(index, playlist, song, lyrics_index)
+        else:
+            index.remove_song(f"{playlist}/{song}")
+
+
+def update_search_entries(keys):
+    with search_changes_lock:
+        if search_pending is not None:
+            search_pending.update(keys)
+    apply_search_changes(search_index, keys)
+
+
+@app.route("/api/search")
+def api_search():
+    query = request.args.get("q", "").strip()
+    try:
+        limit = max(1, min(int(request.args.get("limit", SEARCH_LIMIT)), SEARCH_MAX_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Invalid limit parameter"}), 400
+    if not query:
+        return jsonify({"error": "Missing q parameter"}), 400
+    if not search_index_ready:
+        start_search_build()  # only needed with --no-warmup
+    return jsonify({
+        "query": query,
+        "results": search_index.search(query, limit),
+        "complete": search_index_ready,
+    })
+
+
+CACHE_GENERATION_INTERVAL = 1.0
+
+cache_generation = 0
+cache_generation_checked = 0.0
+
+
+def reset_local_caches():
+    global lyrics_index_cache, lyrics_index_timestamp, catalog_checked, catalog_full_checked
+    lyrics_index_cache = None
+    lyrics_index_timestamp = 0
+    clear_music_files()
+    catalog_checked = catalog_full_checked = 0
+
+
+@app.before_request
+def check_cache_generation():
+    """Pick up a /api/clear-cache handled by another worker (shared backends)."""
+    global cache_generation, cache_generation_checked
+    now = time.time()
+    if now - cache_generation_checked < CACHE_GENERATION_INTERVAL:
+        return
+    cache_generation_checked = now
+    generation = lyrics_result_cache.generation()
+    if generation is not None and generation != cache_generation:
+        cache_generation = generation
+        reset_local_caches()
+
+
+@app.route("/api/clear-cache", methods=["POST"])
+def api_clear_cache():
+    global cache_generation
+    lyrics_result_cache.clear()
+    cache_generation = lyrics_result_cache.generation() or 0
+    reset_local_caches()
+    return jsonify({"success": True, "message": "Cache cleared"})
+
+
+@app.route("/api/cache-stats")
+def api_cache_stats():
+    return jsonify({"lyrics": lyrics_result_cache.stats()})
+
+
+# --- Downloads ---
+#
+# A persistent queue (SQLite in the cache dir) of Bilibili URLs processed by a
+# background worker using the non-interactive engine from download/download.py.
+# Finished songs are added to the catalog and derived indexes one by one. Under
+# gunicorn every worker runs a queue worker; jobs are claimed atomically, and
+# other workers see the new songs through their watcher.
+# Downloads write to the library and job listings expose source URLs, so all
+# /api/downloads routes 404 unless started with --downloads (optionally also
+# requiring --downloads-token as a bearer token).
+
+DOWNLOAD_DB = "downloads.sqlite3"
+DOWNLOAD_POLL_INTERVAL = 5
+DOWNLOAD_LIST_LIMIT = 100
+DOWNLOAD_TOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "download")
+PLAYLIST_NAME_RE = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+download_settings = {"enabled": False, "token": None}
+download_wakeup = threading.Event()
+download_worker_started = False
+download_content_index = None
+
+
+def download_db():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    db = sqlite3.connect(os.path.join(CACHE_DIR, DOWNLOAD_DB), timeout=30)
+    db.row_factory = sqlite3.Row
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS downloads ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT, playlist TEXT, status TEXT, "
+        "attempts INTEGER DEFAULT 0, error TEXT, files TEXT, pid INTEGER, "
+        "created REAL, started REAL, finished REAL)"
+    )
+    return db
+
+
+def download_engine():
+    """Import download/download.py lazily; it is a script directory, not a package."""
+    if DOWNLOAD_TOOL_DIR not in sys.path:
+        sys.path.insert(0, DOWNLOAD_TOOL_DIR)
+    import download
+    return download
+
+
+def download_job_json(row):
+    job = dict(row)
+    job["files"] = json.loads(job["files"]) if job["files"] else []
+    job.pop("pid")
+    if job["started"]:
+        job["elapsed"] = round((job["finished"] or time.time()) - job["started"], 1)
+    return job
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def requeue_orphaned_downloads():
+    """Jobs left running by a process that no longer exists go back to the queue.
+
+    Run before this process claims anything, so a job carrying our own pid was
+    left by an earlier process that had the same pid (e.g. pid 1 in a container).
+    """
+    with closing(download_db()) as db, db:
+        for row in db.execute("SELECT id, pid FROM downloads WHERE status = 'running'").fetchall():
+            if not row["pid"] or row["pid"] == os.getpid() or not pid_alive(row["pid"]):
+                db.execute("UPDATE downloads SET status = 'pending', pid = NULL WHERE id = ?",
+                           (row["id"],))
+
+
+def claim_download():
+    db = download_db()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute("SELECT * FROM downloads WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+        if row is not None:
+            db.execute("UPDATE downloads SET status = 'running', pid = ?, started = ? WHERE id = ?",
+                       (os.getpid(), time.time(), row["id"]))
+        db.commit()
+        return row
+    finally:
+        db.close()
+
+
+def update_download(job_id, **fields):
+    with closing(download_db()) as db, db:
+        db.execute(f"UPDATE downloads SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                   (*fields.values(), job_id))
+
+
+def add_downloaded_songs(files):
+    """Add just the downloaded songs to the catalog, lyrics and search indexes."""
+    music_root = os.path.abspath(MUSIC_DIR)
+    keys = set()
+    for path in files:
+        parts = os.path.relpath(os.path.abspath(path), music_root).split(os.sep)
+        if len(parts) >= 3:
+            keys.add((parts[0], parts[1]))
+    changed = []
+    for playlist, song in sorted(keys):
+        changed.extend((playlist, s) for s in update_catalog_song(playlist, song))
+    on_library_change(changed)
+    return changed
+
+
+def run_download(job, engine, npx):
+    global download_content_index
+    target = os.path.join(MUSIC_DIR, job["playlist"])
+    if download_content_index is None:
+        # Threads, not processes: this server is multithreaded, so forking it is unsafe
+        download_content_index = engine.ContentIndex(
+            MUSIC_DIR, os.path.join(CACHE_DIR, "content_index.sqlite3"), processes=False)
+    attempts = job["attempts"]
+    while True:
+        attempts += 1
+        update_download(job["id"], attempts=attempts)
+        temp_dir = tempfile.mkdtemp(prefix="bv2mp3-", dir=CACHE_DIR)
+        try:
+            return engine.download_once(job["url"], target, npx, temp_dir, download_content_index)
+        except engine.DOWNLOAD_ERRORS as e:
+            if attempts >= engine.MAX_RETRIES:
+                raise
+            update_download(job["id"], error=str(e))
+            time.sleep(engine.RETRY_BACKOFF * 2 ** (attempts - 1))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def fail_download(job, error):
+    print(f"Download {job['id']} failed: {error!r}")
+    try:
+        update_download(job["id"], status="failed", error=str(error) or repr(error),
+                        finished=time.time(), pid=None)
+    except sqlite3.Error as e:
+        print(f"Failed to record the failure of download {job['id']}: {e}")
+
+
+def download_worker():
+    """Process queued jobs forever; no single job's failure stops the queue."""
+    try:
+        requeue_orphaned_downloads()
+    except sqlite3.Error as e:
+        print(f"Failed to requeue interrupted downloads: {e}")
+    engine = download_engine()
+    while True:
+        try:
+            job = claim_download()
+        except sqlite3.Error as e:
+            print(f"Failed to read the download queue: {e}")
+            job = None
+        if job is None:
+            download_wakeup.wait(DOWNLOAD_POLL_INTERVAL)
+            download_wakeup.clear()
+            continue
+        npx = shutil.which("npx")
+        try:
+            if not npx:
+                raise RuntimeError("npx not found")
+            files = run_download(job, engine, npx)
+            update_download(job["id"], status="done", error=None,
+                            files=json.dumps(files, ensure_ascii=False), finished=time.time(), pid=None)
+        except Exception as e:  # a bug in one job must not kill the worker thread
+            fail_download(job, e)
+            continue
+        try:
+            add_downloaded_songs(files)
+        except Exception as e:  # the files are in place; the watcher or next scan picks them up
+            print(f"Failed to index download {job['id']}: {e!r}")
+
+
+def start_download_worker():
+    global download_worker_started
+    if download_settings["enabled"] and not download_worker_started:
+        download_worker_started = True
+        threading.Thread(target=download_worker, name="downloads", daemon=True).start()
+
+
+def check_download_access():
+    """Error response unless downloads are enabled and the request carries the token."""
+    if not download_settings["enabled"]:
+        return jsonify({"error": "Downloads are disabled; start the server with --downloads"}), 404
+    token = download_settings["token"]
+    scheme, _, supplied = request.headers.get("Authorization", "").partition(" ")
+    if token and not (scheme == "Bearer"
+                      and hmac.compare_digest(supplied.encode("utf-8"), token.encode("utf-8"))):
+        return jsonify({"error": "Invalid download token"}), 401
+    return None
+
+
+@app.route("/api/downloads", methods=["GET", "POST"])
+def api_downloads():
+    denied = check_download_access()
+    if denied:
+        return denied
+    if request.method == "GET":
+        with closing(download_db()) as db, db:
+            rows = db.execute("SELECT * FROM downloads ORDER BY id DESC LIMIT ?",
+                              (DOWNLOAD_LIST_LIMIT,)).fetchall()
+        return jsonify({"jobs": [download_job_json(row) for row in rows]})
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    urls = body.get("urls") or ([body["url"]] if body.get("url") else [])
+    playlist = PLAYLIST_NAME_RE.sub("_", str(body.get("playlist", ""))).strip()
+    if not isinstance(urls, list) or not urls:
+        return jsonify({"error": "Missing urls"}), 400
+    if not playlist or playlist in (".", ".."):
+        return jsonify({"error": "Invalid playlist"}), 400
+    if not shutil.which("npx"):
+        return jsonify({"error": "Downloads need Node.js (npx) on the server"}), 503
+
+    engine = download_engine()
+    extracted = [engine.extract_bilibili_url(str(text)) for text in urls]
+    if not all(extracted):
+        invalid = [text for text, url in zip(urls, extracted) if not url]
+        return jsonify({"error": "No Bilibili URL found", "invalid": invalid}), 400
+
+    now = time.time()
+    with closing(download_db()) as db, db:
+        ids = [db.execute("INSERT INTO downloads (url, playlist, status, created) "
+                          "VALUES (?, ?, 'pending', ?)", (url, playlist, now)).lastrowid
+               for url in extracted]
+        rows = db.execute(f"SELECT * FROM downloads WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id",
+                          ids).fetchall()
+    start_download_worker()
+    download_wakeup.set()
+    return jsonify({"jobs": [download_job_json(row) for row in rows]}), 202
+
+
+@app.route("/api/downloads/<int:job_id>")
+def api_download_status(job_id):
+    denied = check_download_access()
+    if denied:
+        return denied
+    with closing(download_db()) as db, db:
+        row = db.execute("SELECT * FROM downloads WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(download_job_json(row))
+
+
+# --- Audio streaming with Range support ---
 
+STREAM_CHUNK_SIZE = 64 * 1024
 
-def build_lyrics_index():
-    global lyrics_index_cache, lyrics_index_timestamp
-    index = {}
-    if not os.path.isdir(MUSIC_DIR):
-        lyrics_index_cache = index
-        lyrics_index_timestamp = time.time()
-        return
 
-    for playlist in os.listdir(MUSIC_DIR):
-        playlist_path = os.path.join(MUSIC_DIR, playlist)
-        if not os.path.isdir(playlist_path):
-            continue
-        for song_dir_name in os.listdir(playlist_path):
-            song_path = os.path.join(playlist_path, song_dir_name)
-            if not os.path.isdir(song_path):
-                continue
-            lrc_files = glob.glob(os.path.join(song_path, "*.lrc"))
-            if lrc_files:
-                key = f"{playlist}/{song_dir_name}"
-                index[key] = lrc_files[0]
+def parse_range_header(range_header, file_size):
+    """Parse a single-range ``bytes=`` header.
 
-    lyrics_index_cache = index
-    lyrics_index_timestamp = time.time()
+    Returns (start, end) with end clamped to EOF, "unsatisfiable" for ranges that
+    start past EOF, or None for headers we do not understand (serve the full file).
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    start_str, end_str = match.groups()
+    if not start_str:
+        suffix = int(end_str)
+        if suffix == 0 or file_size == 0:
+            return "unsatisfiable"
+        return max(file_size - suffix, 0), file_size - 1
+    start = int(start_str)
+    end = min(int(end_str), file_size - 1) if end_str else file_size - 1
+    if start >= file_size:
+        return "unsatisfiable"
+    if end < start:
+        return None
+    return start, end
 
 
-def get_lyrics_index():
-    global lyrics_index_cache, lyrics_index_timestamp
-    if lyrics_index_cache is None or (time.time() - lyrics_index_timestamp > CACHE_TTL):
-        build_lyrics_index()
-    return lyrics_index_cache
+class FileRange:
+    """Read-only view of ``length`` bytes of an open file starting at ``start``.
 
+    Handed to the WSGI server's file wrapper: servers with sendfile support use
+    fileno() plus the response Content-Length to send the span zero-copy, others
+    call read() in STREAM_CHUNK_SIZE pieces, so memory per stream stays constant.
+    """
 
-def find_audio_file(song_dir_path):
-    for f in sorted(os.listdir(song_dir_path)):
-        if os.path.splitext(f)[1].lower() in AUDIO_EXTENSIONS:
-            return os.path.join(song_dir_path, f)
-    return None
+    def __init__(self, f, start, length, on_close=None):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = length
+        self.on_close = on_close
+        self.callbacks = []  # see on_stream_close()
 
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
 
-# --- Static files ---
+    def fileno(self):
+        return self.f.fileno()
 
-@app.route("/")
-def index():
-    return send_file("index.html")
+    def tell(self):
+        return self.f.tell()
 
+    def close(self):
+        if self.on_close is not None:
+            self.on_close(self.f)
+        else:
+            self.f.close()
+        for func in self.callbacks:
+            func()
 
-# --- API ---
 
-@app.route("/api/folders")
-def api_folders():
-    if not os.path.isdir(MUSIC_DIR):
-        return jsonify([])
-    folders = sorted(
-        d for d in os.listdir(MUSIC_DIR)
-        if os.path.isdir(os.path.join(MUSIC_DIR, d))
-    )
-    return jsonify(folders)
+def if_range_matches(etag, last_modified):
+    """A Range is honoured only if If-Range (when sent) still names this representation."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified <= if_range.date
+    return True
 
 
-@app.route("/api/songs")
-def api_songs():
-    folder = request.args.get("folder", "")
-    playlist_path = os.path.join(MUSIC_DIR, folder)
-    if not os.path.isdir(playlist_path):
-        return jsonify({"error": f"Folder not found: {folder}"}), 404
+# Resolved /music paths: stat result, MIME type and validators, plus a small
+# pool of idle read-only files so the many Range requests of one playback do
+# not each pay for path checks, stat, guess_type and open(). Entries are
+# re-stat'ed at most every MUSIC_STAT_TTL seconds and dropped as soon as the
+# watcher reports a change. A checked-out file is used by one response at a
+# time, since sendfile implementations rely on the file offset.
 
-    songs = []
-    for entry in sorted(os.listdir(playlist_path)):
-        song_dir = os.path.join(playlist_path, entry)
-        if not os.path.isdir(song_dir):
-            continue
-        audio_path = find_audio_file(song_dir)
-        if audio_path:
-            songs.append({
-                "name": entry,
-                "folder": folder,
-                "file": os.path.basename(audio_path)
-            })
+MUSIC_FILE_CACHE_ENTRIES = 512
+MUSIC_STAT_TTL = 1.0
+MUSIC_FDS_PER_FILE = 4
+# Open files block renames and deletes on Windows, so do not keep idle ones there
+MUSIC_FD_POOL = 0 if os.name == "nt" else 64
 
-    return jsonify(songs)
 
+class MusicFile:
+    def __init__(self, abs_path, st):
+        self.abs_path = abs_path
+        self.st = st
+        self.mime_type = mimetypes.guess_type(abs_path)[0] or "application/octet-stream"
+        self.checked = time.monotonic()
+        self.idle = []  # open files ready for reuse
+        self.valid = True
 
-@app.route("/api/lyrics")
-def api_lyrics():
-    folder = request.args.get("folder", "")
-    song_name = request.args.get("song", "")
-    cache_key = f"{folder}/{song_name}"
+    def same_file(self, st):
+        return (st.st_ino, st.st_size, st.st_mtime_ns) == (
+            self.st.st_ino, self.st.st_size, self.st.st_mtime_ns)
 
-    if cache_key in lyrics_result_cache:
-        entry = lyrics_result_cache[cache_key]
-        if time.time() - entry["ts"] < CACHE_TTL:
-            return jsonify(entry["data"])
 
-    index = get_lyrics_index()
-    lrc_path = index.get(cache_key)
+music_files = OrderedDict()  # request path -> MusicFile, least recently used first
+music_files_lock = threading.Lock()
+music_files_stats = {"hits": 0, "misses": 0, "evictions": 0}
+music_idle_files = 0
 
-    if lrc_path and os.path.isfile(lrc_path):
-        with open(lrc_path, "r", encoding="utf-8", errors="replace") as f:
-            content = f.read()
-        result = {"success": True, "lyrics": content}
-    else:
-        result = {"success": False, "message": "Lyrics file not found"}
 
-    lyrics_result_cache[cache_key] = {"ts": time.time(), "data": result}
-    return jsonify(result)
+def drop_music_file(key):
+    """Forget an entry; files still serving a response are closed when released."""
+    global music_idle_files
+    entry = music_files.pop(key, None)
+    if entry is None:
+        return
+    entry.valid = False
+    music_idle_files -= len(entry.idle)
+    for f in entry.idle:
+        f.close()
+    entry.idle = []
 
 
-@app.route("/api/batch-lyrics")
-def api_batch_lyrics():
-    folder = request.args.get("folder", "")
+def get_music_file(filepath):
+    """Cached MusicFile for a /music request path, or None if it is not a file in MUSIC_DIR."""
+    now = time.monotonic()
+    with music_files_lock:
+        entry = music_files.get(filepath)
+        if entry is not None and now - entry.checked < MUSIC_STAT_TTL:
+            music_files.move_to_end(filepath)
+            music_files_stats["hits"] += 1
+            return entry
+        music_files_stats["misses"] += 1
+
+    # safe_join rejects "..", absolute paths and drive letters after normalising
+    abs_path = safe_join(MUSIC_DIR, filepath)
     try:
-        song_names = json.loads(request.args.get("songs", "[]"))
-    except json.JSONDecodeError:
-        return jsonify({"error": "Invalid songs parameter"}), 400
+        st = os.stat(abs_path) if abs_path else None
+    except OSError:
+        st = None
+    with music_files_lock:
+        if st is None or not stat.S_ISREG(st.st_mode):
+            drop_music_file(filepath)
+            return None
+        entry = music_files.get(filepath)
+        if entry is not None and entry.same_file(st):
+            entry.checked = now
+            music_files.move_to_end(filepath)
+            return entry
+        drop_music_file(filepath)
+        entry = music_files[filepath] = MusicFile(abs_path, st)
+        while len(music_files) > MUSIC_FILE_CACHE_ENTRIES:
+            drop_music_file(next(iter(music_files)))
+            music_files_stats["evictions"] += 1
+        return entry
 
-    index = get_lyrics_index()
-    results = {}
 
-    for song_name in song_names:
-        cache_key = f"{folder}/{song_name}"
-        if cache_key in lyrics_result_cache:
-            entry = lyrics_result_cache[cache_key]
-            if time.time() - entry["ts"] < CACHE_TTL:
-                results[song_name] = entry["data"]
-                continue
+def checkout_music_file(entry):
+    global music_idle_files
+    with music_files_lock:
+        if entry.idle:
+            music_idle_files -= 1
+            return entry.idle.pop()
+    return open(entry.abs_path, "rb")
 
-        lrc_path = index.get(cache_key)
-        if lrc_path and os.path.isfile(lrc_path):
-            with open(lrc_path, "r", encoding="utf-8", errors="replace") as f:
-                content = f.read()
-            data = {"success": True, "lyrics": content}
-        else:
-            data = {"success": False, "message": "Lyrics file not found"}
 
-        lyrics_result_cache[cache_key] = {"ts": time.time(), "data": data}
-        results[song_name] = data
+def release_music_file(entry, f):
+    global music_idle_files
+    with music_files_lock:
+        if entry.valid and len(entry.idle) < MUSIC_FDS_PER_FILE and music_idle_files < MUSIC_FD_POOL:
+            entry.idle.append(f)
+            music_idle_files += 1
+            return
+    f.close()
 
-    return jsonify({"success": True, "results": results})
 
+def invalidate_music_files(keys):
+    prefixes = tuple(f"{playlist}/{song}/" for playlist, song in keys)
+    with music_files_lock:
+        for key in [k for k in music_files if k.startswith(prefixes)]:
+            drop_music_file(key)
 
-@app.route("/api/clear-cache", methods=["POST"])
-def api_clear_cache():
-    global lyrics_index_cache, lyrics_index_timestamp, lyrics_result_cache
-    lyrics_index_cache = None
-    lyrics_index_timestamp = 0
-    lyrics_result_cache = {}
-    return jsonify({"success": True, "message": "Cache cleared"})
 
+def clear_music_files():
+    with music_files_lock:
+        for key in list(music_files):
+            drop_music_file(key)
 
-# --- Audio streaming with Range support ---
 
-def parse_range_header(range_header, file_size):
-    match = re.match(r"bytes=(\d+)-(\d*)", range_header)
-    if not match:
-        return None
-    start = int(match.group(1))
-    end_str = match.group(2)
-    end = int(end_str) if end_str else file_size - 1
-    if start >= file_size or end >= file_size:
-        return None
-    return start, end
+def send_audio_file(abs_path, st, mime_type, music_file=None):
+    """Serve a file on disk with validators and single-range support.
 
+    With ``music_file`` the open file comes from (and returns to) its pool.
+    """
+    file_size = st.st_size
+    etag = stat_etag(st)
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
 
-@app.route("/music/<path:filepath>")
-def serve_music(filepath):
-    abs_path = os.path.join(MUSIC_DIR, filepath)
-    if not os.path.isfile(abs_path):
-        return jsonify({"error": "File not found"}), 404
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return not_modified(etag, last_modified)
 
-    file_size = os.path.getsize(abs_path)
-    mime_type = mimetypes.guess_type(abs_path)[0] or "application/octet-stream"
+    def file_response(start, length, status, headers):
+        if music_file is None:
+            f, on_close = open(abs_path, "rb"), None
+        else:
+            f, on_close = checkout_music_file(music_file), partial(release_music_file, music_file)
+        file_range = FileRange(f, start, length, on_close)
+        response = Response(wrap_file(request.environ, file_range, STREAM_CHUNK_SIZE), status,
+                            headers=headers, direct_passthrough=True)
+        response.file_range = file_range
+        return with_validators(response, etag, last_modified)
 
     range_header = request.headers.get("Range")
+    if range_header and not if_range_matches(etag, last_modified):
+        range_header = None
     if range_header:
         ranges = parse_range_header(range_header, file_size)
+        if ranges == "unsatisfiable":
+            return Response(
+                status=416,
+                headers={"Content-Range": f"bytes */{file_size}", "Accept-Ranges": "bytes"},
+            )
         if ranges:
             start, end = ranges
             length = end - start + 1
-            with open(abs_path, "rb") as f:
-                f.seek(start)
-                data = f.read(length)
-            return Response(
-                data,
-                206,
-                headers={
-                    "Content-Type": mime_type,
-                    "Content-Range": f"bytes {start}-{end}/{file_size}",
-                    "Content-Length": str(length),
-                    "Accept-Ranges": "bytes",
-                },
-                direct_passthrough=True,
-            )
+            return file_response(start, length, 206, {
+                "Content-Type": mime_type,
+                "Content-Range": f"bytes {start}-{end}/{file_size}",
+                "Content-Length": str(length),
+                "Accept-Ranges": "bytes",
+            })
+
+    return file_response(0, file_size, 200, {
+        "Content-Type": mime_type,
+        "Content-Length": str(file_size),
+        "Accept-Ranges": "bytes",
+    })
+
+
+@app.route("/music/<path:filepath>")
+def serve_music(filepath):
+    response = track_stream(shape_stream(app.make_response(serve_music_file(filepath))))
+    if response.status_code in (200, 206):
+        note_readahead_use("audio", filepath)
+        if response_start(response) < STREAM_FIRST_SEGMENT:  # a track start, not a seek
+            schedule_readahead(filepath)
+    return response
+
+
+def serve_music_file(filepath):
+    music_file = get_music_file(filepath)
+    if music_file is None:
+        return jsonify({"error": "File not found"}), 404
+
+    quality = request.args.get("quality")
+    if quality:
+        if quality not in TRANSCODE_PROFILES:
+            return jsonify({"error": f"Invalid quality: {quality}"}), 400
+        if FFMPEG is None:
+            # Serving the original instead would silently defeat the point of asking
+            return jsonify({"error": "Transcoding is unavailable: FFmpeg is not installed"}), 501
+        return serve_transcode(music_file.abs_path, music_file.st, quality)
+
+    return send_audio_file(music_file.abs_path, music_file.st, music_file.mime_type, music_file)
+
+
+# --- Stream shaping ---
+
+# Optional per-client limits for /music/ responses (0 = off, the default). Each
+# IP gets a cap on concurrent streams and a token bucket shared by its streams;
+# --max-streams bounds the whole process. The first STREAM_FIRST_SEGMENT bytes of
+# a track skip the pacing (they are still charged, as debt the following chunks
+# pay back) and track starts may use the slots held back from other requests,
+# so a new song starts promptly even while someone scrubs or scrapes. Limits are
+# per worker process under gunicorn.
+
+STREAM_FIRST_SEGMENT = 512 * 1024
+STREAM_BURST_SECONDS = 2.0      # bucket capacity, in seconds of the configured rate
+STREAM_PRIORITY_RESERVE = 0.25  # share of --max-streams only track starts may use
+STREAM_CLIENTS_MAX = 4096       # idle buckets kept before full ones are pruned
+
+stream_settings = {"per_ip": 0, "rate": 0, "max_streams": 0}
+stream_lock = threading.Lock()
+stream_active = {}   # ip -> streams being sent
+stream_buckets = {}  # ip -> TokenBucket
+stream_count = 0
+
+
+class TokenBucket:
+    """Bytes-per-second budget that can go into debt. Callers hold stream_lock."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount):
+        """Take ``amount`` tokens; returns the seconds until the balance is back to zero."""
+        self.refill()
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+def stream_bucket(ip):
+    bucket = stream_buckets.get(ip)
+    if bucket is None:
+        rate = stream_settings["rate"]
+        bucket = stream_buckets[ip] = TokenBucket(rate, rate * STREAM_BURST_SECONDS)
+    return bucket
+
+
+class ShapedIterable:
+    """Paces a response body through its client's token bucket."""
+
+    def __init__(self, iterable, ip, free_bytes):
+        self.iterable = iterable
+        self.ip = ip
+        self.free_bytes = free_bytes
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            with stream_lock:
+                wait = stream_bucket(self.ip).consume(len(chunk))
+            if self.free_bytes > 0:
+                self.free_bytes -= len(chunk)
+            elif wait:
+                metrics.inc("stream_throttled_seconds_total", wait)
+                time.sleep(wait)
+            yield chunk
+
+    def close(self):
+        close = getattr(self.iterable, "close", None)
+        if close is not None:
+            close()
+
+
+def admit_stream(ip, track_start):
+    """Take a stream slot for ``ip``; returns None, or (status, error, retry_after)."""
+    global stream_count
+    per_ip, max_streams = stream_settings["per_ip"], stream_settings["max_streams"]
+    with stream_lock:
+        active = stream_active.get(ip, 0)
+        if per_ip and active >= per_ip:
+            return 429, "Too many concurrent streams from this client", 1
+        if max_streams:
+            limit = max_streams
+            if not track_start:
+                limit = max(1, int(max_streams * (1 - STREAM_PRIORITY_RESERVE)))
+            if stream_count >= limit:
+                return 503, "Server busy, try again shortly", 2
+        stream_active[ip] = active + 1
+        stream_count += 1
+    return None
+
+
+def release_stream(ip):
+    global stream_count
+    with stream_lock:
+        stream_count -= 1
+        if stream_active[ip] > 1:
+            stream_active[ip] -= 1
+            return
+        del stream_active[ip]
+        if len(stream_buckets) > STREAM_CLIENTS_MAX:
+            for idle_ip in [i for i in stream_buckets if i not in stream_active]:
+                bucket = stream_buckets[idle_ip]
+                bucket.refill()
+                if bucket.tokens >= bucket.capacity:
+                    del stream_buckets[idle_ip]
+
+
+def response_start(response):
+    """Offset of the first byte in a 200/206 audio response."""
+    content_range = response.headers.get("Content-Range")
+    if response.status_code != 206 or not content_range:
+        return 0
+    return int(content_range.split()[1].split("-")[0])
+
+
+def shape_stream(response):
+    if response.status_code not in (200, 206) or not any(stream_settings.values()):
+        return response
+    ip = request.remote_addr or ""
+    start = response_start(response)
+    refused = admit_stream(ip, start < STREAM_FIRST_SEGMENT)
+    if refused:
+        response.close()  # hands a pooled file back
+        status, error, retry_after = refused
+        metrics.inc("streams_rejected_total", status=status)
+        refusal = jsonify({"error": error})
+        refusal.status_code = status
+        refusal.headers["Retry-After"] = str(retry_after)
+        return refusal
+    on_stream_close(response, partial(release_stream, ip))
+    if stream_settings["rate"]:
+        # Pacing needs the bytes in Python, so shaped responses give up sendfile
+        response.response = ShapedIterable(response.response, ip,
+                                           max(0, STREAM_FIRST_SEGMENT - start))
+    return response
+
+
+# --- Read-ahead ---
+#
+# When a track starts playing, the next few tracks in catalog order (what the
+# player's sequential mode plays next) are prepared in the background: the
+# kernel is asked to read their leading bytes into the page cache
+# (posix_fadvise WILLNEED, or a plain read where that is unavailable) and their
+# lyrics are loaded into lyrics_result_cache. Prefetches not yet requested are
+# tracked within a byte budget and a time window, so the metrics show how many
+# were used or wasted. Tracking is per process.
+
+READAHEAD_BUDGET_BYTES = 64 * 1024 * 1024  # unrequested prefetched audio
+READAHEAD_WINDOW = 30 * 60                 # seconds before an unused prefetch counts as wasted
+READAHEAD_QUEUE = 16
+
+readahead_settings = {"tracks": 2, "bytes": 1024 * 1024}
+readahead_lock = threading.Lock()
+readahead_queue = queue.Queue(READAHEAD_QUEUE)
+readahead_thread = None
+readahead_pending = OrderedDict()  # (kind, key) -> (bytes, prefetched_at), oldest first
+readahead_pending_bytes = 0
+
+
+def warm_file(path, length):
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, length, os.POSIX_FADV_WILLNEED)
+            return
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+
+
+def drop_prefetch(key, outcome):
+    global readahead_pending_bytes
+    size, _ = readahead_pending.pop(key)
+    readahead_pending_bytes -= size
+    if outcome:
+        metrics.inc(f"readahead_{outcome}_total", kind=key[0])
+
+
+def remember_prefetch(kind, key, size):
+    global readahead_pending_bytes
+    now = time.time()
+    with readahead_lock:
+        if (kind, key) in readahead_pending:
+            drop_prefetch((kind, key), None)
+        readahead_pending[(kind, key)] = (size, now)
+        readahead_pending_bytes += size
+        while readahead_pending:
+            oldest = next(iter(readahead_pending))
+            if (readahead_pending_bytes <= READAHEAD_BUDGET_BYTES
+                    and now - readahead_pending[oldest][1] <= READAHEAD_WINDOW):
+                break
+            drop_prefetch(oldest, "wasted")
+    metrics.inc("readahead_prefetched_total", kind=kind)
+
+
+def note_readahead_use(kind, key):
+    if not readahead_pending:
+        return
+    with readahead_lock:
+        if (kind, key) in readahead_pending:
+            drop_prefetch((kind, key), "used")
+
+
+def prefetch_track(filepath):
+    music_file = get_music_file(filepath)
+    if music_file is None:
+        return
+    length = min(readahead_settings["bytes"], music_file.st.st_size)
+    if length > 0:  # posix_fadvise reads a 0 length as "to the end of the file"
+        warm_file(music_file.abs_path, length)
+        remember_prefetch("audio", filepath, length)
+
+    playlist, song, _ = filepath.split("/", 2)
+    index = get_lyrics_index()
+    if f"{playlist}/{song}" in index:
+        load_lyrics(playlist, song, index, "parsed")
+        remember_prefetch("lyrics", f"{playlist}/{song}", 0)
+
+
+def readahead_worker():
+    while True:
+        filepath = readahead_queue.get()
+        try:
+            prefetch_track(filepath)
+        except OSError:
+            pass  # gone or unreadable: the request itself will report it
+        except Exception as e:  # the only worker: it must outlive any one track
+            print(f"Read-ahead of {filepath} failed: {e!r}")
+
+
+def schedule_readahead(filepath):
+    """Queue the tracks after ``filepath`` (a /music path) in its playlist."""
+    global readahead_thread
+    tracks = readahead_settings["tracks"]
+    parts = filepath.split("/")
+    if not tracks or len(parts) != 3:
+        return
+    playlist = get_catalog().get(parts[0])
+    if playlist is None:
+        return
+    listing = playlist[1]
+    position = listing_position(listing, parts[1]) - 1
+    if position < 0 or listing[position]["name"] != parts[1]:
+        return
+    with readahead_lock:
+        if readahead_thread is None:
+            readahead_thread = threading.Thread(target=readahead_worker, name="readahead",
+                                                daemon=True)
+            readahead_thread.start()
+        for offset in range(1, min(tracks, len(listing) - 1) + 1):
+            song = listing[(position + offset) % len(listing)]
+            path = f"{song['folder']}/{song['name']}/{song['file']}"
+            if ("audio", path) in readahead_pending:
+                continue  # still warm from an earlier prefetch
+            try:
+                readahead_queue.put_nowait(path)
+            except queue.Full:
+                metrics.inc("readahead_dropped_total")
+                break
+
+
+def reset_readahead_worker():
+    global readahead_queue, readahead_thread, readahead_pending_bytes
+    readahead_queue = queue.Queue(READAHEAD_QUEUE)
+    readahead_thread = None
+    readahead_pending.clear()
+    readahead_pending_bytes = 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_readahead_worker)
+
+
+# --- Transcoding ---
+#
+# /music/<path>?quality=low|medium re-encodes through a local ffmpeg. Output is
+# written to cache/transcode/<key>.<pid>.part and streamed to the first
+# listeners while it grows; once complete it is renamed into place and later
+# requests (including Range requests) are served like any other file. Jobs are
+# per process, hence the pid: gunicorn workers never share a .part file, and
+# leftovers are only removed at startup, before workers exist. The cache
+# directory is bounded by size with least-recently-used eviction.
+
+TRANSCODE_PROFILES = {"low": 64, "medium": 128}  # target kbps
+TRANSCODE_CODECS = {
+    # codec: (ffmpeg encoder, muxer, mime type, extension, extra args)
+    "mp3": ("libmp3lame", "mp3", "audio/mpeg", ".mp3", ["-write_xing", "0"]),
+    "opus": ("libopus", "ogg", "audio/ogg", ".opus", []),
+}
+TRANSCODE_CODEC = "mp3"
+TRANSCODE_WORKERS = 2
+TRANSCODE_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+TRANSCODE_POLL_INTERVAL = 0.05
+
+FFMPEG = shutil.which("ffmpeg")
+
+transcode_lock = threading.Lock()
+transcode_jobs = {}  # cache file name -> TranscodeJob
+transcode_slots = threading.BoundedSemaphore(TRANSCODE_WORKERS)
+transcode_cache = None  # OrderedDict: cache file name -> size, oldest first
+transcode_cache_bytes = 0
+
+
+def transcode_dir():
+    return os.path.join(CACHE_DIR, "transcode")
+
+
+class TranscodeError(Exception):
+    pass
+
+
+class TranscodeJob:
+    def __init__(self, src, name, bitrate):
+        encoder, muxer, _, _, extra = TRANSCODE_CODECS[TRANSCODE_CODEC]
+        self.name = name
+        self.dest = os.path.join(transcode_dir(), name)
+        self.part = f"{self.dest}.{os.getpid()}.part"
+        self.done = threading.Event()
+        self.failed = False
+        open(self.part, "wb").close()  # readers may open it before ffmpeg starts writing
+        self.process = subprocess.Popen(
+            [FFMPEG, "-nostdin", "-v", "error", "-y", "-i", src, "-vn", "-threads", "1",
+             "-c:a", encoder, "-b:a", f"{bitrate}k"] + extra + ["-f", muxer, self.part],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        threading.Thread(target=self.wait, name=f"transcode-{name}", daemon=True).start()
+
+    def wait(self):
+        try:
+            _, stderr = self.process.communicate()
+            if self.process.returncode == 0:
+                os.replace(self.part, self.dest)
+                add_transcode_to_cache(self.name, os.path.getsize(self.dest))
+            else:
+                self.failed = True
+                print(f"ffmpeg failed for {self.name}: {stderr.decode(errors='replace').strip()}")
+        except OSError as e:
+            self.failed = True
+            print(f"Transcode of {self.name} failed: {e}")
+        finally:
+            if self.failed:
+                try:
+                    os.remove(self.part)
+                except OSError:
+                    pass
+            transcode_slots.release()
+            with transcode_lock:
+                transcode_jobs.pop(self.name, None)
+            self.done.set()
+
+    def stream(self):
+        """Yield the output as ffmpeg writes it; ends when the job finishes.
+
+        A failed job raises after its last chunk, so the server aborts the
+        response instead of ending it like a complete file.
+        """
+        try:
+            f = open(self.part, "rb")
+        except FileNotFoundError:
+            if self.failed:
+                raise TranscodeError(f"Transcode of {self.name} failed")
+            f = open(self.dest, "rb")  # finished between lookup and open
+        with f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                elif self.done.is_set():
+                    chunk = f.read()  # anything written after the last read
+                    if chunk:
+                        yield chunk
+                    break
+                else:
+                    self.done.wait(TRANSCODE_POLL_INTERVAL)
+        if self.failed:
+            raise TranscodeError(f"Transcode of {self.name} failed")
+
+
+def load_transcode_cache():
+    global transcode_cache, transcode_cache_bytes
+    entries = []
+    if os.path.isdir(transcode_dir()):
+        for entry in os.scandir(transcode_dir()):
+            if entry.name.endswith(".part"):
+                continue  # being written by this or another worker
+            if entry.is_file():
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name, st.st_size))
+    transcode_cache = OrderedDict((name, size) for _, name, size in sorted(entries))
+    transcode_cache_bytes = sum(transcode_cache.values())
+
+
+def remove_partial_transcodes():
+    """Delete .part files left by an interrupted run; call before any worker starts."""
+    if os.path.isdir(transcode_dir()):
+        for entry in os.scandir(transcode_dir()):
+            if entry.name.endswith(".part"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+def add_transcode_to_cache(name, size):
+    global transcode_cache_bytes
+    with transcode_lock:
+        transcode_cache[name] = size
+        transcode_cache_bytes += size
+        while transcode_cache_bytes > TRANSCODE_CACHE_BYTES and len(transcode_cache) > 1:
+            old_name, old_size = transcode_cache.popitem(last=False)
+            transcode_cache_bytes -= old_size
+            try:
+                os.remove(os.path.join(transcode_dir(), old_name))
+            except OSError:
+                pass
+
+
+def serve_transcode(abs_path, st, quality):
+    global transcode_cache_bytes
+    _, _, mime_type, ext, _ = TRANSCODE_CODECS[TRANSCODE_CODEC]
+    source_key = f"{abs_path}\0{st.st_mtime_ns}\0{st.st_size}\0{quality}\0{TRANSCODE_CODEC}"
+    name = hashlib.sha1(source_key.encode("utf-8")).hexdigest()[:24] + ext
+    cached_path = os.path.join(transcode_dir(), name)
+
+    with transcode_lock:
+        if transcode_cache is None:
+            load_transcode_cache()
+        job = transcode_jobs.get(name)
+        if job is None and name in transcode_cache:
+            transcode_cache.move_to_end(name)
+            try:
+                cached_st = os.stat(cached_path)
+                os.utime(cached_path)  # persist recency for the next startup
+                return send_audio_file(cached_path, cached_st, mime_type)
+            except OSError:
+                transcode_cache_bytes -= transcode_cache.pop(name)
+        if job is None:
+            if not transcode_slots.acquire(blocking=False):
+                response = jsonify({"error": "Transcoder busy, try again shortly"})
+                response.status_code = 503
+                response.headers["Retry-After"] = "5"
+                return response
+            try:
+                os.makedirs(transcode_dir(), exist_ok=True)
+                job = TranscodeJob(abs_path, name, TRANSCODE_PROFILES[quality])
+            except OSError as e:
+                transcode_slots.release()
+                return jsonify({"error": f"Transcode failed: {e}"}), 500
+            transcode_jobs[name] = job
+
+    # Still being written: stream what exists and follow the file. Length is unknown,
+    # so ranges are not offered until the cached copy is complete.
+    return Response(job.stream(), 200, mimetype=mime_type,
+                    headers={"Accept-Ranges": "none", "Cache-Control": "no-store"})
+
+
+# --- Waveforms ---
+#
+# Min/max peaks for drawing a seek-bar waveform without downloading the track.
+# PCM WAV is read with the stdlib wave module, anything else is decoded to
+# 8 kHz mono by ffmpeg. Peaks are computed once per file at a few resolutions
+# (finest first; coarser levels are reduced from it) and stored as int16 pairs
+# in <cache-dir>/waveforms.sqlite3, keyed by path and validated by mtime/size.
+# /api/waveform returns raw little-endian int8 or int16 (min, max) pairs.
+
+WAVEFORM_RESOLUTIONS = (2048, 512, 128)  # buckets per track, finest first
+WAVEFORM_DEFAULT_BUCKETS = 128
+WAVEFORM_DB = "waveforms.sqlite3"
+WAVEFORM_SAMPLE_RATE = 8000
+WAVEFORM_BLOCK = 256  # samples per block while streaming ffmpeg output
+WAVEFORM_TIMEOUT = 300
+
+try:
+    import numpy
+except ImportError:  # optional: peaks are computed with array slices instead
+    numpy = None
+
+waveform_lock = threading.Lock()
+waveform_queue = queue.PriorityQueue()  # (priority, seq, rel_path); 0 = a client is waiting
+waveform_pending = set()
+waveform_seq = 0
+waveform_thread = None
+
+
+def waveform_db():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    db = sqlite3.connect(os.path.join(CACHE_DIR, WAVEFORM_DB), timeout=30)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS waveforms ("
+        "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, resolutions TEXT, data BLOB)"
+    )
+    return db
+
+
+def block_peaks(data, sample_width, block):
+    """(mins, maxs) of consecutive ``block``-sample runs of little-endian PCM."""
+    if sample_width == 1:
+        samples = numpy.frombuffer(data, numpy.uint8).astype(numpy.int16) if numpy else array("B", data)
+        offset = 128  # 8-bit WAV is unsigned
+    else:
+        samples = numpy.frombuffer(data, "<i2") if numpy else array("h", data)
+        if not numpy and sys.byteorder == "big":
+            samples.byteswap()
+        offset = 0
+    if numpy:
+        starts = numpy.arange(0, len(samples), block)
+        if not len(starts):
+            return [], []
+        mins = (numpy.minimum.reduceat(samples, starts).astype(numpy.int32) - offset) << (8 if offset else 0)
+        maxs = (numpy.maximum.reduceat(samples, starts).astype(numpy.int32) - offset) << (8 if offset else 0)
+        return mins.tolist(), maxs.tolist()
+    mins, maxs = [], []
+    scale = 256 if offset else 1
+    for i in range(0, len(samples), block):
+        run = samples[i:i + block]
+        mins.append((min(run) - offset) * scale)
+        maxs.append((max(run) - offset) * scale)
+    return mins, maxs
+
+
+def reduce_peaks(mins, maxs, buckets):
+    """Group per-block peaks into ``buckets`` (an empty track gives silence)."""
+    n = len(mins)
+    if not n:
+        return [0] * buckets, [0] * buckets
+    bounds = [min(i * n // buckets, n - 1) for i in range(buckets)] + [n]
+    if numpy:
+        starts = numpy.array(bounds[:-1])
+        return (numpy.minimum.reduceat(numpy.array(mins), starts).tolist(),
+                numpy.maximum.reduceat(numpy.array(maxs), starts).tolist())
+    return ([min(mins[a:max(b, a + 1)]) for a, b in zip(bounds, bounds[1:])],
+            [max(maxs[a:max(b, a + 1)]) for a, b in zip(bounds, bounds[1:])])
+
+
+def wav_peaks(path, buckets):
+    """Finest-level peaks straight from 8/16-bit PCM WAV, or None to use ffmpeg."""
+    try:
+        with wave.open(path, "rb") as w:
+            width, channels, frames = w.getsampwidth(), w.getnchannels(), w.getnframes()
+            if width not in (1, 2) or not frames:
+                return None
+            # Interleaved channels are fine: the envelope covers all of them
+            block_frames = -(-frames // buckets)
+            block = block_frames * channels
+            read_frames = block_frames * max(1, (1 << 16) // block_frames)
+            mins, maxs = [], []
+            while True:
+                data = w.readframes(read_frames)
+                if not data:
+                    break
+                lo, hi = block_peaks(data, width, block)
+                mins += lo
+                maxs += hi
+    except (wave.Error, EOFError, OSError):
+        return None
+    return reduce_peaks(mins, maxs, buckets)
+
+
+def ffmpeg_peaks(path, buckets):
+    if FFMPEG is None:
+        return None
+    proc = subprocess.Popen(
+        [FFMPEG, "-nostdin", "-v", "error", "-threads", "1", "-i", path, "-vn", "-ac", "1",
+         "-ar", str(WAVEFORM_SAMPLE_RATE), "-f", "s16le", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    mins, maxs = [], []
+    deadline = time.time() + WAVEFORM_TIMEOUT
+    chunk_size = WAVEFORM_BLOCK * 2 * 256
+    try:
+        while time.time() < deadline:
+            data = proc.stdout.read(chunk_size)
+            if not data:
+                break
+            lo, hi = block_peaks(data[:len(data) & ~1], 2, WAVEFORM_BLOCK)
+            mins += lo
+            maxs += hi
+        else:
+            proc.kill()
+            return None
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0 or not mins:
+        return None
+    return reduce_peaks(mins, maxs, buckets)
+
+
+def compute_peaks(path):
+    """All resolutions as one little-endian int16 blob of (min, max) pairs, or None."""
+    finest = WAVEFORM_RESOLUTIONS[0]
+    peaks = None
+    if path.lower().endswith(".wav"):
+        peaks = wav_peaks(path, finest)
+    if peaks is None:
+        peaks = ffmpeg_peaks(path, finest)
+    if peaks is None:
+        return None
+    blob = array("h")
+    for buckets in WAVEFORM_RESOLUTIONS:
+        mins, maxs = peaks if buckets == finest else reduce_peaks(*peaks, buckets)
+        for lo, hi in zip(mins, maxs):
+            blob.append(max(-32768, min(32767, lo)))
+            blob.append(max(-32768, min(32767, hi)))
+    if sys.byteorder == "big":
+        blob.byteswap()
+    return blob.tobytes()
+
+
+def load_waveform(rel_path, st):
+    """Stored peaks for the current file version: bytes, None (undecodable), or False (missing)."""
+    try:
+        with closing(waveform_db()) as db, db:
+            row = db.execute("SELECT mtime_ns, size, resolutions, data FROM waveforms WHERE path = ?",
+                             (rel_path,)).fetchone()
+    except sqlite3.Error:
+        return False
+    if row is None or row[:3] != (st.st_mtime_ns, st.st_size, json.dumps(WAVEFORM_RESOLUTIONS)):
+        return False
+    return row[3]
+
+
+def compute_waveform(rel_path):
+    abs_path = os.path.join(MUSIC_DIR, rel_path)
+    try:
+        st = os.stat(abs_path)
+        if load_waveform(rel_path, st) is not False:
+            return  # another worker process got here first
+        store_waveform(rel_path, st, compute_peaks(abs_path))
+    except (OSError, sqlite3.Error) as e:
+        print(f"Failed to compute waveform for {rel_path}: {e}")
+    except Exception as e:  # a decoder bug: record this version as undecodable
+        print(f"Failed to compute waveform for {rel_path}: {e!r}")
+        store_waveform(rel_path, st, None)
+
+
+def store_waveform(rel_path, st, data):
+    with closing(waveform_db()) as db, db:
+        db.execute("INSERT OR REPLACE INTO waveforms VALUES (?, ?, ?, ?, ?)",
+                   (rel_path, st.st_mtime_ns, st.st_size, json.dumps(WAVEFORM_RESOLUTIONS), data))
+
+
+def waveform_worker():
+    while True:
+        _, _, rel_path = waveform_queue.get()
+        with waveform_lock:
+            if rel_path not in waveform_pending:
+                continue  # already done at a higher priority
+        try:
+            compute_waveform(rel_path)
+        except Exception as e:  # the only worker: it must outlive any one file
+            print(f"Failed to compute waveform for {rel_path}: {e!r}")
+        finally:
+            with waveform_lock:
+                waveform_pending.discard(rel_path)
+
+
+def schedule_waveforms(rel_paths, priority=1):
+    global waveform_seq, waveform_thread
+    with waveform_lock:
+        if waveform_thread is None:
+            waveform_thread = threading.Thread(target=waveform_worker, name="waveforms", daemon=True)
+            waveform_thread.start()
+        for rel_path in rel_paths:
+            if rel_path in waveform_pending and priority:
+                continue
+            waveform_pending.add(rel_path)
+            waveform_seq += 1
+            waveform_queue.put((priority, waveform_seq, rel_path))
+
+
+def reset_waveform_worker():
+    global waveform_queue, waveform_thread
+    waveform_queue = queue.PriorityQueue()
+    waveform_thread = None
+    waveform_pending.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_waveform_worker)
 
-    return send_file(abs_path, mimetype=mime_type)
+
+def precompute_waveforms():
+    # Shuffled so several gunicorn workers mostly pick different files first
+    paths = catalog_audio_paths()
+    random.shuffle(paths)
+    schedule_waveforms(paths)
+
+
+def invalidate_waveforms(keys):
+    if waveform_thread is None:
+        return  # not precomputing; changed files are recomputed on request
+    songs_by_playlist = get_catalog()
+    paths = []
+    for playlist, song in keys:
+        entry = songs_by_playlist.get(playlist, ({}, None))[0].get(song)
+        if entry and entry[1]:
+            paths.append(f"{playlist}/{song}/{entry[1]}")
+    schedule_waveforms(paths)
+
+
+@app.route("/api/waveform")
+def api_waveform():
+    folder = request.args.get("folder", "")
+    song = request.args.get("song", "")
+    entry = get_catalog().get(folder, ({}, None))[0].get(song)
+    if not entry or not entry[1]:
+        return jsonify({"error": "Song not found"}), 404
+    try:
+        buckets = int(request.args.get("buckets", WAVEFORM_DEFAULT_BUCKETS))
+        bits = int(request.args.get("bits", 8))
+    except ValueError:
+        buckets = bits = None
+    if buckets not in WAVEFORM_RESOLUTIONS or bits not in (8, 16):
+        return jsonify({"error": f"buckets must be one of {list(WAVEFORM_RESOLUTIONS)}, bits 8 or 16"}), 400
+
+    rel_path = f"{folder}/{song}/{entry[1]}"
+    try:
+        st = os.stat(os.path.join(MUSIC_DIR, rel_path))
+    except OSError:
+        return jsonify({"error": "Song not found"}), 404
+    etag = f"{stat_etag(st)}-{buckets}-{bits}"
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+
+    data = load_waveform(rel_path, st)
+    if data is False:
+        schedule_waveforms([rel_path], priority=0)
+        response = jsonify({"pending": True})
+        response.status_code = 202
+        response.headers["Retry-After"] = "2"
+        return response
+    if data is None:
+        return jsonify({"error": "Waveform unavailable for this file"}), 404
+
+    offset = 0
+    for resolution in WAVEFORM_RESOLUTIONS:
+        if resolution == buckets:
+            break
+        offset += resolution * 4
+    body = data[offset:offset + buckets * 4]
+    if bits == 8:
+        if numpy:
+            body = (numpy.frombuffer(body, "<i2") >> 8).astype(numpy.int8).tobytes()
+        else:
+            pairs = array("h", body)
+            if sys.byteorder == "big":
+                pairs.byteswap()
+            body = array("b", (v >> 8 for v in pairs)).tobytes()
+    response = Response(body, mimetype="application/octet-stream")
+    response.headers["X-Waveform-Buckets"] = str(buckets)
+    response.headers["X-Waveform-Bits"] = str(bits)
+    return with_validators(response, etag)
 
 
 # --- Main ---
 
+SERVER_THREADS = 8
+SERVER_BACKLOG = 2048
+
+
+WARM_CACHE_FRACTION = 0.5  # share of the lyrics cache the warmup may fill
+
+startup_phases = {}  # phase -> seconds, in the order they ran
+
+
+class startup_phase:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        startup_phases[self.name] = time.perf_counter() - self.start
+
+
+def report_startup(label, names, started, note=""):
+    phases = ", ".join(f"{name} {startup_phases[name] * 1000:.0f} ms"
+                       for name in names if name in startup_phases)
+    print(f"{label}: {phases} (total {(time.perf_counter() - started) * 1000:.0f} ms{note})")
+
+
+def prepare_caches():
+    """Get ready to serve from the previous run's snapshot when there is one.
+
+    The lyrics index is derived from the catalog's .lrc entries, so the catalog
+    snapshot restores both. Re-validating it against directory mtimes is left
+    to warm_caches(); only a missing snapshot forces a full scan here.
+    """
+    global catalog_checked
+    started = time.perf_counter()
+    with startup_phase("assets"):
+        build_assets()
+    remove_partial_transcodes()
+    with startup_phase("catalog_snapshot"):
+        load_catalog_snapshot()
+    with startup_phase("metadata_snapshot"):
+        load_metadata_snapshot()
+    if catalog:
+        catalog_checked = time.time()
+    else:
+        with startup_phase("catalog_scan"):
+            refresh_catalog(full=True)
+    with startup_phase("lyrics_index"):
+        build_lyrics_index()
+    report_startup("Startup", ("assets", "catalog_snapshot", "metadata_snapshot",
+                               "catalog_scan", "lyrics_index"), started)
+
+
+def warm_first_pages():
+    """Pre-read the lyrics /api/playlist returns with the first page of each playlist."""
+    index = get_lyrics_index()
+    budget = int(lyrics_result_cache.max_entries * WARM_CACHE_FRACTION)
+    byte_budget = int(lyrics_result_cache.max_bytes * WARM_CACHE_FRACTION)
+    warmed = 0
+    for playlist, (_, listing, _) in sorted(get_catalog().items()):
+        for song in listing[:PLAYLIST_PAGE_SIZE]:
+            stats = lyrics_result_cache.stats()
+            if stats["entries"] is None:  # redis: only count what we add
+                stats = {"entries": warmed, "bytes": 0}
+            if stats["entries"] >= budget or stats["bytes"] >= byte_budget:
+                return warmed
+            load_lyrics(playlist, song["name"], index, "parsed")
+            warmed += 1
+    return warmed
+
+
+def warm_caches():
+    """Background warmup while requests are already being served."""
+    started = time.perf_counter()
+    with startup_phase("catalog_validate"):
+        changed = refresh_catalog(full=True)
+    on_library_change(changed)
+    with startup_phase("lyrics_warm"):
+        warmed = warm_first_pages()
+    with startup_phase("search_index"):
+        build_search_index()
+    report_startup("Warmup", ("catalog_validate", "lyrics_warm", "search_index"), started,
+                   f"; {len(changed)} songs changed since snapshot, {warmed} lyrics pre-read")
+
+
+def start_background_tasks(args):
+    """Per-process startup: threads are not inherited by forked workers.
+
+    With --no-warmup nothing is pre-read: metadata is read as pages list songs
+    and the search index is built on the first search.
+    """
+    global search_build_started
+    with startup_phase("watcher"):
+        start_watcher(args.watch)
+    if args.warmup:
+        search_build_started = True
+        schedule_metadata(catalog_audio_paths())
+        threading.Thread(target=warm_caches, name="cache-warmup", daemon=True).start()
+    start_download_worker()
+    if args.waveforms == "all":
+        precompute_waveforms()
+
+
+def run_gunicorn(args):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("--server gunicorn requires gunicorn: pip install gunicorn")
+
+    class MusicPlayerApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("backlog", args.backlog)
+            self.cfg.set("graceful_timeout", 30)
+            self.cfg.set("post_worker_init", lambda worker: start_background_tasks(args))
+
+        def load(self):
+            return app
+
+    # Caches are built once in the master and inherited by every worker; SIGHUP
+    # replaces workers gracefully without dropping in-flight streams.
+    MusicPlayerApplication().run()
+
+
+def run_waitress(args):
+    try:
+        import waitress
+    except ImportError:
+        sys.exit("--server waitress requires waitress: pip install waitress")
+    start_background_tasks(args)
+    waitress.serve(app, host=args.host, port=args.port, threads=args.threads,
+                   backlog=args.backlog)
+
+
 def main():
+    global CACHE_DIR, TRANSCODE_CODEC, TRANSCODE_CACHE_BYTES, transcode_slots, lyrics_result_cache
     parser = argparse.ArgumentParser(description="Music player server")
     parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: 8080)")
     parser.add_argument("--host", default="0.0.0.0", help="Host to bind to (default: 0.0.0.0)")
-    parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument("--debug", action="store_true",
+                        help="Enable debug mode (always uses the Flask development server)")
+    parser.add_argument("--server", choices=["flask", "waitress", "gunicorn"], default="flask",
+                        help="HTTP server: flask (development, default), waitress (threaded, "
+                             "cross-platform) or gunicorn (multi-process, Linux/macOS)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes for --server gunicorn (default: 1)")
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS,
+                        help=f"Threads per worker for waitress/gunicorn (default: {SERVER_THREADS})")
+    parser.add_argument("--backlog", type=int, default=SERVER_BACKLOG,
+                        help=f"Listen backlog for waitress/gunicorn (default: {SERVER_BACKLOG})")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+                        help=f"Directory for on-disk caches and snapshots (default: {CACHE_DIR})")
+    parser.add_argument("--watch", choices=["auto", "inotify", "poll", "off"], default="auto",
+                        help="Keep caches current by watching music/ (default: auto, "
+                             "inotify on Linux with a polling fallback; off restores TTL rebuilds)")
+    parser.add_argument("--lyrics-cache-entries", type=int, default=LYRICS_CACHE_ENTRIES,
+                        help=f"Max cached lyrics results (default: {LYRICS_CACHE_ENTRIES})")
+    parser.add_argument("--cache-backend", default="memory",
+                        help="Where lyrics results and the lyrics index are cached: memory "
+                             "(per process, default), sqlite (shared by the workers on this "
+                             "host) or a redis://host:port/db URL (needs the redis package)")
+    parser.add_argument("--lyrics-cache-mb", type=int, default=LYRICS_CACHE_BYTES // (1024 * 1024),
+                        help="Max memory for cached lyrics results in MB "
+                             f"(default: {LYRICS_CACHE_BYTES // (1024 * 1024)})")
+    parser.add_argument("--transcode-codec", choices=sorted(TRANSCODE_CODECS), default=TRANSCODE_CODEC,
+                        help=f"Codec for ?quality= transcodes (default: {TRANSCODE_CODEC})")
+    parser.add_argument("--transcode-workers", type=int, default=TRANSCODE_WORKERS,
+                        help=f"Max concurrent ffmpeg processes (default: {TRANSCODE_WORKERS})")
+    parser.add_argument("--transcode-cache-mb", type=int,
+                        default=TRANSCODE_CACHE_BYTES // (1024 * 1024),
+                        help="Disk budget for cached transcodes in MB "
+                             f"(default: {TRANSCODE_CACHE_BYTES // (1024 * 1024)})")
+    parser.add_argument("--waveforms", choices=["all", "on-demand"], default="all",
+                        help="Precompute waveform peaks for the whole library in the background, "
+                             "or only when first requested (default: all)")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false",
+                        help="Skip background catalog validation, lyrics pre-reads, metadata "
+                             "and search indexing at startup (for benchmarks)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile a sample of requests into <cache-dir>/profiles")
+    parser.add_argument("--profile-rate", type=float, default=0.01,
+                        help="Fraction of requests profiled with --profile (default: 0.01)")
+    parser.add_argument("--profile-format", choices=PROFILE_FORMATS, default="collapsed",
+                        help="collapsed stacks (flamegraph) or cProfile pstats (default: collapsed)")
+    parser.add_argument("--slow-ms", type=float, default=SLOW_REQUEST_MS,
+                        help=f"Log requests slower than this, 0 to disable (default: {SLOW_REQUEST_MS})")
+    parser.add_argument("--downloads", action="store_true",
+                        help="Accept POST /api/downloads and run the download queue")
+    parser.add_argument("--downloads-token",
+                        help="Require 'Authorization: Bearer <token>' on POST /api/downloads")
+    parser.add_argument("--readahead", type=int, default=readahead_settings["tracks"],
+                        help="Tracks after the one being played to prefetch, 0 to disable "
+                             f"(default: {readahead_settings['tracks']})")
+    parser.add_argument("--readahead-kb", type=int, default=readahead_settings["bytes"] // 1024,
+                        help="Leading bytes of each prefetched track, in KB "
+                             f"(default: {readahead_settings['bytes'] // 1024})")
+    parser.add_argument("--stream-limit-per-ip", type=int, default=0,
+                        help="Max concurrent audio streams per client IP, answered with 429 "
+                             "beyond it (default: 0, unlimited)")
+    parser.add_argument("--stream-rate-kbps", type=int, default=0,
+                        help="Per-IP audio bandwidth in KB/s; track starts are sent unpaced "
+                             "(default: 0, unlimited)")
+    parser.add_argument("--max-streams", type=int, default=0,
+                        help="Max concurrent audio streams per process, answered with 503 "
+                             "beyond it (default: 0, unlimited)")
+    parser.add_argument("--proxy-hops", type=int, default=0,
+                        help="Trust this many X-Forwarded-For hops for the client IP "
+                             "when behind a reverse proxy (default: 0)")
     args = parser.parse_args()
 
-    print(f"Serving on http://{args.host}:{args.port}")
-    app.run(host=args.host, port=args.port, debug=args.debug)
+    CACHE_DIR = args.cache_dir
+    TRANSCODE_CODEC = args.transcode_codec
+    TRANSCODE_CACHE_BYTES = args.transcode_cache_mb * 1024 * 1024
+    transcode_slots = threading.BoundedSemaphore(args.transcode_workers)
+    try:
+        lyrics_result_cache = make_cache_backend(args.cache_backend, args.lyrics_cache_entries,
+                                                 args.lyrics_cache_mb * 1024 * 1024, CACHE_TTL)
+    except ValueError as e:
+        parser.error(str(e))
+    profile_settings.update(rate=args.profile_rate if args.profile else 0.0,
+                            format=args.profile_format, slow_ms=args.slow_ms)
+    if args.profile:
+        app.add_url_rule("/api/profile", view_func=api_profile, methods=["GET", "POST"])
+    stream_settings.update(per_ip=args.stream_limit_per_ip, rate=args.stream_rate_kbps * 1024,
+                           max_streams=args.max_streams)
+    download_settings.update(enabled=args.downloads or bool(args.downloads_token),
+                             token=args.downloads_token)
+    readahead_settings.update(tracks=args.readahead, bytes=args.readahead_kb * 1024)
+    if args.proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=args.proxy_hops)
+    prepare_caches()
+
+    server = "flask" if args.debug else args.server
+    print(f"Serving on http://{args.host}:{args.port} ({server})")
+    if server == "gunicorn":
+        run_gunicorn(args)
+    elif server == "waitress":
+        run_waitress(args)
+    else:
+        start_background_tasks(args)
+        app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
 
 
 if __name__ == "__main__":
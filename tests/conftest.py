@@ -0,0 +1,35 @@
+import os
+import queue
+import sys
+from collections import OrderedDict
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    """Give each test its own module-level caches, indexes and settings."""
+    monkeypatch.setattr(server, "catalog", {})
+    monkeypatch.setattr(server, "catalog_checked", 0)
+    monkeypatch.setattr(server, "catalog_full_checked", 0)
+    monkeypatch.setattr(server, "catalog_dir_mtimes", {})
+    monkeypatch.setattr(server, "metadata_cache", {})
+    monkeypatch.setattr(server, "music_files", OrderedDict())
+    monkeypatch.setattr(server, "lyrics_index_cache", None)
+    monkeypatch.setattr(server, "lyrics_result_cache", server.LRUCache(
+        server.LYRICS_CACHE_ENTRIES, server.LYRICS_CACHE_BYTES, server.CACHE_TTL))
+    monkeypatch.setattr(server, "search_index", server.SearchIndex())
+    monkeypatch.setattr(server, "search_index_ready", False)
+    monkeypatch.setattr(server, "search_pending", None)
+    monkeypatch.setattr(server, "search_build_started", False)
+    monkeypatch.setattr(server, "readahead_queue", queue.Queue(server.READAHEAD_QUEUE))
+    monkeypatch.setattr(server, "readahead_pending", OrderedDict())
+    monkeypatch.setattr(server, "readahead_pending_bytes", 0)
+    monkeypatch.setattr(server, "transcode_cache", None)
+    monkeypatch.setattr(server, "transcode_jobs", {})
+    monkeypatch.setattr(server, "download_settings", {"enabled": False, "token": None})
+    monkeypatch.setattr(server, "profile_settings", dict(server.profile_settings))
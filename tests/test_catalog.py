@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    music = tmp_path / "music"
+    (music / "p" / "a").mkdir(parents=True)
+    (music / "p" / "a" / "a.mp3").write_bytes(b"x")
+    monkeypatch.setattr(server, "MUSIC_DIR", str(music))
+    monkeypatch.setattr(server, "CACHE_DIR", str(tmp_path / "cache"))
+    return music
+
+
+def test_unchanged_playlists_are_not_rescanned(library, monkeypatch):
+    assert server.refresh_catalog() == [("p", "a")]
+    scans = []
+    monkeypatch.setattr(server, "update_catalog_playlist",
+                        lambda playlist: scans.append(playlist) or [])
+    server.refresh_catalog()
+    assert scans == []
+    server.refresh_catalog(full=True)
+    assert scans == ["p"]
+
+
+def test_new_song_folder_is_picked_up(library):
+    server.refresh_catalog()
+    (library / "p" / "b").mkdir()
+    (library / "p" / "b" / "b.mp3").write_bytes(b"x")
+    os.utime(library / "p", ns=(0, os.stat(library / "p").st_mtime_ns + 1))
+    assert server.refresh_catalog() == [("p", "b")]
+
+
+class StopPolling(BaseException):
+    pass
+
+
+def test_polling_survives_a_failed_batch(monkeypatch):
+    scans = iter([[("p", "a")], [], []])
+    applied = []
+
+    def on_library_change(keys):
+        applied.append(set(keys))
+        if len(applied) == 1:
+            raise RuntimeError("database is locked")
+
+    def sleep(seconds):
+        if len(applied) == 2:
+            raise StopPolling
+    monkeypatch.setattr(server, "refresh_catalog", lambda full=None: next(scans))
+    monkeypatch.setattr(server, "on_library_change", on_library_change)
+    monkeypatch.setattr(server.time, "sleep", sleep)
+    with pytest.raises(StopPolling):
+        server.poll_library()
+    assert applied == [{("p", "a")}, {("p", "a")}]
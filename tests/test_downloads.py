@@ -0,0 +1,89 @@
+import os
+import types
+from contextlib import closing
+
+import pytest
+
+import server
+
+
+class QueueDrained(Exception):
+    pass
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "CACHE_DIR", str(tmp_path))
+
+    def add(url, status="pending", pid=None):
+        with closing(server.download_db()) as db, db:
+            return db.execute("INSERT INTO downloads (url, playlist, status, pid) VALUES (?, 'p', ?, ?)",
+                              (url, status, pid)).lastrowid
+    return add
+
+
+def statuses():
+    with closing(server.download_db()) as db:
+        return {row["url"]: (row["status"], row["error"])
+                for row in db.execute("SELECT * FROM downloads")}
+
+
+def test_worker_survives_an_unexpected_error(queue, monkeypatch):
+    queue("bad")
+    queue("good")
+
+    def run_download(job, engine, npx):
+        if job["url"] == "bad":
+            raise KeyError("boom")
+        return []
+
+    def wait(timeout):
+        raise QueueDrained
+    monkeypatch.setattr(server, "download_engine", lambda: types.SimpleNamespace())
+    monkeypatch.setattr(server, "run_download", run_download)
+    monkeypatch.setattr(server, "add_downloaded_songs", lambda files: [])
+    monkeypatch.setattr(server.shutil, "which", lambda name: "/usr/bin/npx")
+    monkeypatch.setattr(server.download_wakeup, "wait", wait)
+    with pytest.raises(QueueDrained):
+        server.download_worker()
+    assert statuses() == {"bad": ("failed", "'boom'"), "good": ("done", None)}
+
+
+def test_interrupted_jobs_are_requeued(queue):
+    queue("ours", status="running", pid=os.getpid())
+    queue("gone", status="running", pid=None)
+    server.requeue_orphaned_downloads()
+    assert statuses() == {"ours": ("pending", None), "gone": ("pending", None)}
+
+
+@pytest.mark.parametrize("settings, headers, status", [
+    ({"enabled": False, "token": None}, {}, 404),
+    ({"enabled": True, "token": "s3cret"}, {}, 401),
+    ({"enabled": True, "token": "s3cret"}, {"Authorization": "Bearer wrong"}, 401),
+    ({"enabled": True, "token": "s3cret"}, {"Authorization": "Bearer s3cret"}, 400),
+    ({"enabled": True, "token": None}, {}, 400),
+], ids=["off", "no-token", "bad-token", "token", "open"])
+def test_queueing_downloads_is_opt_in(queue, monkeypatch, settings, headers, status):
+    monkeypatch.setattr(server, "download_settings", settings)
+    response = server.app.test_client().post("/api/downloads", json={}, headers=headers)
+    assert response.status_code == status  # 400: allowed through to body validation
+
+
+@pytest.mark.parametrize("settings, headers, status", [
+    ({"enabled": False, "token": None}, {}, 404),
+    ({"enabled": True, "token": "s3cret"}, {}, 401),
+    ({"enabled": True, "token": "s3cret"}, {"Authorization": "Bearer s3cret"}, 200),
+], ids=["off", "no-token", "token"])
+def test_job_listings_need_the_same_access(queue, monkeypatch, settings, headers, status):
+    job_id = queue("https://www.bilibili.com/video/BV1")
+    monkeypatch.setattr(server, "download_settings", settings)
+    client = server.app.test_client()
+    assert client.get("/api/downloads", headers=headers).status_code == status
+    assert client.get(f"/api/downloads/{job_id}", headers=headers).status_code == status
+
+
+@pytest.mark.parametrize("body", [[], ["https://b23.tv/x"], "https://b23.tv/x", 1])
+def test_non_object_bodies_are_rejected(queue, monkeypatch, body):
+    monkeypatch.setattr(server, "download_settings", {"enabled": True, "token": None})
+    response = server.app.test_client().post("/api/downloads", json=body)
+    assert response.status_code == 400
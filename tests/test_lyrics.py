@@ -0,0 +1,24 @@
+import server
+
+
+def test_translation_pairs_with_the_line_sharing_its_timestamp():
+    parsed = server.parse_lrc("[ti:Song]\n"
+                              "[00:15.28]曾羡慕闲云野鹤\n"
+                              "[00:15.28]I once envied the clouds\n"
+                              "[00:18.50]寄情于天地\n"
+                              "[00:20.00]\n")
+    assert parsed == {"times": [15.28, 18.5], "texts": ["曾羡慕闲云野鹤", "寄情于天地"],
+                      "translations": ["I once envied the clouds", None]}
+
+
+def test_line_with_several_timestamps_repeats_in_time_order():
+    parsed = server.parse_lrc("[01:00.000][00:10]副歌\n[00:30.50]主歌")
+    assert parsed["times"] == [10.0, 30.5, 60.0]
+    assert parsed["texts"] == ["副歌", "主歌", "副歌"]
+
+
+def test_offset_shifts_every_line():
+    earlier = server.parse_lrc("[offset:+500]\n[00:10.00]a\n[00:00.20]b")
+    assert earlier["times"] == [0.0, 9.5]
+    later = server.parse_lrc("[offset:-250]\n[00:10.00]a")
+    assert later["times"] == [10.25]
@@ -0,0 +1,37 @@
+import pytest
+
+import server
+
+AUDIO = bytes(range(256)) * 64
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    song_dir = tmp_path / "playlist" / "song"
+    song_dir.mkdir(parents=True)
+    (song_dir / "song.mp3").write_bytes(AUDIO)
+    monkeypatch.setattr(server, "MUSIC_DIR", str(tmp_path))
+    return server.app.test_client()
+
+
+def streams_active():
+    return server.metrics.gauges.get(("streams_active", ()), 0)
+
+
+def test_missing_music_file_is_404(client):
+    response = client.get("/music/nope/x.mp3")
+    assert response.status_code == 404
+    assert streams_active() == 0
+
+
+@pytest.mark.parametrize("headers, status, body", [
+    ({}, 200, AUDIO),
+    ({"Range": "bytes=100-199"}, 206, AUDIO[100:200]),
+], ids=["full", "range"])
+def test_streams_active_returns_to_zero(client, headers, status, body):
+    before = streams_active()
+    response = client.get("/music/playlist/song/song.mp3", headers=headers)
+    assert response.status_code == status
+    assert response.get_data() == body
+    response.close()
+    assert streams_active() == before
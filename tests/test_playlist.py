@@ -0,0 +1,21 @@
+import pytest
+
+import server
+
+
+@pytest.fixture
+def client(monkeypatch):
+    listing = [{"folder": "pl", "name": name, "file": f"{name}.mp3"} for name in "abcde"]
+    monkeypatch.setattr(server, "get_catalog", lambda: {"pl": ({}, listing, 0)})
+    return server.app.test_client()
+
+
+def test_cursor_pages_through_the_playlist(client):
+    first = client.get("/api/playlist?folder=pl&limit=2&metadata=0").get_json()
+    second = client.get(f"/api/playlist?folder=pl&limit=2&metadata=0&cursor={first['next_cursor']}")
+    assert [song["name"] for song in second.get_json()["songs"]] == ["c", "d"]
+
+
+@pytest.mark.parametrize("cursor", ["!!!", "YQ=!", "a", "é"])
+def test_malformed_cursor_is_rejected(client, cursor):
+    assert client.get(f"/api/playlist?folder=pl&metadata=0&cursor={cursor}").status_code == 400
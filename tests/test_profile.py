@@ -0,0 +1,12 @@
+import server
+
+
+def test_runtime_profiling_needs_the_flag_and_loopback():
+    client = server.app.test_client()
+    assert client.post("/api/profile", json={"rate": 1}).status_code == 404
+    with server.app.test_request_context("/api/profile", method="POST", json={"rate": 1},
+                                         environ_base={"REMOTE_ADDR": "203.0.113.5"}):
+        assert server.api_profile()[1] == 403
+    with server.app.test_request_context("/api/profile", method="POST", json={"rate": 0.5},
+                                         environ_base={"REMOTE_ADDR": "127.0.0.1"}):
+        assert server.api_profile().get_json()["rate"] == 0.5
@@ -0,0 +1,56 @@
+import io
+
+import pytest
+
+import server
+
+AUDIO = bytes(range(256)) * 4  # 1024 bytes
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=1000-", (1000, 1023)),
+    ("bytes=1000-5000", (1000, 1023)),  # end clamped to EOF
+    ("bytes=-100", (924, 1023)),        # suffix
+    ("bytes=-5000", (0, 1023)),         # suffix longer than the file
+    ("bytes=1024-", "unsatisfiable"),
+    ("bytes=-0", "unsatisfiable"),
+    ("bytes=50-10", None),
+    ("bytes=0-1,5-9", None),            # multiple ranges: serve the whole file
+    ("items=0-1", None),
+    ("bytes=-", None),
+])
+def test_parse_range_header(header, expected):
+    assert server.parse_range_header(header, len(AUDIO)) == expected
+
+
+def test_suffix_on_an_empty_file_is_unsatisfiable():
+    assert server.parse_range_header("bytes=-1", 0) == "unsatisfiable"
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    (tmp_path / "p" / "s").mkdir(parents=True)
+    (tmp_path / "p" / "s" / "s.mp3").write_bytes(AUDIO)
+    monkeypatch.setattr(server, "MUSIC_DIR", str(tmp_path))
+    return server.app.test_client()
+
+
+def test_suffix_range_response(client):
+    response = client.get("/music/p/s/s.mp3", headers={"Range": "bytes=-100"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 924-1023/1024"
+    assert response.get_data() == AUDIO[-100:]
+
+
+def test_range_past_eof_is_416(client):
+    response = client.get("/music/p/s/s.mp3", headers={"Range": "bytes=2000-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */1024"
+
+
+def test_file_range_reads_only_its_span():
+    span = server.FileRange(io.BytesIO(AUDIO), 100, 50)
+    assert span.read(30) == AUDIO[100:130]
+    assert span.read() == AUDIO[130:150]
+    assert span.read() == b""
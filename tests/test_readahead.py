@@ -0,0 +1,67 @@
+import pytest
+
+import server
+
+
+def song(name):
+    return {"folder": "ra", "name": name, "file": f"{name}.mp3"}
+
+
+@pytest.fixture
+def readahead(monkeypatch):
+    listing = [song(name) for name in ("a", "b", "c", "d")]
+    monkeypatch.setattr(server, "get_catalog", lambda: {"ra": ({}, listing, 0)})
+    monkeypatch.setattr(server, "get_lyrics_index", lambda: {})
+    monkeypatch.setattr(server, "readahead_settings", {"tracks": 2, "bytes": 1024})
+    monkeypatch.setattr(server, "readahead_thread", object())  # do not start the worker
+    return server.readahead_queue
+
+
+def queued(q):
+    return [q.get_nowait() for _ in range(q.qsize())]
+
+
+def test_next_tracks_are_queued_in_order_and_wrap(readahead):
+    server.schedule_readahead("ra/c/c.mp3")
+    assert queued(readahead) == ["ra/d/d.mp3", "ra/a/a.mp3"]
+    server.schedule_readahead("ra/zz/zz.mp3")
+    assert queued(readahead) == []
+
+
+def test_zero_bytes_prefetches_no_audio(readahead, tmp_path, monkeypatch):
+    (tmp_path / "ra" / "a").mkdir(parents=True)
+    (tmp_path / "ra" / "a" / "a.mp3").write_bytes(b"x" * 4096)
+    monkeypatch.setattr(server, "MUSIC_DIR", str(tmp_path))
+    monkeypatch.setitem(server.readahead_settings, "bytes", 0)
+    monkeypatch.setattr(server, "warm_file", lambda path, length: pytest.fail("warmed"))
+    server.prefetch_track("ra/a/a.mp3")
+    assert ("audio", "ra/a/a.mp3") not in server.readahead_pending
+
+
+class StopWorker(BaseException):
+    pass
+
+
+def test_worker_outlives_unexpected_errors(readahead, monkeypatch):
+    seen = []
+
+    def prefetch(path):
+        seen.append(path)
+        if path == "stop":
+            raise StopWorker
+        raise KeyError(path)
+    monkeypatch.setattr(server, "prefetch_track", prefetch)
+    for path in ("ra/a/a.mp3", "ra/b/b.mp3", "stop"):
+        readahead.put(path)
+    with pytest.raises(StopWorker):
+        server.readahead_worker()
+    assert seen == ["ra/a/a.mp3", "ra/b/b.mp3", "stop"]
+
+
+def test_lyrics_delivered_with_a_playlist_page_count_as_used(readahead):
+    server.remember_prefetch("lyrics", "ra/a", 0)
+    used = server.metrics.counters.get(("readahead_used_total", (("kind", "lyrics"),)), 0)
+    response = server.app.test_client().get("/api/playlist?folder=ra&lyrics=1&metadata=0&limit=1")
+    response.get_data()
+    assert not server.readahead_pending
+    assert server.metrics.counters.get(("readahead_used_total", (("kind", "lyrics"),)), 0) == used + 1
@@ -0,0 +1,89 @@
+import pytest
+
+import server
+
+
+def test_lru_evicts_least_recently_used_first():
+    cache = server.LRUCache(3, 1 << 20, 3600)
+    for key in "abc":
+        cache.set(key, key.upper(), 10)
+    assert cache.get("a") == "A"  # now the most recent
+    cache.set("d", "D", 10)
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_accounts_bytes():
+    cache = server.LRUCache(100, 100, 3600)
+    cache.set("a", 1, 40)
+    cache.set("b", 2, 40)
+    cache.set("a", 3, 70)  # replacing refunds the old 40, then 110 bytes evicts b
+    assert (cache.get("b"), cache.get("a"), cache.stats()["bytes"]) == (None, 3, 70)
+    cache.set("huge", 4, 101)  # never stored, and nothing is evicted for it
+    assert (cache.get("huge"), cache.get("a")) == (None, 3)
+
+
+def test_lru_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "time", lambda: now[0])
+    cache = server.LRUCache(10, 1 << 20, 60)
+    cache.set("a", 1, 10)
+    now[0] += 61
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1 and cache.stats()["bytes"] == 0
+
+
+def test_clear_in_another_process_resets_local_state(tmp_path, monkeypatch):
+    path = str(tmp_path / "results.sqlite3")
+    ours, theirs = (server.SQLiteCache(path, 10, 1 << 20, 3600) for _ in range(2))
+    monkeypatch.setattr(server, "lyrics_result_cache", ours)
+    monkeypatch.setattr(server, "cache_generation", ours.generation())
+    resets = []
+    monkeypatch.setattr(server, "reset_local_caches", lambda: resets.append(1))
+
+    def check():
+        monkeypatch.setattr(server, "cache_generation_checked", 0.0)
+        server.check_cache_generation()
+
+    check()
+    assert resets == []
+    theirs.set("p/a", {"success": True}, 10)
+    theirs.clear()
+    assert ours.get("p/a") is None
+    check()
+    check()  # the same generation only resets once
+    assert resets == [1]
+
+
+def sqlite_cache(tmp_path):
+    return server.SQLiteCache(str(tmp_path / "results.sqlite3"), 2, 1 << 20, 3600)
+
+
+def redis_cache(tmp_path):
+    fakeredis = pytest.importorskip("fakeredis")
+    return server.RedisCache("redis://", 2, 1 << 20, 3600, client=fakeredis.FakeRedis())
+
+
+@pytest.mark.parametrize("make", [sqlite_cache, redis_cache], ids=["sqlite", "redis"])
+def test_lyrics_index_is_kept_outside_the_results(tmp_path, make):
+    cache = make(tmp_path)
+    assert cache.load_index() is None
+    cache.replace_index({"p/a": "/m/p/a/a.lrc", "p/b": "/m/p/b/b.lrc"}, 100.0)
+    for i in range(5):  # more results than max_entries
+        cache.set(f"r{i}", {"i": i}, 10)
+    cache.patch_index({"p/b": None, "p/c": "/m/p/c/c.lrc"})
+    assert cache.load_index() == ({"p/a": "/m/p/a/a.lrc", "p/c": "/m/p/c/c.lrc"}, 100.0)
+    cache.clear()
+    assert cache.load_index() is None
+
+
+def test_redis_clear_survives_an_unreachable_server():
+    fakeredis = pytest.importorskip("fakeredis")
+    down = fakeredis.FakeServer()
+    down.connected = False
+    cache = server.RedisCache("redis://", 10, 1 << 20, 3600,
+                              client=fakeredis.FakeRedis(server=down))
+    cache.clear()
+    assert cache.errors_seen == 1
+    assert cache.load_index() is None
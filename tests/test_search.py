@@ -0,0 +1,61 @@
+import server
+
+
+def lyrics(*lines):
+    return {"times": [float(i) for i in range(len(lines))], "texts": list(lines),
+            "translations": [None] * len(lines)}
+
+
+def test_ranking_and_limit():
+    index = server.SearchIndex()
+    for i in range(200):
+        index.set_song(f"p/song {i}", lyrics("hello world", "something else"))
+    index.set_song("p/hello", lyrics("la la"))
+    results = index.search("hello", 5)
+    assert len(results) == 5
+    assert results[0] == {"folder": "p", "name": "hello", "match": "name"}
+    assert all(hit["match"] == "lyrics" for hit in results[1:])
+
+
+def test_single_character_matches_names_only():
+    index = server.SearchIndex()
+    index.set_song("p/夜曲", lyrics("月光"))
+    index.set_song("p/晴天", lyrics("夜晚"))
+    assert [hit["name"] for hit in index.search("夜", 10)] == ["夜曲"]
+
+
+def test_removed_song_is_not_found():
+    index = server.SearchIndex()
+    index.set_song("p/晴天", lyrics("刮风这天"))
+    index.remove_song("p/晴天")
+    assert index.search("刮风", 10) == []
+
+
+def test_changes_during_rebuild_survive_the_swap(monkeypatch):
+    catalog = {"p": ({"晴天": None, "夜曲": None}, [], "")}
+    monkeypatch.setattr(server, "get_catalog", lambda: catalog)
+    monkeypatch.setattr(server, "get_lyrics_index", lambda: {})
+    original = server.index_song_for_search
+
+    def remove_midway(index, playlist, song, lyrics_index):
+        if "夜曲" in catalog["p"][0]:
+            del catalog["p"][0]["夜曲"]
+            server.update_search_entries([("p", "夜曲")])
+        original(index, playlist, song, lyrics_index)
+
+    monkeypatch.setattr(server, "index_song_for_search", remove_midway)
+    server.build_search_index()
+    assert server.search_index.search("夜曲", 10) == []
+    assert [hit["name"] for hit in server.search_index.search("晴天", 10)] == ["晴天"]
+
+
+def test_first_search_builds_the_index_without_warmup(monkeypatch):
+    builds = []
+    monkeypatch.setattr(server, "build_search_index", lambda: builds.append(1))
+    client = server.app.test_client()
+    assert client.get("/api/search?q=x").get_json()["complete"] is False
+    client.get("/api/search?q=x")
+    for thread in server.threading.enumerate():
+        if thread.name == "search-index":
+            thread.join()
+    assert builds == [1]
@@ -0,0 +1,58 @@
+import pytest
+
+import server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake monotonic time; sleeping advances it and is recorded."""
+    state = {"now": 100.0, "sleeps": []}
+
+    def sleep(seconds):
+        state["sleeps"].append(round(seconds, 6))
+        state["now"] += seconds
+    monkeypatch.setattr(server.time, "monotonic", lambda: state["now"])
+    monkeypatch.setattr(server.time, "sleep", sleep)
+    return state
+
+
+@pytest.fixture
+def shaping(monkeypatch):
+    monkeypatch.setattr(server, "stream_settings", {"per_ip": 2, "rate": 1000, "max_streams": 4})
+    monkeypatch.setattr(server, "stream_buckets", {})
+    monkeypatch.setattr(server, "stream_active", {})
+    monkeypatch.setattr(server, "stream_count", 0)
+
+
+def test_bucket_bursts_then_goes_into_debt(clock):
+    bucket = server.TokenBucket(1000, 2000)
+    assert bucket.consume(1500) == 0.0
+    assert bucket.consume(1000) == 0.5  # 500 bytes of debt at 1000 B/s
+    clock["now"] += 10
+    bucket.refill()
+    assert bucket.tokens == 2000  # refills only up to capacity
+
+
+def test_free_first_segment_is_charged_and_repaid(clock, shaping):
+    chunks = [b"x" * 1000] * 6
+    shaped = server.ShapedIterable(iter(chunks), "1.2.3.4", free_bytes=3000)
+    assert list(shaped) == chunks
+    # 2000 burst + 3000 unpaced bytes leave 1000 of debt before the fourth chunk
+    assert clock["sleeps"] == [2.0, 1.0, 1.0]
+
+
+def test_clients_share_nothing(clock, shaping):
+    list(server.ShapedIterable(iter([b"x" * 2000]), "a", free_bytes=0))
+    list(server.ShapedIterable(iter([b"x" * 2000]), "b", free_bytes=0))
+    assert clock["sleeps"] == []
+
+
+def test_admission_limits_per_ip_and_reserves_slots_for_track_starts(shaping):
+    assert server.admit_stream("a", track_start=False) is None
+    assert server.admit_stream("a", track_start=False) is None
+    assert server.admit_stream("a", track_start=True)[0] == 429
+    assert server.admit_stream("b", track_start=False) is None
+    assert server.admit_stream("c", track_start=False)[0] == 503  # 3 of 4 for seeks
+    assert server.admit_stream("c", track_start=True) is None
+    server.release_stream("a")
+    assert server.stream_active == {"a": 1, "b": 1, "c": 1}
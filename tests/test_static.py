@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("path", [
+    "/cache/catalog.sqlite3",
+    "/cache/downloads.sqlite3",
+    "/server.py",
+    "/requests.jsonl",
+])
+def test_project_files_are_not_served(path):
+    assert server.app.test_client().get(path).status_code == 404
+
+
+def test_assets_are_served(monkeypatch):
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # assets are cwd-relative
+    client = server.app.test_client()
+    assert client.get("/").status_code == 200
+    assert client.get("/script.js").status_code == 200
@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pytest
+
+import server
+
+
+def test_quality_without_ffmpeg_is_not_the_original(tmp_path, monkeypatch):
+    song_dir = tmp_path / "playlist" / "song"
+    song_dir.mkdir(parents=True)
+    (song_dir / "song.flac").write_bytes(b"fLaC" + bytes(1024))
+    monkeypatch.setattr(server, "MUSIC_DIR", str(tmp_path))
+    monkeypatch.setattr(server, "FFMPEG", None)
+    client = server.app.test_client()
+    assert client.get("/music/playlist/song/song.flac?quality=low").status_code == 501
+    assert client.get("/music/playlist/song/song.flac?quality=bogus").status_code == 400
+    assert client.get("/music/playlist/song/song.flac").status_code == 200
+
+
+FAKE_FFMPEG = """#!{python}
+import sys
+
+import pytest
+with open(sys.argv[-1], "wb") as f:
+    f.write(b"partial")
+sys.exit({status})
+"""
+
+
+def transcode_client(tmp_path, monkeypatch, status):
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(FAKE_FFMPEG.format(python=sys.executable, status=status))
+    ffmpeg.chmod(0o755)
+    song_dir = tmp_path / "music" / "playlist" / "song"
+    song_dir.mkdir(parents=True)
+    (song_dir / "song.flac").write_bytes(b"fLaC" + bytes(1024))
+    monkeypatch.setattr(server, "MUSIC_DIR", str(tmp_path / "music"))
+    monkeypatch.setattr(server, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(server, "FFMPEG", str(ffmpeg))
+    return server.app.test_client()
+
+
+def test_failed_transcode_aborts_the_response(tmp_path, monkeypatch):
+    client = transcode_client(tmp_path, monkeypatch, status=1)
+    response = client.get("/music/playlist/song/song.flac?quality=low")
+    with pytest.raises(server.TranscodeError):
+        response.get_data()
+    assert os.listdir(server.transcode_dir()) == []
+
+
+def test_transcode_is_cached_after_success(tmp_path, monkeypatch):
+    client = transcode_client(tmp_path, monkeypatch, status=0)
+    assert client.get("/music/playlist/song/song.flac?quality=low").get_data() == b"partial"
+    for job in list(server.transcode_jobs.values()):
+        job.done.wait(5)
+    names = os.listdir(server.transcode_dir())
+    assert len(names) == 1 and not names[0].endswith(".part")
+
+
+def test_only_startup_removes_partial_transcodes(tmp_path, monkeypatch):
+    transcode_client(tmp_path, monkeypatch, status=0)
+    os.makedirs(server.transcode_dir())
+    part = os.path.join(server.transcode_dir(), "abc.mp3.12345.part")
+    open(part, "wb").close()
+    server.load_transcode_cache()
+    assert os.path.exists(part)
+    server.remove_partial_transcodes()
+    assert not os.path.exists(part)
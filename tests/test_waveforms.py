@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import server
+
+
+class StopWorker(BaseException):
+    pass
+
+
+def test_decoder_bug_marks_the_file_and_keeps_the_worker(tmp_path, monkeypatch):
+    for name in ("a", "b"):
+        (tmp_path / "p" / name).mkdir(parents=True)
+        (tmp_path / "p" / name / f"{name}.wav").write_bytes(b"RIFF")
+    monkeypatch.setattr(server, "MUSIC_DIR", str(tmp_path))
+    monkeypatch.setattr(server, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(server, "waveform_thread", object())  # run the worker inline below
+    monkeypatch.setattr(server, "waveform_queue", server.queue.PriorityQueue())
+    monkeypatch.setattr(server, "waveform_pending", set())
+
+    def compute_peaks(path):
+        if path.endswith("a.wav"):
+            raise ZeroDivisionError("bad header")
+        return b"\0" * 4
+
+    def store_waveform(rel_path, st, data, store=server.store_waveform):
+        store(rel_path, st, data)
+        if rel_path.endswith("b.wav"):
+            raise StopWorker
+    monkeypatch.setattr(server, "compute_peaks", compute_peaks)
+    monkeypatch.setattr(server, "store_waveform", store_waveform)
+    server.schedule_waveforms(["p/a/a.wav", "p/b/b.wav"])
+    with pytest.raises(StopWorker):
+        server.waveform_worker()
+    st = os.stat(tmp_path / "p" / "a" / "a.wav")
+    assert server.load_waveform("p/a/a.wav", st) is None  # undecodable, not pending forever
+    assert server.load_waveform("p/b/b.wav", os.stat(tmp_path / "p" / "b" / "b.wav")) == b"\0" * 4